@@ -0,0 +1,85 @@
+"""
+Reference-audio ingest: decode, downmix to mono and resample once, then serve repeats from a bounded LRU
+of the resulting tensors.
+
+Files are decoded in-process by torchaudio, compressed formats such as mp3 included (through its ffmpeg
+or soundfile backend), so nothing is converted or written next to the input. Paths are keyed on
+(path, mtime, size), so an edited file is decoded again. File objects, e.g. uploaded bytes, are keyed
+on a hash of their contents.
+"""
+
+import hashlib
+import os
+import threading
+from typing import BinaryIO, Hashable, Optional, Union
+
+import torch
+import torchaudio
+from segment_cache import CacheStats, SegmentTokenCache
+
+AudioSource = Union[str, os.PathLike, BinaryIO]
+
+
+def decode_audio(source: AudioSource, sample_rate: int) -> torch.Tensor:
+    """Decode an audio file (path or file object) to a mono (num_samples,) float tensor at ``sample_rate``."""
+    audio, file_sample_rate = torchaudio.load(source)
+    if audio.shape[0] > 1:
+        audio = torch.mean(audio, dim=0, keepdim=True)
+    return torchaudio.functional.resample(audio.squeeze(0), orig_freq=file_sample_rate, new_freq=sample_rate)
+
+
+def _source_key(source: AudioSource) -> Hashable:
+    if isinstance(source, (str, os.PathLike)):
+        path = os.path.abspath(source)
+        stat = os.stat(path)
+        return ("path", path, stat.st_mtime_ns, stat.st_size)
+    position = source.tell()
+    digest = hashlib.blake2b(source.read(), digest_size=16).hexdigest()
+    source.seek(position)
+    return ("bytes", digest)
+
+
+class AudioCache:
+    """
+    Bounded LRU of decoded reference audio, keyed on the source and the target sample rate.
+
+    Returned tensors are shared with the cache and must not be modified in place.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self._entries = SegmentTokenCache(max_bytes=max_bytes)
+        # The server decodes uploads from several request threads at once.
+        self._lock = threading.Lock()
+
+    def load(self, source: AudioSource, sample_rate: int) -> torch.Tensor:
+        key = (_source_key(source), sample_rate)
+        with self._lock:
+            cached = self._entries.get(key)
+        if cached is not None:
+            return cached[0]
+        audio = decode_audio(source, sample_rate)
+        with self._lock:
+            self._entries.put(key, (audio,))
+        return audio
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.invalidate()
+
+    @property
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return self._entries.stats
+
+
+_default_cache = AudioCache()
+
+
+def load_audio(source: AudioSource, sample_rate: int, cache: Optional[AudioCache] = _default_cache) -> torch.Tensor:
+    """
+    ``decode_audio`` through ``cache`` (a process-wide one by default), so repeated loads of the same
+    reference skip decoding, downmixing and resampling. ``cache=None`` always decodes.
+    """
+    if cache is None:
+        return decode_audio(source, sample_rate)
+    return cache.load(source, sample_rate)
@@ -0,0 +1,175 @@
+"""
+Incremental audio output: clips (conversation turns, long-form chunks) are appended to a file or stream
+as soon as they are generated, instead of being collected and concatenated at the end.
+
+Memory stays at one clip however long the output gets, and what has been written survives a crash: the
+WAV header is rewritten after every clip, so the file is always valid up to the last finished clip.
+
+    with open_sink("conversation.wav", generator.sample_rate, gap_ms=500) as sink:
+        for turn in turns:
+            sink.append(generate(turn))
+"""
+
+import os
+import struct
+from typing import BinaryIO, Optional
+
+import torch
+
+
+def to_pcm16(audio: torch.Tensor) -> bytes:
+    return (audio.detach().float().clamp(-1, 1) * 32767).to(torch.int16).cpu().numpy().tobytes()
+
+
+class AudioSink:
+    """
+    Appends 1D clips at ``sample_rate``, separated by ``gap_ms`` of silence or blended over ``crossfade_ms``
+    with a linear crossfade (as ``longform.crossfade_concat``). Subclasses implement ``_write``.
+
+    With a crossfade, the last ``crossfade_ms`` of each clip is held back until the next clip (or ``close``).
+    """
+
+    def __init__(self, sample_rate: int, gap_ms: float = 0, crossfade_ms: float = 0):
+        if gap_ms and crossfade_ms:
+            raise ValueError("Use either gap_ms or crossfade_ms, not both")
+        self.sample_rate = sample_rate
+        self._gap = int(gap_ms * sample_rate / 1000)
+        self._fade = int(crossfade_ms * sample_rate / 1000)
+        self._tail: Optional[torch.Tensor] = None
+        self.samples_written = 0
+        self.clips = 0
+
+    def append(self, clip: torch.Tensor) -> None:
+        clip = clip.detach().float().cpu()
+        if clip.numel() == 0:
+            return
+        # Held back for the next crossfade, which overlaps at most this clip (as in crossfade_concat).
+        keep = min(self._fade, clip.numel())
+        parts = []
+        if self._tail is not None:
+            overlap = min(self._fade, self._tail.numel(), clip.numel())
+            if overlap:
+                ramp = torch.linspace(0, 1, overlap)
+                parts += [self._tail[:-overlap], self._tail[-overlap:] * (1 - ramp) + clip[:overlap] * ramp]
+                clip = clip[overlap:]
+            else:
+                parts += [self._tail, torch.zeros(self._gap)]
+        elif self.clips:
+            parts.append(torch.zeros(self._gap))
+        pending = torch.cat(parts + [clip])
+
+        self._tail = pending[pending.numel() - keep :] if keep else None
+        self._emit(pending[: pending.numel() - keep])
+        self.clips += 1
+
+    def close(self) -> None:
+        if self._tail is not None:
+            self._emit(self._tail)
+            self._tail = None
+        self._close()
+
+    def _emit(self, samples: torch.Tensor) -> None:
+        if samples.numel():
+            self._write(samples)
+            self.samples_written += samples.numel()
+
+    def _write(self, samples: torch.Tensor) -> None:
+        raise NotImplementedError
+
+    def _close(self) -> None:
+        pass
+
+    @property
+    def seconds_written(self) -> float:
+        return self.samples_written / self.sample_rate
+
+    def __enter__(self) -> "AudioSink":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class PcmSink(AudioSink):
+    """Raw 16-bit little-endian mono PCM to a binary stream (a socket, stdout, an HTTP response), flushed per write."""
+
+    def __init__(self, stream: BinaryIO, sample_rate: int, gap_ms: float = 0, crossfade_ms: float = 0):
+        super().__init__(sample_rate, gap_ms, crossfade_ms)
+        self._stream = stream
+
+    def _write(self, samples: torch.Tensor) -> None:
+        self._stream.write(to_pcm16(samples))
+        self._stream.flush()
+
+
+class WavSink(AudioSink):
+    """16-bit mono WAV file, its header patched after every write."""
+
+    def __init__(self, path: str, sample_rate: int, gap_ms: float = 0, crossfade_ms: float = 0):
+        super().__init__(sample_rate, gap_ms, crossfade_ms)
+        self.path = path
+        self._file = open(path, "wb")
+        self._data_bytes = 0
+        self._write_header()
+
+    def _write_header(self) -> None:
+        self._file.seek(0)
+        self._file.write(
+            struct.pack(
+                "<4sI4s4sIHHIIHH4sI",
+                b"RIFF",
+                36 + self._data_bytes,
+                b"WAVE",
+                b"fmt ",
+                16,
+                1,  # PCM
+                1,  # mono
+                self.sample_rate,
+                self.sample_rate * 2,
+                2,
+                16,
+                b"data",
+                self._data_bytes,
+            )
+        )
+
+    def _write(self, samples: torch.Tensor) -> None:
+        data = to_pcm16(samples)
+        self._file.seek(44 + self._data_bytes)
+        self._file.write(data)
+        self._data_bytes += len(data)
+        self._write_header()
+        self._file.flush()
+
+    def _close(self) -> None:
+        self._file.close()
+
+
+class FlacSink(AudioSink):
+    """16-bit mono FLAC file, encoded as it is written. Needs the ``soundfile`` package."""
+
+    def __init__(self, path: str, sample_rate: int, gap_ms: float = 0, crossfade_ms: float = 0):
+        super().__init__(sample_rate, gap_ms, crossfade_ms)
+        import soundfile
+
+        self.path = path
+        self._file = soundfile.SoundFile(
+            path, "w", samplerate=sample_rate, channels=1, format="FLAC", subtype="PCM_16"
+        )
+
+    def _write(self, samples: torch.Tensor) -> None:
+        self._file.write(samples.clamp(-1, 1).numpy())
+        self._file.flush()
+
+    def _close(self) -> None:
+        self._file.close()
+
+
+def open_sink(path: str, sample_rate: int, gap_ms: float = 0, crossfade_ms: float = 0) -> AudioSink:
+    """A ``WavSink`` or ``FlacSink`` for ``path``, by its extension."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".wav":
+        return WavSink(path, sample_rate, gap_ms, crossfade_ms)
+    if extension == ".flac":
+        return FlacSink(path, sample_rate, gap_ms, crossfade_ms)
+    raise ValueError(f"Unsupported output format {extension!r}, expected .wav or .flac")
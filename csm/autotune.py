@@ -0,0 +1,360 @@
+"""
+Pick the device, dtype and CPU thread count to run the model with, by timing ``Model.generate_frame`` on
+this machine, and remember the choice per machine.
+
+bfloat16 is the checkpoint dtype and the fastest on recent GPUs, but on many x86 CPUs without native
+bf16 matmuls it is emulated and several times slower than float32. float16 is not a candidate: the
+checkpoint was trained in bfloat16 and its range is not guaranteed to fit float16's, and only speed is
+measured here, not output quality. Another dtype replaces bfloat16 only when it is at least
+``DTYPE_MARGIN`` faster, so timing noise cannot move a machine off the checkpoint dtype. The default intra-op thread count
+(one per logical core) can also be slower than one per physical core. So every candidate is measured:
+each available device (the CPU is skipped when CUDA is present), each dtype it supports and, on CPU,
+a few thread counts. A dtype whose full-size weights would not fit in the memory available on the device
+(RAM for the CPU and MPS, free VRAM for CUDA) is skipped before it is measured, since the probe model is
+too small to run out; the reason is kept with the result.
+
+Frames are timed on a probe model with the 1B architecture and random weights, with the backbone cut
+to ``PROBE_BACKBONE_LAYERS`` layers to keep the probe light; the decoder and the heads are full size.
+The result is cached in ``~/.cache/csm/autotune.json`` under a fingerprint of the CPU, the accelerators
+and the torch version, so later startups read it instead of measuring.
+
+    python autotune.py          # measure once and cache the result
+    python autotune.py --force  # measure again and print every candidate
+
+    tuned = autotune()          # measures when nothing is cached
+    tuned = cached_or_default() # never measures: the cached result, or the checkpoint dtype untuned
+    tuned.apply()               # sets the CPU thread count
+    generator = load_generator(device=tuned.device, dtype=tuned.torch_dtype)
+"""
+
+import argparse
+import ctypes
+import hashlib
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from dataclasses import asdict, dataclass, field, replace
+from typing import Dict, List, Optional
+
+import torch
+from models import CSM_1B_ARGS, Model, init_rope_buffers
+
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "csm", "autotune.json")
+PROBE_BACKBONE_LAYERS = 2
+PROMPT_LEN = 64
+# Mimi, the KV caches and activations on top of the model weights.
+RUNTIME_OVERHEAD_BYTES = 2**30
+# How much faster than the checkpoint dtype another dtype must be to be picked over it.
+DTYPE_MARGIN = 0.15
+CHECKPOINT_DTYPE = "bfloat16"
+
+_DTYPES = {"float32": torch.float32, "bfloat16": torch.bfloat16}
+
+
+@dataclass
+class TuneResult:
+    device: str
+    dtype: str
+    # None leaves torch's default; only tuned on CPU.
+    num_threads: Optional[int]
+    frame_ms: float
+    # Candidates left out before timing, with the reason, e.g. "cpu float32: needs 7.6 GB, 5.1 GB available".
+    skipped: List[str] = field(default_factory=list)
+
+    @property
+    def torch_dtype(self) -> torch.dtype:
+        return _DTYPES[self.dtype]
+
+    def apply(self) -> None:
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+
+    def __str__(self) -> str:
+        threads = f", {self.num_threads} threads" if self.num_threads is not None else ""
+        timing = "not measured" if self.frame_ms != self.frame_ms else f"{self.frame_ms:.1f} ms/probe frame"
+        return f"{self.device} {self.dtype}{threads} ({timing})"
+
+
+def machine_fingerprint() -> str:
+    """Hash of what the measurement depends on: CPU, core count, accelerators and the torch version."""
+    info = {
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "system": platform.system(),
+        "cpu_count": os.cpu_count(),
+        "cpu_capability": torch.backends.cpu.get_cpu_capability(),
+        "torch": torch.__version__,
+        "cuda": [torch.cuda.get_device_name(i) for i in range(torch.cuda.device_count())],
+        "mps": torch.backends.mps.is_available(),
+    }
+    return hashlib.blake2b(json.dumps(info, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+def candidate_devices() -> List[str]:
+    if torch.cuda.is_available():
+        return ["cuda"]
+    devices = ["mps"] if torch.backends.mps.is_available() else []
+    return devices + ["cpu"]
+
+
+def candidate_dtypes(device: str) -> List[str]:
+    if device == "cuda" and not torch.cuda.is_bf16_supported():
+        return ["float32"]
+    # bfloat16 on an MPS build without it fails in _probe_model and is left out there.
+    return ["bfloat16", "float32"]
+
+
+def candidate_threads() -> List[int]:
+    logical = os.cpu_count() or 1
+    # Without SMT information, half the logical cores stands in for the physical ones.
+    return sorted({logical, max(1, logical // 2), torch.get_num_threads()}, reverse=True)
+
+
+def model_bytes(dtype: str) -> int:
+    """Bytes the full 1B model's weights take in ``dtype``."""
+    with torch.device("meta"):
+        params = sum(param.numel() for param in Model(CSM_1B_ARGS).parameters())
+    return params * _DTYPES[dtype].itemsize
+
+
+def _system_available_bytes() -> Optional[int]:
+    try:
+        import psutil
+
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    if sys.platform == "win32":
+
+        class MemoryStatusEx(ctypes.Structure):
+            _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong)] + [
+                (name, ctypes.c_ulonglong)
+                for name in (
+                    "ullTotalPhys",
+                    "ullAvailPhys",
+                    "ullTotalPageFile",
+                    "ullAvailPageFile",
+                    "ullTotalVirtual",
+                    "ullAvailVirtual",
+                    "ullAvailExtendedVirtual",
+                )
+            ]
+
+        status = MemoryStatusEx()
+        status.dwLength = ctypes.sizeof(MemoryStatusEx)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+        return None
+    try:
+        with open("/proc/meminfo", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def available_bytes(device: str) -> Optional[int]:
+    """Memory free for the model on ``device``: free VRAM on CUDA, otherwise RAM. None when unknown."""
+    if device == "cuda":
+        return torch.cuda.mem_get_info()[0]
+    # MPS shares the system memory.
+    return _system_available_bytes()
+
+
+def _probe_model(device: str, dtype: torch.dtype) -> Model:
+    # Only text token 0 is ever embedded, so the 128k-row text embedding is shrunk away.
+    config = replace(CSM_1B_ARGS, text_vocab_size=16)
+    with torch.device("meta"):
+        model = Model(config).to(dtype=dtype)
+    del model.backbone.layers[PROBE_BACKBONE_LAYERS:]
+    model = model.to_empty(device=device)
+    with torch.no_grad():
+        for param in model.parameters():
+            param.normal_(0, 0.02)
+    init_rope_buffers(model, device, dtype)
+    model.setup_caches(1)
+    return model
+
+
+def _sync(device: str) -> None:
+    if device == "cuda":
+        torch.cuda.synchronize()
+    elif device == "mps":
+        torch.mps.synchronize()
+
+
+@torch.inference_mode()
+def time_frame(model: Model, device: str, frames: int = 10, warmup: int = 2) -> float:
+    """Median ms of one ``generate_frame`` step after a ``PROMPT_LEN`` prompt."""
+    model.reset_caches()
+    tokens = torch.zeros(1, PROMPT_LEN, 33, dtype=torch.long, device=device)
+    tokens_mask = torch.ones(1, PROMPT_LEN, 33, dtype=torch.bool, device=device)
+    input_pos = torch.arange(PROMPT_LEN, device=device).unsqueeze(0)
+    sample = model.generate_frame(tokens, tokens_mask, input_pos, 0.9, 50)
+
+    frame_tokens = torch.zeros(1, 1, 33, dtype=torch.long, device=device)
+    frame_mask = torch.ones(1, 1, 33, dtype=torch.bool, device=device)
+    frame_mask[..., -1] = False
+    frame_pos = torch.full((1, 1), PROMPT_LEN, device=device)
+    times = []
+    for i in range(warmup + frames):
+        frame_tokens[0, 0, :-1] = sample[0]
+        _sync(device)
+        start = time.perf_counter()
+        model.generate_frame(frame_tokens, frame_mask, frame_pos, 0.9, 50, out=sample)
+        _sync(device)
+        if i >= warmup:
+            times.append((time.perf_counter() - start) * 1000)
+        frame_pos.add_(1)
+    return statistics.median(times)
+
+
+def measure(devices: Optional[List[str]] = None, verbose: bool = True) -> List[TuneResult]:
+    """
+    Time every candidate configuration. Candidates that would not fit in memory, or fail (unsupported
+    dtype), are left out; the ones that would not fit are listed in each result's ``skipped``.
+    """
+    default_threads = torch.get_num_threads()
+    results = []
+    skipped = []
+    try:
+        for device in devices or candidate_devices():
+            dtypes = candidate_dtypes(device)
+            available = available_bytes(device)
+            if available is not None:
+                needed = {dtype: model_bytes(dtype) + RUNTIME_OVERHEAD_BYTES for dtype in dtypes}
+                fitting = [dtype for dtype in dtypes if needed[dtype] <= available]
+                # When nothing fits, the smallest dtype is still timed rather than leaving the device out.
+                fitting = fitting or [min(dtypes, key=needed.get)]
+                for dtype in dtypes:
+                    if dtype not in fitting:
+                        skipped.append(
+                            f"{device} {dtype}: needs {needed[dtype] / 1e9:.1f} GB, {available / 1e9:.1f} GB available"
+                        )
+                        if verbose:
+                            print(f"  {skipped[-1]}")
+                dtypes = fitting
+            for dtype in dtypes:
+                try:
+                    model = _probe_model(device, _DTYPES[dtype])
+                except Exception as e:  # noqa: BLE001 - e.g. bfloat16 on an older MPS
+                    if verbose:
+                        print(f"  {device} {dtype}: unsupported ({type(e).__name__})")
+                    continue
+                for threads in candidate_threads() if device == "cpu" else [None]:
+                    if threads is not None:
+                        torch.set_num_threads(threads)
+                    try:
+                        result = TuneResult(device, dtype, threads, time_frame(model, device))
+                    except Exception as e:  # noqa: BLE001
+                        if verbose:
+                            print(f"  {device} {dtype}: failed ({type(e).__name__}: {e})")
+                        break
+                    if verbose:
+                        print(f"  {result}")
+                    results.append(result)
+                del model
+    finally:
+        torch.set_num_threads(default_threads)
+    for result in results:
+        result.skipped = list(skipped)
+    return results
+
+
+def pick(results: List[TuneResult]) -> TuneResult:
+    """
+    The fastest result, except that the fastest ``CHECKPOINT_DTYPE`` result on the same device is kept
+    unless the fastest is at least ``DTYPE_MARGIN`` faster than it.
+    """
+    best = min(results, key=lambda r: r.frame_ms)
+    checkpoint = [r for r in results if r.device == best.device and r.dtype == CHECKPOINT_DTYPE]
+    if checkpoint:
+        fastest_checkpoint = min(checkpoint, key=lambda r: r.frame_ms)
+        if best.frame_ms > (1 - DTYPE_MARGIN) * fastest_checkpoint.frame_ms:
+            return fastest_checkpoint
+    return best
+
+
+def _read_cache(cache_path: str) -> Dict[str, dict]:
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _cached_result(cache_path: str, fingerprint: str) -> Optional[TuneResult]:
+    entry = _read_cache(cache_path).get(fingerprint)
+    # Results cached while float16 was still a candidate are treated as missing.
+    if entry is None or entry.get("dtype") not in _DTYPES:
+        return None
+    return TuneResult(**entry)
+
+
+def autotune(cache_path: str = CACHE_PATH, force: bool = False, verbose: bool = True) -> TuneResult:
+    """
+    The fastest configuration for this machine: from ``cache_path`` when measured before (unless
+    ``force``), otherwise measured now and stored there.
+    """
+    fingerprint = machine_fingerprint()
+    result = None if force else _cached_result(cache_path, fingerprint)
+    if result is not None:
+        if verbose:
+            print(f"Autotune: {result} (cached)")
+            for reason in result.skipped:
+                print(f"  skipped {reason}")
+        return result
+
+    if verbose:
+        print("Autotune: timing candidate configurations, once per machine...")
+    results = measure(verbose=verbose)
+    if not results:
+        raise RuntimeError("Autotune: no configuration could run")
+    best = pick(results)
+    if verbose:
+        print(f"Autotune: {best}")
+
+    cache = _read_cache(cache_path)
+    cache[fingerprint] = asdict(best)
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    partial_path = cache_path + ".partial"
+    with open(partial_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f, indent=2)
+    os.replace(partial_path, cache_path)
+    return best
+
+
+def cached_or_default(cache_path: str = CACHE_PATH, verbose: bool = True) -> TuneResult:
+    """
+    The cached result for this machine, or the first candidate device with the checkpoint dtype and
+    torch's default threads. Never measures, so it is cheap enough to call at import time.
+    """
+    result = _cached_result(cache_path, machine_fingerprint())
+    if result is not None:
+        if verbose:
+            print(f"Autotune: {result} (cached)")
+        return result
+
+    device = candidate_devices()[0]
+    dtype = CHECKPOINT_DTYPE if CHECKPOINT_DTYPE in candidate_dtypes(device) else "float32"
+    result = TuneResult(device, dtype, None, float("nan"))
+    if verbose:
+        print(f"Autotune: {result}; run python autotune.py to measure this machine")
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure and cache the fastest device/dtype/thread setup.")
+    parser.add_argument("--force", action="store_true", help="measure again even if a result is cached")
+    parser.add_argument("--cache", type=str, default=CACHE_PATH)
+    args = parser.parse_args()
+    autotune(args.cache, force=args.force)
+
+
+if __name__ == "__main__":
+    main()
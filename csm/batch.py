@@ -0,0 +1,179 @@
+"""
+Synthesize every job in a JSONL or CSV job file with one warm generator.
+
+    python batch.py jobs.jsonl --output-dir out
+
+Each job is one line / row with these fields (only ``text`` and ``output`` are required):
+
+    text                  text to speak, of any length (long texts are generated sentence chunk by chunk)
+    output                output .wav or .flac path, relative to --output-dir
+    voice                 a voice from the voice pack or sounds/ (see voice_pack.py), or
+    voice_audio           path of a reference clip, with voice_text as its transcript
+    speaker               speaker id, default 0
+    temperature, topk     sampling parameters, default 0.9 and 50
+    max_audio_length_ms   longest audio per chunk, default 20000
+
+    {"text": "Chapter one.", "voice": "3-news_woman", "output": "ch01.wav"}
+
+Jobs sharing a voice run back to back, so the voice is loaded and prefilled once. Jobs whose output
+already exists are skipped, so an interrupted run can simply be restarted. Every job appends a line to
+the manifest (``<job file>.manifest.jsonl`` by default) with its status, audio duration, wall time and
+real-time factor.
+"""
+
+import argparse
+import csv
+import json
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import torch
+import torchaudio
+from audio_io import load_audio
+from generator import Generator, Segment, load_generator
+from longform import generate_long
+from voice_pack import SOUNDS_DIR, VoicePack, load_voice_pack
+
+_NUMERIC_FIELDS = {"speaker": int, "topk": int, "temperature": float, "max_audio_length_ms": float}
+# Formats torchaudio writes from the extension, through soundfile or sox alike.
+OUTPUT_EXTENSIONS = (".wav", ".flac")
+
+
+def read_jobs(path: str) -> List[dict]:
+    """Jobs from a ``.jsonl`` or ``.csv`` file, with numeric fields converted and blank fields dropped."""
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    jobs = []
+    for line_number, row in enumerate(rows, 1):
+        job = {key: value for key, value in row.items() if value not in (None, "")}
+        for key, convert in _NUMERIC_FIELDS.items():
+            if key in job:
+                job[key] = convert(job[key])
+        if "text" not in job or "output" not in job:
+            raise ValueError(f"{path}: job {line_number} needs 'text' and 'output'")
+        if os.path.splitext(job["output"])[1].lower() not in OUTPUT_EXTENSIONS:
+            raise ValueError(f"{path}: job {line_number} output must end in .wav or .flac")
+        job["id"] = line_number
+        jobs.append(job)
+    return jobs
+
+
+def voice_key(job: dict) -> str:
+    return job.get("voice") or job.get("voice_audio") or ""
+
+
+class VoiceLoader:
+    """Context segments per (voice, speaker), built once and reused across jobs."""
+
+    def __init__(self, generator: Generator, voice_pack: Optional[VoicePack], base_dir: str):
+        self._generator = generator
+        self._voice_pack = voice_pack
+        self._base_dir = base_dir
+        self._segments: Dict[Tuple[str, int], List[Segment]] = {}
+
+    def context(self, job: dict) -> List[Segment]:
+        key = (voice_key(job), job.get("speaker", 0))
+        if key not in self._segments:
+            self._segments[key] = self._load(job, key[1])
+        return self._segments[key]
+
+    def _load(self, job: dict, speaker: int) -> List[Segment]:
+        if "voice" in job:
+            name = job["voice"]
+            if self._voice_pack is not None and name in self._voice_pack:
+                return [self._voice_pack.segment(name, speaker)]
+            audio_path = os.path.join(SOUNDS_DIR, name + ".wav")
+            with open(os.path.join(SOUNDS_DIR, name + ".txt"), encoding="utf-8") as f:
+                text = f.read().strip()
+        elif "voice_audio" in job:
+            audio_path = os.path.join(self._base_dir, job["voice_audio"])
+            text = job.get("voice_text", "")
+            codes = self._voice_pack.codes_for_file(audio_path) if self._voice_pack is not None else None
+            if codes is not None:
+                return [Segment(speaker=speaker, text=text, audio=None, codes=codes)]
+        else:
+            return []
+        return [Segment(speaker=speaker, text=text, audio=load_audio(audio_path, self._generator.sample_rate))]
+
+
+def run_jobs(generator: Generator, jobs: List[dict], output_dir: str, manifest_path: str, base_dir: str) -> None:
+    voices = VoiceLoader(generator, load_voice_pack(), base_dir)
+    # Stable sort: jobs keep their file order within a voice.
+    jobs = sorted(jobs, key=voice_key)
+
+    with open(manifest_path, "a", encoding="utf-8") as manifest:
+        for n, job in enumerate(jobs, 1):
+            output_path = os.path.join(output_dir, job["output"])
+            record = {"id": job["id"], "output": output_path, "voice": voice_key(job)}
+            if os.path.exists(output_path):
+                record["status"] = "skipped"
+            else:
+                print(f"[{n}/{len(jobs)}] {job['output']}: {job['text'][:60]}")
+                start = time.perf_counter()
+                try:
+                    audio = generate_long(
+                        generator,
+                        text=job["text"],
+                        speaker=job.get("speaker", 0),
+                        context=voices.context(job),
+                        max_chunk_audio_ms=job.get("max_audio_length_ms", 20_000),
+                        temperature=job.get("temperature", 0.9),
+                        topk=job.get("topk", 50),
+                        # Jobs are sorted by voice, so one snapshot serves a whole voice group; the next
+                        # group's different context tokens replace it instead of adding another.
+                        prefix_cache="batch-voice" if voice_key(job) else None,
+                    )
+                    _save_atomic(output_path, audio, generator.sample_rate)
+                except Exception as e:  # noqa: BLE001 - recorded in the manifest, the batch goes on
+                    record.update(status="error", error=f"{type(e).__name__}: {e}")
+                    print(f"  failed: {record['error']}")
+                else:
+                    wall_seconds = time.perf_counter() - start
+                    audio_seconds = audio.numel() / generator.sample_rate
+                    record.update(
+                        status="ok",
+                        audio_seconds=round(audio_seconds, 3),
+                        wall_seconds=round(wall_seconds, 3),
+                        real_time_factor=round(wall_seconds / audio_seconds, 3) if audio_seconds else None,
+                    )
+            manifest.write(json.dumps(record) + "\n")
+            manifest.flush()
+
+
+def _save_atomic(path: str, audio: torch.Tensor, sample_rate: int) -> None:
+    # Written under a temporary name first, so an interrupted job never leaves a file that looks finished.
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # The real extension is kept last, since torchaudio picks the format from it.
+    root, extension = os.path.splitext(path)
+    partial_path = root + ".partial" + extension
+    torchaudio.save(partial_path, audio.unsqueeze(0).cpu(), sample_rate)
+    os.replace(partial_path, path)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Synthesize every job in a JSONL or CSV job file.")
+    parser.add_argument("jobs", type=str, help="job file (.jsonl or .csv)")
+    parser.add_argument("--output-dir", type=str, default=None, help="default: the job file's directory")
+    parser.add_argument("--manifest", type=str, default=None, help="default: <jobs>.manifest.jsonl")
+    parser.add_argument("--checkpoint", type=str, default=None)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--quantize", type=str, choices=["int8", "int4"], default=None)
+    args = parser.parse_args()
+
+    jobs = read_jobs(args.jobs)
+    base_dir = os.path.dirname(os.path.abspath(args.jobs))
+    output_dir = args.output_dir or base_dir
+    manifest_path = args.manifest or os.path.splitext(args.jobs)[0] + ".manifest.jsonl"
+
+    generator = load_generator(args.checkpoint, device=args.device, quantize=args.quantize)
+    run_jobs(generator, jobs, output_dir, manifest_path, base_dir)
+    print(f"Manifest written to {manifest_path}")
+
+
+if __name__ == "__main__":
+    main()
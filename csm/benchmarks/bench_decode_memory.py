@@ -0,0 +1,155 @@
+"""
+Peak memory and agreement of the one-shot and chunked Mimi decode paths (Generator._decode) as the
+clip length grows. Needs the real Mimi (downloaded from the Hugging Face Hub).
+
+Every case runs in a fresh process so its peak memory (CUDA allocator peak, or max RSS on CPU) is its own.
+Exits with an error when the chunked audio differs from the one-shot audio by more than --tolerance.
+
+With --watermark (needs silentcipher), each case also watermarks its audio, in one piece or block by block
+as Generator._submit_watermark does for long clips, and the peak memory and comparison cover both steps.
+
+    python benchmarks/bench_decode_memory.py --device cpu --seconds 10 30 90 --chunk-frames 250
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generator import Generator, load_mimi  # noqa: E402
+from watermarking import CSM_1B_GH_WATERMARK, WatermarkStage, load_watermarker  # noqa: E402
+
+FRAMES_PER_SECOND = 12.5
+
+
+def _codes(seconds: float, device: str) -> torch.Tensor:
+    generator = torch.Generator().manual_seed(0)
+    return torch.randint(0, 2048, (1, 32, int(seconds * FRAMES_PER_SECOND)), generator=generator).to(device)
+
+
+def _decoder(device: str, chunk_frames: int, warmup_frames: int, watermark: bool):
+    # Generator._decode only needs the audio tokenizer, the device and the chunk and warm-up sizes;
+    # Generator._submit_watermark adds the watermark stage, the sample rate and the block margin.
+    mimi = load_mimi(device)
+    stage = None
+    if watermark:
+        stage = WatermarkStage(load_watermarker(device), mimi.sample_rate, CSM_1B_GH_WATERMARK, background=False)
+    return SimpleNamespace(
+        _audio_tokenizer=mimi,
+        _watermark_stage=stage,
+        sample_rate=mimi.sample_rate,
+        device=torch.device(device),
+        decode_chunk_frames=chunk_frames,
+        decode_warmup_frames=warmup_frames,
+        watermark_margin_ms=1000,
+    )
+
+
+def _peak_rss_mb() -> float:
+    if resource is not None:
+        # ru_maxrss is in KiB on Linux and in bytes on macOS.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == "darwin" else 1024)
+    try:
+        import psutil
+    except ImportError:
+        return float("nan")
+    return psutil.Process().memory_info().peak_wset / 2**20
+
+
+@torch.inference_mode()
+def run_case(
+    device: str, seconds: float, chunk_frames: int, warmup_frames: int, watermark: bool, audio_path: str
+) -> dict:
+    decoder = _decoder(device, chunk_frames, warmup_frames, watermark)
+    codes = _codes(seconds, device)
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    audio = Generator._decode(decoder, codes)
+    if watermark:
+        audio = Generator._submit_watermark(decoder, audio).result()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+        peak_mb = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        peak_mb = _peak_rss_mb()
+    decode_ms = (time.perf_counter() - start) * 1000
+    torch.save(audio.cpu(), audio_path)
+    return {"chunk_frames": chunk_frames, "decode_ms": decode_ms, "peak_mb": peak_mb}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--seconds", type=float, nargs="+", default=[10, 30, 90])
+    parser.add_argument("--chunk-frames", type=int, default=250)
+    parser.add_argument("--warmup-frames", type=int, default=150)
+    parser.add_argument("--watermark", action="store_true", help="also watermark, in one piece or block by block")
+    parser.add_argument("--tolerance", type=float, default=1e-4, help="max allowed |one-shot - chunked|")
+    parser.add_argument("--output", type=str, default="")
+    parser.add_argument("--case", type=str, default="", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        seconds, chunk_frames, warmup_frames, watermark, audio_path = args.case.split(",", 4)
+        result = run_case(
+            args.device, float(seconds), int(chunk_frames), int(warmup_frames), watermark == "1", audio_path
+        )
+        print(json.dumps(result))
+        return
+
+    results = []
+    for seconds in args.seconds:
+        cases, audio = {}, {}
+        # A chunk size past the clip length decodes it in one call.
+        for name, chunk_frames in (("one_shot", sys.maxsize), ("chunked", args.chunk_frames)):
+            with tempfile.TemporaryDirectory() as tmp:
+                audio_path = os.path.join(tmp, "audio.pt")
+                case = f"{seconds},{chunk_frames},{args.warmup_frames},{int(args.watermark)},{audio_path}"
+                out = subprocess.run(
+                    [sys.executable, __file__, "--device", args.device, "--case", case],
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                ).stdout
+                cases[name] = json.loads(out.strip().splitlines()[-1])
+                audio[name] = torch.load(audio_path, weights_only=True)
+
+        result = {
+            "seconds": seconds,
+            "one_shot": cases["one_shot"],
+            "chunked": cases["chunked"],
+            "max_abs_diff": (audio["one_shot"] - audio["chunked"]).abs().max().item(),
+        }
+        results.append(result)
+        print(
+            f"{seconds:.0f} s: "
+            + ", ".join(f"{name} {c['peak_mb']:.0f} MB / {c['decode_ms']:.0f} ms" for name, c in cases.items())
+            + f", max |diff| {result['max_abs_diff']:.2e}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    worst = max(result["max_abs_diff"] for result in results)
+    if worst > args.tolerance:
+        sys.exit(f"chunked decode differs from one-shot by {worst:.2e}, above --tolerance {args.tolerance:.0e}")
+
+
+if __name__ == "__main__":
+    main()
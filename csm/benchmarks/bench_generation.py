@@ -0,0 +1,327 @@
+"""
+Benchmark suite for the generation hot path, written to JSON so runs from two commits can be compared
+with benchmarks/compare.py.
+
+By default the model is the tiny random-weight flavor and the Llama tokenizer, Mimi and the watermarker
+are replaced by offline stubs, so the suite runs without network access or weights. Use --config 1b for
+the full-size architecture, --checkpoint for real weights and --real-codecs for the real Mimi and
+watermarker (downloaded from the Hugging Face Hub).
+
+    python benchmarks/bench_generation.py --device cpu --output before.json
+    python benchmarks/bench_generation.py --device cpu --output after.json
+    python benchmarks/compare.py before.json after.json
+
+Measurements:
+    prefill_ms          backbone prefill latency per prompt length
+    frame               per-frame latency, split into the backbone step, the 31 decoder steps and the rest
+                        (codebook heads, sampling, embeddings)
+    sample_topk_us      cost of one sample_topk call on (1, audio_vocab_size) logits
+    mimi_decode_ms      decoding one second of codes
+    watermark_ms        watermarking one second of audio (with the stub: the resampling around it)
+    end_to_end          Generator.generate wall time and real-time factor
+    stream              Generator.generate_stream time to first audio and wall time, and how many samples are
+                        watermarked per sample streamed (windows overlap; 1.0 would be one pass)
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generator import Generator, load_llama3_tokenizer, load_mimi  # noqa: E402
+from models import CSM_1B_ARGS, TINY_ARGS, Model, load_model_from_checkpoint, random_model  # noqa: E402
+from sampling import sample_topk  # noqa: E402
+from watermarking import load_watermarker  # noqa: E402
+
+CONFIGS = {"tiny": TINY_ARGS, "1b": CSM_1B_ARGS}
+FRAME_MS = 80
+
+
+class ByteTokenizer:
+    """Offline stand-in for the Llama tokenizer: one token per UTF-8 byte between BOS and EOS."""
+
+    bos_token_id = 128000
+    eos_token_id = 128001
+
+    def encode(self, text: str) -> List[int]:
+        return [self.bos_token_id] + list(text.encode("utf-8")) + [self.eos_token_id]
+
+
+class StubMimi:
+    """Offline stand-in for Mimi with the same shapes: 1920 samples per frame of 32 codes."""
+
+    sample_rate = 24_000
+    frame_size = 1920
+
+    def encode(self, audio: torch.Tensor) -> torch.Tensor:
+        num_frames = audio.size(-1) // self.frame_size
+        return torch.zeros(audio.size(0), 32, num_frames, dtype=torch.long, device=audio.device)
+
+    def decode(self, codes: torch.Tensor) -> torch.Tensor:
+        frames = codes.float().mean(dim=1, keepdim=True) / 2048
+        return torch.repeat_interleave(frames, self.frame_size, dim=-1)
+
+    def streaming(self, batch_size: int):
+        return contextlib.nullcontext()
+
+
+class StubWatermarker:
+    def encode_wav(self, audio: torch.Tensor, sample_rate: int, key: List[int], **kwargs):
+        return audio, None
+
+
+def _sync(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def _time_ms(fn: Callable[[], object], device: torch.device, iters: int, warmup: int = 2) -> Dict[str, float]:
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(iters):
+        _sync(device)
+        start = time.perf_counter()
+        fn()
+        _sync(device)
+        times.append((time.perf_counter() - start) * 1000)
+    return {"median": statistics.median(times), "min": min(times), "max": max(times)}
+
+
+class _ModuleTimer:
+    """Accumulates wall time spent inside a module's forward, via pre/post hooks."""
+
+    def __init__(self, module: torch.nn.Module, device: torch.device):
+        self.total_ms = 0.0
+        self._device = device
+        self._start = 0.0
+        self._handles = [module.register_forward_pre_hook(self._pre), module.register_forward_hook(self._post)]
+
+    def _pre(self, module, args) -> None:
+        _sync(self._device)
+        self._start = time.perf_counter()
+
+    def _post(self, module, args, output) -> None:
+        _sync(self._device)
+        self.total_ms += (time.perf_counter() - self._start) * 1000
+
+    def remove(self) -> None:
+        for handle in self._handles:
+            handle.remove()
+
+
+def _prompt(model: Model, length: int, device: torch.device):
+    tokens = torch.randint(0, model.config.audio_vocab_size - 3, (1, length, 33), device=device)
+    tokens_mask = torch.ones(1, length, 33, dtype=torch.bool, device=device)
+    input_pos = torch.arange(0, length, device=device).unsqueeze(0)
+    return tokens, tokens_mask, input_pos
+
+
+@torch.inference_mode()
+def bench_prefill(model: Model, device: torch.device, lengths: List[int], iters: int) -> Dict[str, dict]:
+    results = {}
+    for length in lengths:
+        tokens, tokens_mask, input_pos = _prompt(model, length, device)
+
+        def run():
+            model.reset_caches()
+            model.prefill(tokens, tokens_mask, input_pos)
+
+        results[str(length)] = _time_ms(run, device, iters)
+    return results
+
+
+@torch.inference_mode()
+def bench_frame(model: Model, device: torch.device, prompt_len: int, frames: int) -> Dict[str, float]:
+    model.reset_caches()
+    tokens, tokens_mask, input_pos = _prompt(model, prompt_len, device)
+    sample = model.generate_frame(tokens, tokens_mask, input_pos, 0.9, 50)
+
+    frame_tokens = torch.zeros(1, 1, 33, dtype=torch.long, device=device)
+    frame_mask = torch.ones(1, 1, 33, dtype=torch.bool, device=device)
+    frame_mask[..., -1] = False
+    frame_pos = torch.full((1, 1), prompt_len, device=device)
+
+    def step():
+        frame_tokens[0, 0, :-1] = sample[0]
+        model.generate_frame(frame_tokens, frame_mask, frame_pos, 0.9, 50, out=sample)
+        frame_pos.add_(1)
+
+    for _ in range(2):
+        step()
+    backbone = _ModuleTimer(model.backbone, device)
+    decoder = _ModuleTimer(model.decoder, device)
+    try:
+        total = _time_ms(step, device, frames, warmup=0)
+    finally:
+        backbone.remove()
+        decoder.remove()
+
+    # The hooks synchronize, so the median is a little pessimistic on GPU; the split is what matters.
+    return {
+        "total_ms": total["median"],
+        "backbone_ms": backbone.total_ms / frames,
+        "decoder_ms": decoder.total_ms / frames,
+        "other_ms": max(0.0, total["median"] - (backbone.total_ms + decoder.total_ms) / frames),
+    }
+
+
+@torch.inference_mode()
+def bench_sample_topk(model: Model, device: torch.device, iters: int) -> float:
+    dtype = next(model.parameters()).dtype
+    logits = torch.randn(1, model.config.audio_vocab_size, device=device, dtype=dtype)
+    return _time_ms(lambda: sample_topk(logits, 50, 0.9), device, iters)["median"] * 1000
+
+
+@torch.inference_mode()
+def bench_mimi_decode(generator: Generator, iters: int) -> float:
+    codes = torch.randint(0, 2048, (1, 32, 1000 // FRAME_MS), device=generator.device)
+    return _time_ms(lambda: generator._audio_tokenizer.decode(codes), generator.device, iters)["median"]
+
+
+def bench_watermark(generator: Generator, iters: int) -> float:
+    audio = torch.randn(generator.sample_rate, device=generator.device) * 0.1
+    return _time_ms(lambda: generator._watermark(audio), generator.device, iters)["median"]
+
+
+def bench_end_to_end(generator: Generator, text: str, max_audio_length_ms: float, iters: int) -> Dict[str, float]:
+    results = []
+    for i in range(iters + 1):
+        torch.manual_seed(i)
+        _sync(generator.device)
+        start = time.perf_counter()
+        audio = generator.generate(text, 0, [], max_audio_length_ms=max_audio_length_ms)
+        _sync(generator.device)
+        elapsed = time.perf_counter() - start
+        if i > 0:  # the first run is warmup
+            results.append((elapsed, audio.numel() / generator.sample_rate))
+    elapsed = statistics.median(r[0] for r in results)
+    audio_seconds = statistics.median(r[1] for r in results)
+    return {
+        "wall_ms": elapsed * 1000,
+        "audio_seconds": audio_seconds,
+        "real_time_factor": elapsed / audio_seconds if audio_seconds else float("nan"),
+    }
+
+
+def bench_stream(generator: Generator, text: str, max_audio_length_ms: float, iters: int) -> Dict[str, float]:
+    stage = generator._watermark_stage
+    apply = stage._apply
+    watermarked = [0]
+
+    def counting_apply(audio: torch.Tensor) -> torch.Tensor:
+        watermarked[0] += audio.numel()
+        return apply(audio)
+
+    stage._apply = counting_apply
+    results = []
+    try:
+        for i in range(iters + 1):
+            torch.manual_seed(i)
+            watermarked[0] = 0
+            streamed = 0
+            first_ms = float("nan")
+            _sync(generator.device)
+            start = time.perf_counter()
+            for chunk in generator.generate_stream(text, 0, [], max_audio_length_ms=max_audio_length_ms):
+                if streamed == 0:
+                    first_ms = (time.perf_counter() - start) * 1000
+                streamed += chunk.numel()
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if i > 0:  # the first run is warmup
+                results.append((first_ms, elapsed_ms, watermarked[0] / streamed if streamed else float("nan")))
+    finally:
+        del stage._apply
+    return {
+        "time_to_first_audio_ms": statistics.median(r[0] for r in results),
+        "wall_ms": statistics.median(r[1] for r in results),
+        "watermarked_per_streamed_sample": statistics.median(r[2] for r in results),
+    }
+
+
+def _git_commit() -> str:
+    try:
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=cwd, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", type=str, default="bfloat16")
+    parser.add_argument("--config", type=str, choices=sorted(CONFIGS), default="tiny")
+    parser.add_argument("--checkpoint", type=str, default="", help="real weights; implies --config 1b")
+    parser.add_argument("--real-codecs", action="store_true", help="use the real tokenizer, Mimi and watermarker")
+    parser.add_argument("--prefill-lengths", type=int, nargs="+", default=[16, 128, 512, 1024])
+    parser.add_argument("--prompt-len", type=int, default=200)
+    parser.add_argument("--frames", type=int, default=20)
+    parser.add_argument("--iters", type=int, default=5)
+    parser.add_argument("--text", type=str, default="The quick brown fox jumps over the lazy dog.")
+    parser.add_argument("--max-audio-length-ms", type=float, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    if args.checkpoint:
+        model = load_model_from_checkpoint(args.checkpoint, device=device, dtype=dtype)
+    else:
+        model = random_model(CONFIGS[args.config], device=device, dtype=dtype)
+
+    if args.real_codecs:
+        generator = Generator(
+            model,
+            text_tokenizer=load_llama3_tokenizer(),
+            audio_tokenizer=load_mimi(device),
+            watermarker=load_watermarker(device=device),
+        )
+    else:
+        generator = Generator(
+            model, text_tokenizer=ByteTokenizer(), audio_tokenizer=StubMimi(), watermarker=StubWatermarker()
+        )
+
+    results = {
+        "meta": {
+            "commit": _git_commit(),
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "device": str(device),
+            "dtype": args.dtype,
+            "config": "checkpoint" if args.checkpoint else args.config,
+            "codecs": "real" if args.real_codecs else "stub",
+            "threads": torch.get_num_threads(),
+        },
+        "prefill_ms": bench_prefill(model, device, args.prefill_lengths, args.iters),
+        "frame": bench_frame(model, device, args.prompt_len, args.frames),
+        "sample_topk_us": bench_sample_topk(model, device, args.iters * 100),
+        "mimi_decode_ms": bench_mimi_decode(generator, args.iters),
+        "watermark_ms": bench_watermark(generator, args.iters),
+        "end_to_end": bench_end_to_end(generator, args.text, args.max_audio_length_ms, args.iters),
+        "stream": bench_stream(generator, args.text, args.max_audio_length_ms, args.iters),
+    }
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Backbone KV cache memory of the dense per-row cache against the paged pool, on a mixed prompt-length
+workload run through BatchScheduler.
+
+The dense cache gives each of --max-batch-size rows max_seq_len positions. The paged pool holds
+--cache-tokens positions shared by all rows. The report has the bytes of each and the pool's peak use
+during the run. It also has how many average sessions of this workload fit in --budget-mb either way.
+Uses random weights and the offline stubs from bench_generation.py.
+
+    python benchmarks/bench_kv_cache.py --config tiny --max-batch-size 16 --cache-tokens 8192 --requests 48
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from typing import List
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_generation import CONFIGS, ByteTokenizer, StubMimi, StubWatermarker  # noqa: E402
+from generator import Generator  # noqa: E402
+from models import Model, random_model  # noqa: E402
+from scheduler import BatchScheduler, SynthesisRequest  # noqa: E402
+
+
+def _backbone_cache_bytes(model: Model) -> int:
+    total = 0
+    for layer in model.backbone.layers:
+        kv_cache = layer.attn.kv_cache
+        total += sum(t.element_size() * t.nelement() for t in (kv_cache.k_cache, kv_cache.v_cache))
+    return total
+
+
+def workload(requests: int, prompt_lengths: List[int], audio_ms: List[float], seed: int) -> List[SynthesisRequest]:
+    rng = random.Random(seed)
+    out = []
+    for _ in range(requests):
+        # ByteTokenizer: one token per byte, plus the speaker tag, BOS and EOS.
+        length = max(1, rng.choice(prompt_lengths) - 5)
+        text = "".join(rng.choice("abcdefghij ") for _ in range(length))
+        out.append(SynthesisRequest(text, 0, [], max_audio_length_ms=rng.choice(audio_ms)))
+    return out
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, choices=sorted(CONFIGS), default="tiny")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", type=str, default="bfloat16")
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--cache-tokens", type=int, default=8192)
+    parser.add_argument("--block-size", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=48)
+    parser.add_argument("--prompt-lengths", type=int, nargs="+", default=[64, 256, 768, 1536])
+    parser.add_argument("--audio-ms", type=float, nargs="+", default=[1000, 3000, 6000])
+    parser.add_argument("--budget-mb", type=float, default=4096, help="for the sessions-per-budget estimate")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="")
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    model = random_model(CONFIGS[args.config], device=args.device, dtype=getattr(torch, args.dtype))
+    generator = Generator(
+        model, text_tokenizer=ByteTokenizer(), audio_tokenizer=StubMimi(), watermarker=StubWatermarker()
+    )
+    max_seq_len = model.backbone.max_seq_len
+
+    model.setup_caches(args.max_batch_size)
+    dense_bytes = _backbone_cache_bytes(model)
+
+    requests = workload(args.requests, args.prompt_lengths, args.audio_ms, args.seed)
+    scheduler = BatchScheduler(
+        generator,
+        args.max_batch_size,
+        max_queue=len(requests),
+        cache_tokens=args.cache_tokens,
+        block_size=args.block_size,
+    )
+    start = time.perf_counter()
+    futures = [scheduler.submit(request) for request in requests]
+    peak_active = 0
+    while not all(future.done() for future in futures):
+        peak_active = max(peak_active, scheduler.active_requests)
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - start
+    audio_seconds = sum(future.result().numel() for future in futures) / StubMimi.sample_rate
+    pool = model.kv_pool
+    paged_bytes = _backbone_cache_bytes(model)
+    scheduler.close()
+
+    bytes_per_position = paged_bytes / (pool.num_blocks * pool.block_size)
+    # Positions an average session holds at its end: prompt plus generated frames.
+    mean_prompt = sum(args.prompt_lengths) / len(args.prompt_lengths)
+    mean_frames = sum(args.audio_ms) / len(args.audio_ms) / 80
+    budget = args.budget_mb * 2**20
+    results = {
+        "meta": {
+            "config": args.config,
+            "dtype": args.dtype,
+            "max_batch_size": args.max_batch_size,
+            "cache_tokens": args.cache_tokens,
+            "block_size": args.block_size,
+            "requests": args.requests,
+            "prompt_lengths": args.prompt_lengths,
+            "audio_ms": args.audio_ms,
+        },
+        "dense_cache_mb": dense_bytes / 2**20,
+        "paged_cache_mb": paged_bytes / 2**20,
+        "paged_peak_used_mb": pool.peak_blocks_in_use * pool.block_size * bytes_per_position / 2**20,
+        "peak_active_requests": peak_active,
+        "requests_per_sec": len(requests) / elapsed,
+        "audio_seconds_per_sec": audio_seconds / elapsed,
+        "sessions_in_budget": {
+            "dense": int(budget // (dense_bytes / args.max_batch_size)),
+            "paged": int(budget // ((mean_prompt + mean_frames) * bytes_per_position)),
+        },
+        "max_seq_len": max_seq_len,
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
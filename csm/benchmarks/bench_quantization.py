@@ -0,0 +1,141 @@
+"""
+Frames/sec and peak RSS of the model in bf16/fp32 versus weight-only int8 (and int4 on CUDA).
+
+Each configuration runs in its own subprocess so peak RSS is not shared between them. Without
+--checkpoint the full-size CSM-1B architecture is built with random weights, which is enough for
+speed and memory numbers.
+
+    python benchmarks/bench_quantization.py --device cpu --modes bf16 int8
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import torch
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import CSM_1B_ARGS, Model, load_model_from_checkpoint, random_model  # noqa: E402
+from quantization import quantize_model  # noqa: E402
+
+DTYPES = {"bf16": torch.bfloat16, "fp32": torch.float32}
+
+
+def _current_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:  # no procfs: macOS, Windows
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return float("nan")
+    return psutil.Process().memory_info().rss / 2**20
+
+
+def _peak_rss_mb() -> float:
+    if resource is not None:
+        # ru_maxrss is in KiB on Linux and in bytes on macOS.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == "darwin" else 1024)
+    try:
+        import psutil
+    except ImportError:
+        return float("nan")
+    return psutil.Process().memory_info().peak_wset / 2**20
+
+
+def _build(mode: str, device: str, checkpoint: str) -> Model:
+    dtype = torch.bfloat16 if mode in ("bf16", "int8", "int4") else DTYPES[mode]
+    if checkpoint:
+        model = load_model_from_checkpoint(checkpoint, device=device, dtype=dtype)
+    else:
+        model = random_model(CSM_1B_ARGS, device=device, dtype=dtype)
+    if mode in ("int8", "int4"):
+        quantize_model(model, mode)
+    return model
+
+
+@torch.inference_mode()
+def run_one(mode: str, device: str, checkpoint: str, prompt_len: int, frames: int) -> dict:
+    model = _build(mode, device, checkpoint)
+    model.setup_caches(1)
+    model.reset_caches()
+
+    tokens = torch.randint(0, 2000, (1, prompt_len, 33), device=device)
+    tokens_mask = torch.ones(1, prompt_len, 33, dtype=torch.bool, device=device)
+    input_pos = torch.arange(0, prompt_len, device=device).unsqueeze(0)
+    sample = model.generate_frame(tokens, tokens_mask, input_pos, 0.9, 50)
+
+    frame_tokens = torch.zeros(1, 1, 33, dtype=torch.long, device=device)
+    frame_mask = torch.ones(1, 1, 33, dtype=torch.bool, device=device)
+    frame_mask[..., -1] = False
+    frame_pos = torch.full((1, 1), prompt_len, device=device)
+    if device == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(frames):
+        frame_tokens[0, 0, :-1] = sample[0]
+        sample = model.generate_frame(frame_tokens, frame_mask, frame_pos, 0.9, 50)
+        frame_pos += 1
+    if device == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "mode": mode,
+        "device": device,
+        "frames_per_sec": frames / elapsed,
+        "real_time_factor": elapsed / (frames * 0.08),
+        # Steady-state RSS after setup; the peak also covers the bf16 weights quantization started from.
+        "rss_mb": _current_rss_mb(),
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--modes", type=str, nargs="+", default=["bf16", "int8"])
+    parser.add_argument("--checkpoint", type=str, default="")
+    parser.add_argument("--prompt-len", type=int, default=200)
+    parser.add_argument("--frames", type=int, default=20)
+    parser.add_argument("--output", type=str, default="")
+    parser.add_argument("--single", type=str, default="", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        result = run_one(args.single, args.device, args.checkpoint, args.prompt_len, args.frames)
+        print(json.dumps(result))
+        return
+
+    results = []
+    for mode in args.modes:
+        cmd = [sys.executable, os.path.abspath(__file__), "--single", mode, "--device", args.device]
+        cmd += ["--checkpoint", args.checkpoint, "--prompt-len", str(args.prompt_len), "--frames", str(args.frames)]
+        output = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+        r = results[-1]
+        print(
+            f"{mode:>5}: {r['frames_per_sec']:.2f} frames/s, RTF {r['real_time_factor']:.2f}, "
+            f"RSS {r['rss_mb']:.0f} MB (peak {r['peak_rss_mb']:.0f} MB)"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Microbenchmark of the top-k samplers against the original full-vocabulary implementation.
+
+    python benchmarks/bench_sampling.py --device cpu --batch-sizes 1 8
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sampling import SamplingParams, sample_topk, sample_topk_reference, sample_topk_rows  # noqa: E402
+
+
+def _time(fn, iters: int, device: torch.device) -> float:
+    for _ in range(10):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--dtype", type=str, default="bfloat16")
+    parser.add_argument("--vocab-size", type=int, default=2051)
+    parser.add_argument("--topk", type=int, default=50)
+    parser.add_argument("--temperature", type=float, default=0.9)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--iters", type=int, default=1000)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    print(f"{'batch':>5} {'reference us':>13} {'sample_topk us':>15} {'per-row us':>11} {'speedup':>8}")
+    for batch_size in args.batch_sizes:
+        logits = torch.randn(batch_size, args.vocab_size, device=device, dtype=dtype)
+        # Per-row settings spread around the shared ones, as they would be for mixed requests.
+        params = SamplingParams.create(
+            [args.temperature + 0.05 * (i % 3) for i in range(batch_size)],
+            [max(1, args.topk - 10 * (i % 3)) for i in range(batch_size)],
+            batch_size,
+            device,
+        )
+
+        reference = _time(lambda: sample_topk_reference(logits, args.topk, args.temperature), args.iters, device)
+        fast = _time(lambda: sample_topk(logits, args.topk, args.temperature), args.iters, device)
+        rows = _time(lambda: sample_topk_rows(logits, params), args.iters, device)
+        print(f"{batch_size:>5} {reference:>13.1f} {fast:>15.1f} {rows:>11.1f} {reference / fast:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Throughput of text normalization + tokenization into text frames: the former per-line path (regex passes
+and one ``encode`` call per text) against ``TextTokenizer`` cold (one batch encode) and warm (memoized).
+
+The corpus mixes unique sentences with a small set of phrases repeated throughout, like the prompts of an
+IVR system. Uses the offline byte tokenizer by default; --real-tokenizer loads the Llama 3.2 fast
+tokenizer (downloaded from the Hugging Face Hub), which is the one with a batch encode path.
+
+    python benchmarks/bench_text.py --lines 5000 --repeated 0.5 --real-tokenizer
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+from typing import List, Tuple
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_generation import ByteTokenizer  # noqa: E402
+from generator import load_llama3_tokenizer  # noqa: E402
+from text_processing import TextTokenizer  # noqa: E402
+
+WORDS = (
+    "the a your account balance payment order number please press one two three to for of and is has been "
+    "received shipped delayed thank you calling our team will help with today minutes hold line transfer"
+).split()
+PHRASES = [
+    "Thank you for calling. Please hold.",
+    "Your call is important to us; please stay on the line.",
+    "Press one for billing, two for support.",
+    "Sorry, I didn't catch that: could you repeat it?",
+]
+
+
+def corpus(lines: int, repeated: float, seed: int) -> List[str]:
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(lines):
+        if rng.random() < repeated:
+            texts.append(rng.choice(PHRASES))
+        else:
+            words = rng.choices(WORDS, k=rng.randint(6, 30))
+            texts.append(" ".join(words).capitalize() + rng.choice([".", "?", "!", ";", ":"]))
+    return texts
+
+
+def per_line(tokenizer, text: str, speaker: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    # Generator._tokenize_text_segment before text_processing.
+    text = text.replace("\r", ", ")
+    text = text.replace(";", ", ")
+    text = text.replace(":", ", ")
+    text = re.sub(r"\s*,\s*", ", ", text)
+    text = " ".join(text.split())
+
+    text_tokens = tokenizer.encode(f"[{speaker}]{text}")
+    text_frame = torch.zeros(len(text_tokens), 33).long()
+    text_frame_mask = torch.zeros(len(text_tokens), 33).bool()
+    text_frame[:, -1] = torch.tensor(text_tokens)
+    text_frame_mask[:, -1] = True
+    return text_frame, text_frame_mask
+
+
+def _lines_per_sec(fn, lines: int, iters: int) -> float:
+    best = float("inf")
+    for _ in range(iters):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return lines / best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=5000)
+    parser.add_argument("--repeated", type=float, default=0.5, help="fraction of lines that are repeated phrases")
+    parser.add_argument("--iters", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--real-tokenizer", action="store_true")
+    parser.add_argument("--output", type=str, default="")
+    args = parser.parse_args()
+
+    tokenizer = load_llama3_tokenizer() if args.real_tokenizer else ByteTokenizer()
+    texts = corpus(args.lines, args.repeated, args.seed)
+
+    def run_per_line():
+        for text in texts:
+            per_line(tokenizer, text, 0)
+
+    def run_cold():
+        TextTokenizer(tokenizer, max_entries=len(texts)).frames_batch(texts, 0)
+
+    warm = TextTokenizer(tokenizer, max_entries=len(texts))
+    warm.frames_batch(texts, 0)
+
+    # Same frames either way.
+    for text, (frames, mask) in zip(texts[:100], warm.frames_batch(texts[:100], 0)):
+        expected_frames, expected_mask = per_line(tokenizer, text, 0)
+        assert torch.equal(frames, expected_frames) and torch.equal(mask, expected_mask), text
+
+    results = {
+        "meta": {"lines": args.lines, "repeated": args.repeated, "tokenizer": type(tokenizer).__name__},
+        "per_line_lines_per_sec": _lines_per_sec(run_per_line, len(texts), args.iters),
+        "batch_cold_lines_per_sec": _lines_per_sec(run_cold, len(texts), args.iters),
+        "batch_warm_lines_per_sec": _lines_per_sec(lambda: warm.frames_batch(texts, 0), len(texts), args.iters),
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
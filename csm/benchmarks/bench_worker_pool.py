@@ -0,0 +1,109 @@
+"""
+Throughput and memory of WorkerPool as the worker count grows.
+
+Memory is the proportional set size (PSS) summed over the parent and its workers, which counts shared
+weight pages once instead of once per process as RSS would. PSS is read from /proc/<pid>/smaps_rollup,
+or from psutil where there is no procfs; where psutil has no PSS either (Windows), the parent's RSS plus
+the workers' unique set sizes stands in for it, and ``memory_metric`` in the results says which was used.
+Uses random weights and the offline stubs from bench_generation.py.
+
+    python benchmarks/bench_worker_pool.py --config 1b --workers 1 2 4 --jobs 8 --pin-cores
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import List, Tuple
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_generation import CONFIGS, ByteTokenizer, StubMimi, StubWatermarker  # noqa: E402
+from models import random_model  # noqa: E402
+from worker_pool import WorkerPool  # noqa: E402
+
+
+def _pss_mb(pids: List[int]) -> Tuple[float, str]:
+    """Memory of ``pids`` with shared pages counted once, in MB, and the name of the measure used."""
+    try:
+        total = 0
+        for pid in pids:
+            with open(f"/proc/{pid}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith("Pss:"):
+                        total += int(line.split()[1])
+        return total / 1024, "pss"
+    except OSError:  # no procfs: macOS, Windows
+        pass
+    import psutil
+
+    infos = [psutil.Process(pid).memory_full_info() for pid in pids]
+    if all(hasattr(info, "pss") for info in infos):
+        return sum(info.pss for info in infos) / 2**20, "pss"
+    # The parent's RSS holds the shared weights once; the workers add only their own pages.
+    return (infos[0].rss + sum(info.uss for info in infos[1:])) / 2**20, "parent rss + worker uss"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, choices=sorted(CONFIGS), default="tiny")
+    parser.add_argument("--dtype", type=str, default="bfloat16")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads-per-worker", type=int, default=None)
+    parser.add_argument("--pin-cores", action="store_true")
+    parser.add_argument("--jobs", type=int, default=8)
+    parser.add_argument("--max-audio-length-ms", type=float, default=2000)
+    parser.add_argument("--output", type=str, default="")
+    args = parser.parse_args()
+
+    model = random_model(CONFIGS[args.config], device="cpu", dtype=getattr(torch, args.dtype))
+    text = "The quick brown fox jumps over the lazy dog."
+
+    results = []
+    for num_workers in args.workers:
+        with WorkerPool(
+            model,
+            num_workers,
+            args.threads_per_worker,
+            args.pin_cores,
+            audio_tokenizer=StubMimi(),
+            text_tokenizer=ByteTokenizer(),
+            watermarker=StubWatermarker(),
+        ) as pool:
+            # Warm up every worker (and wait for them to start) before timing.
+            for future in [pool.submit(text, 0, [], args.max_audio_length_ms) for _ in range(num_workers)]:
+                future.result()
+
+            start = time.perf_counter()
+            futures = [pool.submit(text, 0, [], args.max_audio_length_ms) for _ in range(args.jobs)]
+            audio_seconds = sum(future.result().numel() for future in futures) / StubMimi.sample_rate
+            elapsed = time.perf_counter() - start
+            pss, memory_metric = _pss_mb([os.getpid()] + pool.pids)
+
+        results.append(
+            {
+                "workers": num_workers,
+                "threads_per_worker": pool.threads_per_worker,
+                "jobs_per_sec": args.jobs / elapsed,
+                "audio_seconds_per_sec": audio_seconds / elapsed,
+                "pss_mb": pss,
+                "memory_metric": memory_metric,
+            }
+        )
+        r = results[-1]
+        print(
+            f"{num_workers} workers x {r['threads_per_worker']} threads: {r['jobs_per_sec']:.2f} jobs/s, "
+            f"{r['audio_seconds_per_sec']:.2f} s audio/s, {r['memory_metric']} {r['pss_mb']:.0f} MB"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
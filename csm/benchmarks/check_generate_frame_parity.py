@@ -0,0 +1,225 @@
+"""
+Check ``Model.generate_frame`` and the samplers against the original implementation.
+
+1. Original end to end: the reference frame loop (``torch.cat`` per codebook, fresh decoder positions and
+   masks, a full decoder cache reset every frame) sampling with ``sampling.sample_topk_reference``, the
+   original full-vocabulary sampler. That sampler draws a different number of random values than
+   ``sample_topk``, so the two can only agree token for token where sampling is deterministic: this check
+   runs at ``--greedy-temperature``, where the top token takes all the probability.
+2. Decoder loop: the same reference loop sampling with ``sample_topk`` at ``--temperature`` and ``--topk``.
+   From the same seed it must sample exactly the same tokens as ``generate_frame``, with and without
+   per-row ``SamplingParams``.
+3. Samplers: ``sample_topk``, ``sample_topk_rows`` and ``sample_topk_reference`` each draw ``--draws``
+   tokens from fixed logits. Their frequencies must be within ``--tolerance`` of the exact top-k softmax
+   probabilities, and tokens outside the top k must never be drawn.
+
+Each case feeds every frame's samples back in for ``--frames`` frames on the same random-weight model.
+Exits with status 1 on any mismatch.
+
+    python benchmarks/check_generate_frame_parity.py --device cpu --batch-sizes 1 3 --frames 8
+"""
+
+import argparse
+import os
+import sys
+from typing import Callable, Dict, List
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import CSM_1B_ARGS, TINY_ARGS, Model, _index_causal_mask, random_model  # noqa: E402
+from sampling import SamplingParams, sample_topk, sample_topk_reference, sample_topk_rows  # noqa: E402
+
+CONFIGS = {"tiny": TINY_ARGS, "1b": CSM_1B_ARGS}
+
+
+@torch.inference_mode()
+def reference_generate_frame(
+    model: Model,
+    tokens: torch.Tensor,
+    tokens_mask: torch.Tensor,
+    input_pos: torch.Tensor,
+    temperature: float,
+    topk: int,
+    sampler: Callable[[torch.Tensor, int, float], torch.Tensor],
+) -> torch.Tensor:
+    """``Model.generate_frame`` before the decoder loop was preallocated, sampling with ``sampler``."""
+    dtype = next(model.parameters()).dtype
+
+    assert model.backbone.caches_are_enabled(), "backbone caches are not enabled"
+    curr_backbone_mask = _index_causal_mask(model.backbone_causal_mask, input_pos)
+    embeds = model._embed_tokens(tokens)
+    masked_embeds = embeds * tokens_mask.unsqueeze(-1)
+    h = masked_embeds.sum(dim=2)
+    h = model.backbone(h, input_pos=input_pos, mask=curr_backbone_mask).to(dtype=dtype)
+
+    last_h = h[:, -1, :]
+    c0_logits = model.codebook0_head(last_h)
+    c0_sample = sampler(c0_logits, topk, temperature)
+    c0_embed = model._embed_audio(0, c0_sample)
+
+    curr_h = torch.cat([last_h.unsqueeze(1), c0_embed], dim=1)
+    curr_sample = c0_sample.clone()
+    curr_pos = torch.arange(0, curr_h.size(1), device=curr_h.device).unsqueeze(0).repeat(curr_h.size(0), 1)
+
+    # Decoder caches must be reset every frame.
+    model.decoder.reset_caches()
+    for i in range(1, model.config.audio_num_codebooks):
+        curr_decoder_mask = _index_causal_mask(model.decoder_causal_mask, curr_pos)
+        decoder_h = model.decoder(model.projection(curr_h), input_pos=curr_pos, mask=curr_decoder_mask).to(
+            dtype=dtype
+        )
+        ci_logits = torch.mm(decoder_h[:, -1, :], model.audio_head[i - 1])
+        ci_sample = sampler(ci_logits, topk, temperature)
+        ci_embed = model._embed_audio(i, ci_sample)
+
+        curr_h = ci_embed
+        curr_sample = torch.cat([curr_sample, ci_sample], dim=1)
+        curr_pos = curr_pos[:, -1:] + 1
+
+    return curr_sample
+
+
+@torch.inference_mode()
+def run_frames(model: Model, step: Callable, prompt: torch.Tensor, frames: int, seed: int) -> List[torch.Tensor]:
+    """Samples of ``frames`` frames after ``prompt``, each fed back as the next frame's tokens."""
+    b, prompt_len, width = prompt.shape
+    device = prompt.device
+    model.reset_caches()
+    torch.manual_seed(seed)
+
+    tokens = prompt
+    tokens_mask = torch.ones_like(prompt, dtype=torch.bool)
+    input_pos = torch.arange(prompt_len, device=device).unsqueeze(0).repeat(b, 1)
+    frame_mask = torch.ones(b, 1, width, dtype=torch.bool, device=device)
+    frame_mask[..., -1] = False
+    samples = []
+    for _ in range(frames):
+        sample = step(tokens, tokens_mask, input_pos)
+        samples.append(sample.clone())
+        tokens = torch.cat([sample, torch.zeros(b, 1, dtype=sample.dtype, device=device)], dim=1).unsqueeze(1).long()
+        tokens_mask = frame_mask
+        input_pos = input_pos[:, -1:] + 1
+    return samples
+
+
+def check_frames(model: Model, config, args, b: int) -> bool:
+    """Cases 1 and 2 at batch size ``b``. Returns True on any mismatch."""
+    # The original decoder loop assumes caches sized for exactly the batch.
+    model.setup_caches(b)
+    rng = torch.Generator().manual_seed(args.seed + b)
+    prompt = torch.cat(
+        [
+            torch.randint(config.audio_vocab_size, (b, args.prompt_len, config.audio_num_codebooks), generator=rng),
+            torch.randint(config.text_vocab_size, (b, args.prompt_len, 1), generator=rng),
+        ],
+        dim=-1,
+    ).to(args.device)
+    device = torch.device(args.device)
+
+    def reference(sampler: Callable, temperature: float) -> Callable:
+        return lambda t, m, p: reference_generate_frame(model, t, m, p, temperature, args.topk, sampler)
+
+    def current(temperature: float) -> Dict[str, Callable]:
+        params = SamplingParams.create(temperature, args.topk, b, device)
+        return {
+            "generate_frame": lambda t, m, p: model.generate_frame(t, m, p, temperature, args.topk),
+            "generate_frame(sampling=...)": lambda t, m, p: model.generate_frame(t, m, p, 0, 0, sampling=params),
+        }
+
+    greedy = args.greedy_temperature
+    cases = [
+        ("original sampler, near-greedy", reference(sample_topk_reference, greedy), greedy),
+        ("sample_topk", reference(sample_topk, args.temperature), args.temperature),
+    ]
+    failed = False
+    for case, reference_step, temperature in cases:
+        expected = run_frames(model, reference_step, prompt, args.frames, args.seed)
+        for name, step in current(temperature).items():
+            samples = run_frames(model, step, prompt, args.frames, args.seed)
+            mismatches = [i for i, (r, s) in enumerate(zip(expected, samples)) if not torch.equal(r, s)]
+            status = "ok" if not mismatches else f"MISMATCH at frames {mismatches}"
+            print(f"batch {b} {name} vs reference ({case}): {args.frames} frames {status}")
+            failed |= bool(mismatches)
+    return failed
+
+
+def exact_topk_probs(logits: torch.Tensor, topk: int, temperature: float) -> torch.Tensor:
+    """(vocab_size,) probability of every token under top-k sampling of (vocab_size,) ``logits``."""
+    values, indices = torch.topk(logits.double(), topk)
+    return torch.zeros_like(logits, dtype=torch.float64).scatter(0, indices, torch.softmax(values / temperature, 0))
+
+
+def frequencies(samples: torch.Tensor, vocab_size: int) -> torch.Tensor:
+    return torch.bincount(samples.flatten().long().cpu(), minlength=vocab_size).double() / samples.numel()
+
+
+@torch.inference_mode()
+def check_samplers(vocab_size: int, args) -> bool:
+    """Case 3. Returns True when any sampler is off the exact distribution."""
+    torch.manual_seed(args.seed)
+    logits = (torch.randn(vocab_size) * 3).to(args.device)
+    settings = [(args.temperature, args.topk), (0.5, max(1, args.topk // 10))]
+    n = args.draws
+
+    draws = {}
+    for temperature, topk in settings:
+        batch = logits.expand(n, -1)
+        draws[("sample_topk", temperature, topk)] = sample_topk(batch, topk, temperature)
+        draws[("sample_topk_reference", temperature, topk)] = sample_topk_reference(batch, topk, temperature)
+    # One batch mixing both settings, half the rows each, as the scheduler does.
+    params = SamplingParams.create(
+        [t for t, _ in settings for _ in range(n)], [k for _, k in settings for _ in range(n)], 2 * n, logits.device
+    )
+    mixed = sample_topk_rows(logits.expand(2 * n, -1), params)
+    for i, (temperature, topk) in enumerate(settings):
+        draws[("sample_topk_rows", temperature, topk)] = mixed[i * n : (i + 1) * n]
+
+    failed = False
+    for (name, temperature, topk), samples in draws.items():
+        expected = exact_topk_probs(logits.cpu(), topk, temperature)
+        observed = frequencies(samples, vocab_size)
+        error = (observed - expected).abs().max().item()
+        outside = observed[expected == 0].sum().item()
+        ok = error <= args.tolerance and outside == 0
+        print(
+            f"{name} (temperature {temperature}, topk {topk}): max |freq - p| {error:.4f}, "
+            f"mass outside top-k {outside:.4f} {'ok' if ok else 'MISMATCH'}"
+        )
+        failed |= not ok
+    return failed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, choices=sorted(CONFIGS), default="tiny")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", type=str, default="float32")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 3])
+    parser.add_argument("--frames", type=int, default=8)
+    parser.add_argument("--prompt-len", type=int, default=16)
+    parser.add_argument("--temperature", type=float, default=0.9)
+    parser.add_argument("--topk", type=int, default=50)
+    # Random weights give near-tied logits; at 1e-4 some codebooks still sample at random.
+    parser.add_argument("--greedy-temperature", type=float, default=1e-10)
+    parser.add_argument("--draws", type=int, default=20_000, help="tokens drawn per sampler in the distribution check")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="max allowed |frequency - probability|")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    config = CONFIGS[args.config]
+    model = random_model(config, device=args.device, dtype=getattr(torch, args.dtype))
+
+    failed = False
+    for b in args.batch_sizes:
+        failed |= check_frames(model, config, args, b)
+    failed |= check_samplers(config.audio_vocab_size, args)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Compare two bench_generation.py result files metric by metric.
+
+    python benchmarks/compare.py before.json after.json --threshold 0.05
+
+Every metric is a cost (lower is better). Exits with status 1 if any metric got worse by more than
+``--threshold`` (relative), so it can gate a CI job.
+"""
+
+import argparse
+import json
+import math
+import sys
+from typing import Dict
+
+# Informational values that are not costs.
+_SKIP = {"audio_seconds", "min", "max"}
+
+
+def flatten(results: dict, prefix: str = "") -> Dict[str, float]:
+    metrics = {}
+    for key, value in results.items():
+        if key == "meta" or key in _SKIP:
+            continue
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            metrics.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and not math.isnan(value):
+            metrics[name] = float(value)
+    return metrics
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("baseline", type=str)
+    parser.add_argument("candidate", type=str)
+    parser.add_argument("--threshold", type=float, default=0.05)
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    for field in ("device", "dtype", "config", "codecs"):
+        if baseline["meta"].get(field) != candidate["meta"].get(field):
+            print(f"warning: {field} differs ({baseline['meta'].get(field)} vs {candidate['meta'].get(field)})")
+
+    before, after = flatten(baseline), flatten(candidate)
+    regressions = 0
+    print(f"{'metric':<28} {'baseline':>12} {'candidate':>12} {'change':>8}")
+    for name in sorted(before.keys() & after.keys()):
+        change = (after[name] - before[name]) / before[name] if before[name] else 0.0
+        flag = ""
+        if change > args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{name:<28} {before[name]:>12.3f} {after[name]:>12.3f} {change:>+7.1%}{flag}")
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,97 +1,40 @@
 import os
 import torch
 import torchaudio
-import subprocess
-from huggingface_hub import hf_hub_download
-from safetensors.torch import load_file  # <-- import safetensors loader
+from audio_io import load_audio
+from autotune import cached_or_default
 from generator import Segment
+from longform import generate_long
 from tqdm import tqdm
 
-# Device selection: Prefer MPS, then CUDA, then CPU.
-if torch.backends.mps.is_available():
-    device = "mps"
-elif torch.cuda.is_available():
-    device = "cuda"
-else:
-    device = "cpu"
+# Device, dtype and CPU thread count as measured by python autotune.py, or the untuned defaults
+tuned = cached_or_default()
+tuned.apply()
+device = tuned.device
 
-print(f"Using device: {device}")
+print(f"Using device: {device} ({tuned.dtype})")
 
-# Define our own load_csm_1b function that combines both approaches
-def load_csm_1b_custom(device="cuda"):
+# Define our own load_csm_1b function that prefers the local checkpoint
+def load_csm_1b_custom(device="cuda", dtype=torch.bfloat16):
     # Import here to avoid circular imports
-    from models import Model, ModelArgs
-    from generator import Generator
-    
-    # Path to your .safetensors file
-    model_path = os.path.join("models", "model.safetensors")
-    if not os.path.exists(model_path):
-        print("Local checkpoint not found. Downloading from Hugging Face...")
-        model_path = hf_hub_download(repo_id="sesame/csm-1b", filename="model.safetensors")
+    from generator import load_generator
 
-    
-    # Initialize model with args like in the old code
-    model_args = ModelArgs(
-        backbone_flavor="llama-1B",
-        decoder_flavor="llama-100M",
-        text_vocab_size=128256,
-        audio_vocab_size=2051,
-        audio_num_codebooks=32,
-    )
-    
-    # Load the model and state dict
-    model = Model(model_args).to(device=device, dtype=torch.bfloat16)
-    
-    # Load state dict based on file extension
-    if model_path.endswith('.pt'):
-        print("Loading PyTorch checkpoint...")
-        state_dict = torch.load(model_path, map_location=device)
-    else:
-        print("Loading SafeTensors checkpoint...")
-        state_dict = load_file(model_path, device=device)
-    
-    model.load_state_dict(state_dict)
-    return Generator(model)
+    # Builds the model straight from models/model.safetensors (downloaded if missing) and loads
+    # the tokenizer, Mimi and the watermarker in parallel
+    return load_generator(os.path.join("models", "model.safetensors"), device=device, dtype=dtype)
 
 # Load the CSM model using our custom function
-generator = load_csm_1b_custom(device=device)
-
-# Convert MP3 to WAV using ffmpeg (mono audio)
-def convert_mp3_to_wav(mp3_path, wav_path):
-    print(f"Converting {mp3_path} to mono {wav_path}...")
-    subprocess.call(['ffmpeg', '-i', mp3_path, '-ac', '1', wav_path])
-    print("Conversion complete.")
-
-# Function to load and resample audio to the model's sample rate.
-def load_audio(audio_path):
-    if audio_path.endswith('.mp3'):
-        wav_path = audio_path.replace('.mp3', '.wav')
-        convert_mp3_to_wav(audio_path, wav_path)
-        audio_path = wav_path
-        
-    print(f"Loading audio from {audio_path}...")
-    audio_tensor, sample_rate = torchaudio.load(audio_path)
-    
-    if audio_tensor.shape[0] > 1:
-        audio_tensor = torch.mean(audio_tensor, dim=0, keepdim=True)
-        print(f"Converted audio to mono: {audio_tensor.shape}")
-    
-    print(f"Original sample rate: {sample_rate}, converting to {generator.sample_rate}")
-    audio_tensor = torchaudio.functional.resample(
-        audio_tensor.squeeze(0), orig_freq=sample_rate, new_freq=generator.sample_rate
-    )
-    
-    print(f"Final audio tensor shape: {audio_tensor.shape}")
-    return audio_tensor
+generator = load_csm_1b_custom(device=device, dtype=tuned.torch_dtype)
 
 # Function to generate TTS audio with multiple voice references
-def generate_tts_with_voices(text, speakers, transcripts, audio_paths, target_speaker=0, max_audio_length_ms=50_000):
+def generate_tts_with_voices(text, speakers, transcripts, audio_paths, target_speaker=0, max_audio_length_ms=20_000):
     print("\nInitializing voice generation process...")
     
     # Show progress for loading audio files
     voice_audios = []
     for path in tqdm(audio_paths, desc="1/3 Loading voice references"):
-        voice_audios.append(load_audio(path))
+        # mp3 is decoded in-process, no converted wav is written next to it
+        voice_audios.append(load_audio(path, generator.sample_rate))
     
     # Create context segments with progress bar
     context_segments = []
@@ -103,12 +46,13 @@ def generate_tts_with_voices(text, speakers, transcripts, audio_paths, target_sp
         )
     
     print("\n3/3 Generating audio with progress tracking...")
-    # Generate audio using all voice contexts (progress bar handled by Generator class)
-    audio = generator.generate(
+    # Generate sentence chunk by chunk so the text length is not limited by the model's sequence length
+    audio = generate_long(
+        generator,
         text=text,
         speaker=target_speaker,
         context=context_segments,
-        max_audio_length_ms=max_audio_length_ms
+        max_chunk_audio_ms=max_audio_length_ms
     )
     return audio
 
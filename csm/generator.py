@@ -1,24 +1,98 @@
-from dataclasses import dataclass
-from typing import List, Tuple
+import itertools
+import os
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Iterator, List, Optional, Tuple, Union
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 import torch
-import torchaudio
 from huggingface_hub import hf_hub_download
-from models import Model
+from models import BackboneCacheSnapshot, Model, load_model_from_checkpoint
 from moshi.models import loaders
+from sampling import SamplingParams
+from segment_cache import SegmentTokenCache, segment_key
+from text_processing import TextTokenizer
 from tokenizers.processors import TemplateProcessing
 from transformers import AutoTokenizer
-from watermarking import CSM_1B_GH_WATERMARK, load_watermarker, watermark
+from watermarking import CSM_1B_GH_WATERMARK, StreamingWatermark, WatermarkStage, load_watermarker
 from tqdm import tqdm
-import re
 
 
 @dataclass
 class Segment:
     speaker: int
     text: str
-    # (num_samples,), sample_rate = 24_000
-    audio: torch.Tensor
+    # (num_samples,), sample_rate = 24_000. May be None when ``codes`` is given.
+    audio: Optional[torch.Tensor]
+    # (32, num_frames) Mimi codes, e.g. from ``Generator.generate_codes``. Used as they are instead of
+    # encoding ``audio``, which skips a Mimi encode and the drift of a decode/encode round trip.
+    codes: Optional[torch.Tensor] = None
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def _rss_mb() -> float:
+    """Current resident set size of this process, or 0.0 when it cannot be read."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2**20
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except OSError:  # no procfs: macOS or Windows without psutil
+        return 0.0
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+@dataclass
+class GenerationStats:
+    """Per-stage wall times (milliseconds) of one generation, kept on ``Generator.last_stats``."""
+
+    # Prompt tokenization, including the Mimi encodes below.
+    tokenize_ms: float = 0.0
+    # Mimi encode time per context segment; 0.0 when its tokens came from the segment cache.
+    segment_encode_ms: List[float] = field(default_factory=list)
+    # Backbone pass over the prompt plus sampling the first frame.
+    prefill_ms: float = 0.0
+    # Every later frame. Frames between two EOS checks share their interval's average.
+    frame_ms: List[float] = field(default_factory=list)
+    num_frames: int = 0
+    # "eos", or "max_length" when max_audio_length_ms was reached first.
+    eos_reason: str = ""
+    decode_ms: float = 0.0
+    # None when watermarking finished on the background worker.
+    watermark_ms: Optional[float] = None
+    # Peak CUDA memory allocated during this call. On CPU, the highest process RSS seen at the start, at each
+    # EOS check and after decoding and watermarking: sampled, so a short spike inside a stage can be missed.
+    # 0.0 when RSS cannot be read (no psutil and no procfs).
+    peak_memory_mb: float = 0.0
+
+    @property
+    def frame_p50_ms(self) -> float:
+        return _percentile(self.frame_ms, 50)
+
+    @property
+    def frame_p95_ms(self) -> float:
+        return _percentile(self.frame_ms, 95)
+
+    def summary(self) -> str:
+        watermark = "background" if self.watermark_ms is None else f"{self.watermark_ms:.0f} ms"
+        return (
+            f"tokenize {self.tokenize_ms:.0f} ms ({len(self.segment_encode_ms)} segments), "
+            f"prefill {self.prefill_ms:.0f} ms, {self.num_frames} frames ({self.eos_reason}) "
+            f"p50 {self.frame_p50_ms:.1f} / p95 {self.frame_p95_ms:.1f} ms, decode {self.decode_ms:.0f} ms, "
+            f"watermark {watermark}, peak memory {self.peak_memory_mb:.0f} MB"
+        )
 
 
 def load_llama3_tokenizer():
@@ -38,57 +112,89 @@ def load_llama3_tokenizer():
     return tokenizer
 
 
+def load_mimi(device: Union[str, torch.device] = "cuda"):
+    mimi_weight = hf_hub_download(loaders.DEFAULT_REPO, loaders.MIMI_NAME)
+    mimi = loaders.get_mimi(mimi_weight, device=device)
+    mimi.set_num_codebooks(32)
+    return mimi
+
+
 class Generator:
     def __init__(
         self,
         model: Model,
+        segment_cache_bytes: int = 256 * 1024 * 1024,
+        max_prefix_snapshots: int = 8,
+        text_tokenizer=None,
+        audio_tokenizer=None,
+        watermarker=None,
     ):
+        """
+        ``text_tokenizer``, ``audio_tokenizer`` (Mimi) and ``watermarker`` are loaded here unless
+        already loaded by the caller, e.g. concurrently by ``load_generator``. At most ``max_prefix_snapshots``
+        named prefix caches are kept, the least recently used is dropped first.
+        """
         self._model = model
         self._model.setup_caches(1)
 
-        self._text_tokenizer = load_llama3_tokenizer()
+        # Tokenized context segments, keyed on (speaker, text, audio samples).
+        self._segment_cache = SegmentTokenCache(max_bytes=segment_cache_bytes)
+        # Backbone KV cache after prefilling a named context: name -> (tokens, mask, snapshot), oldest use first.
+        self._prefix_snapshots: "OrderedDict[str, Tuple[torch.Tensor, torch.Tensor, BackboneCacheSnapshot]]" = (
+            OrderedDict()
+        )
+        self.max_prefix_snapshots = max_prefix_snapshots
 
-        device = next(model.parameters()).device
-        mimi_weight = hf_hub_download(loaders.DEFAULT_REPO, loaders.MIMI_NAME)
-        mimi = loaders.get_mimi(mimi_weight, device=device)
-        mimi.set_num_codebooks(32)
-        self._audio_tokenizer = mimi
+        self._text_tokenizer = text_tokenizer if text_tokenizer is not None else load_llama3_tokenizer()
 
-        self._watermarker = load_watermarker(device=device)
+        device = next(model.parameters()).device
+        self._audio_tokenizer = audio_tokenizer if audio_tokenizer is not None else load_mimi(device)
+        self._watermarker = watermarker if watermarker is not None else load_watermarker(device=device)
 
-        self.sample_rate = mimi.sample_rate
+        self.sample_rate = self._audio_tokenizer.sample_rate
+        # This applies an imperceptible watermark to identify audio as AI-generated.
+        # Watermarking ensures transparency, dissuades misuse, and enables traceability.
+        # Please be a responsible AI citizen and keep the watermarking in place.
+        # If using CSM 1B in another application, use your own private key and keep it secret.
+        self._watermark_stage = WatermarkStage(self._watermarker, self.sample_rate, CSM_1B_GH_WATERMARK)
         self.device = device
+        # Normalized, tokenized text frames, memoized per (speaker, text).
+        self._text_frontend = TextTokenizer(self._text_tokenizer, device=device)
+        # Frames generated between EOS checks. Each check reads a flag back to the host, which stalls a GPU
+        # but is free on CPU, where a frame sampled past EOS is the bigger cost.
+        self.eos_check_interval = 8 if device.type == "cuda" else 1
+        # Clips longer than this many frames are decoded chunk by chunk, which bounds Mimi's activation memory.
+        self.decode_chunk_frames = 250
+        # Frames decoded again before each chunk and dropped. Mimi's decoder transformer attends to 250 steps
+        # at 25 Hz, i.e. 125 frames; the rest is margin for the convolutions around it.
+        self.decode_warmup_frames = 150
+        # Clips longer than decode_chunk_frames are also watermarked block by block, each block with this much
+        # audio on either side, which bounds the watermarker's memory the same way.
+        self.watermark_margin_ms = 1000
+        # Timings of the most recent generate / generate_deferred / generate_stream call.
+        self.last_stats: Optional[GenerationStats] = None
 
     def _tokenize_text_segment(self, text: str, speaker: int) -> Tuple[torch.Tensor, torch.Tensor]:
-        # Add natural pauses for line breaks and punctuation
-        text = text.replace('\r', ', ')
-        text = text.replace(';', ', ')
-        text = text.replace(':', ', ')
-        # Clean up multiple spaces and commas
-        text = re.sub(r'\s*,\s*', ', ', text)
-        text = ' '.join(text.split())
-        
-        frame_tokens = []
-        frame_masks = []
-
-        text_tokens = self._text_tokenizer.encode(f"[{speaker}]{text}")
-        text_frame = torch.zeros(len(text_tokens), 33).long()
-        text_frame_mask = torch.zeros(len(text_tokens), 33).bool()
-        text_frame[:, -1] = torch.tensor(text_tokens)
-        text_frame_mask[:, -1] = True
-
-        frame_tokens.append(text_frame.to(self.device))
-        frame_masks.append(text_frame_mask.to(self.device))
+        return self._text_frontend.frames(text, speaker)
 
-        return torch.cat(frame_tokens, dim=0), torch.cat(frame_masks, dim=0)
+    def pretokenize(self, texts: List[str], speakers: Union[int, List[int]]) -> None:
+        """
+        Tokenize many texts (e.g. every chunk of a long document, or a batch of jobs) in one tokenizer call,
+        so the ``generate`` calls that follow find their text frames memoized.
+        """
+        self._text_frontend.frames_batch(texts, speakers)
 
     def _tokenize_audio(self, audio: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
-        frame_tokens = []
-        frame_masks = []
-
         # (K, T)
         audio = audio.to(self.device)
         audio_tokens = self._audio_tokenizer.encode(audio.unsqueeze(0).unsqueeze(0))[0]
+        return self._tokenize_codes(audio_tokens)
+
+    def _tokenize_codes(self, audio_tokens: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        frame_tokens = []
+        frame_masks = []
+
+        audio_tokens = audio_tokens.to(self.device)
         # add EOS frame
         eos_frame = torch.zeros(audio_tokens.size(0), 1).to(self.device)
         audio_tokens = torch.cat([audio_tokens, eos_frame], dim=1)
@@ -103,15 +209,75 @@ class Generator:
 
         return torch.cat(frame_tokens, dim=0), torch.cat(frame_masks, dim=0)
 
-    def _tokenize_segment(self, segment: Segment) -> Tuple[torch.Tensor, torch.Tensor]:
+    def _tokenize_segment(
+        self, segment: Segment, stats: Optional[GenerationStats] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Returns:
             (seq_len, 33), (seq_len, 33)
         """
+        if segment.codes is not None:
+            # Nothing to encode, so nothing worth caching.
+            text_tokens, text_masks = self._tokenize_text_segment(segment.text, segment.speaker)
+            audio_tokens, audio_masks = self._tokenize_codes(segment.codes)
+            return torch.cat([text_tokens, audio_tokens], dim=0), torch.cat([text_masks, audio_masks], dim=0)
+
+        key = segment_key(segment.text, segment.speaker, segment.audio)
+        cached = self._segment_cache.get(key)
+        if cached is not None:
+            if stats is not None:
+                stats.segment_encode_ms.append(0.0)
+            return cached
+
         text_tokens, text_masks = self._tokenize_text_segment(segment.text, segment.speaker)
+        start = time.perf_counter()
         audio_tokens, audio_masks = self._tokenize_audio(segment.audio)
+        if stats is not None:
+            stats.segment_encode_ms.append(self._elapsed_ms(start))
+
+        result = torch.cat([text_tokens, audio_tokens], dim=0), torch.cat([text_masks, audio_masks], dim=0)
+        self._segment_cache.put(key, result)
+        return result
+
+    @property
+    def segment_cache(self) -> SegmentTokenCache:
+        return self._segment_cache
+
+    def invalidate_segment_cache(self, segment: Optional[Segment] = None) -> None:
+        """Forget the cached tokens of ``segment``, or of every segment when None."""
+        if segment is None:
+            self._segment_cache.invalidate()
+        elif segment.codes is None:
+            self._segment_cache.invalidate(segment_key(segment.text, segment.speaker, segment.audio))
+
+    def drop_prefix_cache(self, name: Optional[str] = None) -> None:
+        """Forget the backbone snapshot stored under ``name``, or every snapshot when None."""
+        if name is None:
+            self._prefix_snapshots.clear()
+        else:
+            self._prefix_snapshots.pop(name, None)
+
+    def _prefill_prefix(self, name: str, prefix_tokens: torch.Tensor, prefix_mask: torch.Tensor) -> None:
+        """Leave the backbone cache holding ``prefix_tokens``, restoring the ``name`` snapshot when it matches."""
+        entry = self._prefix_snapshots.get(name)
+        if (
+            entry is not None
+            and entry[0].shape == prefix_tokens.shape
+            and torch.equal(entry[0], prefix_tokens)
+            and torch.equal(entry[1], prefix_mask)
+        ):
+            self._model.restore_backbone_cache(entry[2])
+            self._prefix_snapshots.move_to_end(name)
+            return
 
-        return torch.cat([text_tokens, audio_tokens], dim=0), torch.cat([text_masks, audio_masks], dim=0)
+        self._model.reset_caches()
+        prefix_pos = torch.arange(0, prefix_tokens.size(0)).unsqueeze(0).long().to(self.device)
+        self._model.prefill(prefix_tokens.unsqueeze(0), prefix_mask.unsqueeze(0), prefix_pos)
+        snapshot = self._model.snapshot_backbone_cache(prefix_tokens.size(0))
+        self._prefix_snapshots.pop(name, None)
+        self._prefix_snapshots[name] = (prefix_tokens.clone(), prefix_mask.clone(), snapshot)
+        while len(self._prefix_snapshots) > self.max_prefix_snapshots:
+            self._prefix_snapshots.popitem(last=False)
 
     @torch.inference_mode()
     def generate(
@@ -122,13 +288,396 @@ class Generator:
         max_audio_length_ms: float = 90_000,
         temperature: float = 0.9,
         topk: int = 50,
+        prefix_cache: Optional[str] = None,
+        on_progress: Optional[Callable[[int, int], None]] = None,
     ) -> torch.Tensor:
+        """
+        Args:
+            prefix_cache: name under which the backbone KV cache for ``context`` is snapshotted. Later calls
+                with the same name and identical context restore the snapshot and only prefill ``text``.
+            on_progress: called as ``on_progress(frames_done, max_frames)`` at every EOS check. Replaces the
+                tqdm bar when given.
+
+        Per-stage timings are left on ``self.last_stats``.
+        """
+        stats = self._start_stats()
+        samples = list(
+            self._generate_frames(
+                text, speaker, context, max_audio_length_ms, temperature, topk, prefix_cache, stats, on_progress
+            )
+        )
+        start = time.perf_counter()
+        audio = self._decode(torch.stack(samples).permute(1, 2, 0))
+        stats.decode_ms = self._elapsed_ms(start)
+        self._sample_memory(stats)
+        start = time.perf_counter()
+        audio = self._watermark(audio)
+        stats.watermark_ms = self._elapsed_ms(start)
+        self._finish_stats(stats)
+        return audio
+
+    @torch.inference_mode()
+    def generate_deferred(
+        self,
+        text: str,
+        speaker: int,
+        context: List[Segment],
+        max_audio_length_ms: float = 90_000,
+        temperature: float = 0.9,
+        topk: int = 50,
+        prefix_cache: Optional[str] = None,
+        on_progress: Optional[Callable[[int, int], None]] = None,
+    ) -> "Future[torch.Tensor]":
+        """
+        Like ``generate``, but returns as soon as the audio is decoded. Watermarking finishes on the
+        background worker and the returned future resolves to the watermarked audio.
+        """
+        stats = self._start_stats()
+        samples = list(
+            self._generate_frames(
+                text, speaker, context, max_audio_length_ms, temperature, topk, prefix_cache, stats, on_progress
+            )
+        )
+        start = time.perf_counter()
+        audio = self._decode(torch.stack(samples).permute(1, 2, 0))
+        stats.decode_ms = self._elapsed_ms(start)
+        self._finish_stats(stats)
+        return self._submit_watermark(audio)
+
+    @torch.inference_mode()
+    def generate_codes(
+        self,
+        text: str,
+        speaker: int,
+        context: List[Segment],
+        max_audio_length_ms: float = 90_000,
+        temperature: float = 0.9,
+        topk: int = 50,
+        prefix_cache: Optional[str] = None,
+        on_progress: Optional[Callable[[int, int], None]] = None,
+    ) -> torch.Tensor:
+        """
+        Like ``generate``, but stops at the sampled Mimi codes, without decoding or watermarking.
+
+        Feed them back as ``Segment(speaker, text, audio=None, codes=codes)`` context and turn them into
+        audio with ``decode_codes`` only where the audio is actually needed.
+
+        Returns:
+            (32, num_frames) codes
+        """
+        stats = self._start_stats()
+        samples = list(
+            self._generate_frames(
+                text, speaker, context, max_audio_length_ms, temperature, topk, prefix_cache, stats, on_progress
+            )
+        )
+        self._finish_stats(stats)
+        if not samples:
+            return torch.zeros(self._model.config.audio_num_codebooks, 0, dtype=torch.long, device=self.device)
+        return torch.stack(samples).permute(1, 2, 0)[0]
+
+    @torch.inference_mode()
+    def decode_codes(self, codes: torch.Tensor) -> "Future[torch.Tensor]":
+        """
+        Decode (32, num_frames) codes with Mimi and watermark them on the background worker. The returned
+        future resolves to the watermarked (num_samples,) waveform.
+        """
+        if codes.size(-1) == 0:
+            empty: "Future[torch.Tensor]" = Future()
+            empty.set_result(torch.zeros(0, device=self.device))
+            return empty
+        audio = self._decode(codes.unsqueeze(0).to(self.device))
+        return self._submit_watermark(audio)
+
+    @torch.inference_mode()
+    def generate_stream(
+        self,
+        text: str,
+        speaker: int,
+        context: List[Segment],
+        max_audio_length_ms: float = 90_000,
+        temperature: float = 0.9,
+        topk: int = 50,
+        prefix_cache: Optional[str] = None,
+        chunk_frames: int = 2,
+        on_progress: Optional[Callable[[int, int], None]] = None,
+        watermark_context_ms: float = 80,
+        watermark_lookahead_ms: float = 80,
+    ) -> Iterator[torch.Tensor]:
+        """
+        Like ``generate``, but yields watermarked (num_samples,) chunks every ``chunk_frames`` frames
+        (80 ms each) instead of returning the whole clip after EOS.
+
+        Mimi decodes in streaming mode, carrying its convolution and transformer state across chunks.
+        Each chunk is watermarked together with ``watermark_context_ms`` of the audio before it and
+        ``watermark_lookahead_ms`` of the audio after it (see ``StreamingWatermark``), so resampling and
+        the watermarker's STFT see no edge at chunk boundaries. One frame on either side covers the
+        resampling kernels and a 2048-point STFT window at 44.1 kHz; that the watermarker itself needs
+        no more has not been measured. The stream lags generation by the lookahead: with the defaults the
+        first audio is ready after two frames (160 ms of audio), and each chunk is watermarked within a
+        window twice its length. Chunks are watermarked on the background worker while the next frames
+        are sampled, and are yielded in order as they complete.
+        """
+        stats = self._start_stats()
+        chunk = []
+        pending: Deque["Future[torch.Tensor]"] = deque()
+        watermark = StreamingWatermark(
+            self._watermark_stage,
+            context=int(watermark_context_ms * self.sample_rate / 1000),
+            lookahead=int(watermark_lookahead_ms * self.sample_rate / 1000),
+        )
+        frames = self._generate_frames(
+            text, speaker, context, max_audio_length_ms, temperature, topk, prefix_cache, stats, on_progress
+        )
+        # The first step tokenizes the prompt, which Mimi-encodes any context segment not in the segment
+        # cache. Encoding has to happen outside streaming mode: it needs the end padding and fresh state.
+        first = next(frames, None)
+        with self._audio_tokenizer.streaming(1):
+            for sample in itertools.chain([first] if first is not None else [], frames):
+                chunk.append(sample)
+                if len(chunk) == chunk_frames:
+                    pending.extend(watermark.push(self._decode_stream_chunk(chunk, stats)))
+                    chunk = []
+                while pending and pending[0].done():
+                    yield pending.popleft().result()
+            if chunk:
+                pending.extend(watermark.push(self._decode_stream_chunk(chunk, stats)))
+        pending.extend(watermark.flush())
+        self._finish_stats(stats)
+        while pending:
+            yield pending.popleft().result()
+
+    def _decode_stream_chunk(self, samples: List[torch.Tensor], stats: GenerationStats) -> torch.Tensor:
+        start = time.perf_counter()
+        audio = self._audio_tokenizer.decode(torch.stack(samples).permute(1, 2, 0)).squeeze(0).squeeze(0)
+        stats.decode_ms += self._elapsed_ms(start)
+        self._sample_memory(stats)
+        return audio
+
+    def _decode(self, codes: torch.Tensor) -> torch.Tensor:
+        """
+        Decode (1, 32, num_frames) codes to a (num_samples,) waveform.
+
+        Clips longer than ``decode_chunk_frames`` are decoded window by window into a preallocated buffer, so
+        peak memory is that of one window whatever the clip length. Each window starts ``decode_warmup_frames``
+        before the frames it keeps and the warm-up audio is dropped. Mimi's decoder is causal, so once the
+        warm-up covers its receptive field the kept frames match the one-shot decode. The warm-up length is
+        derived from Mimi's architecture, not measured: ``benchmarks/bench_decode_memory.py`` checks it against
+        the real Mimi and fails when the two paths differ by more than ``--tolerance``.
+        """
+        num_frames = codes.size(-1)
+        if num_frames <= self.decode_chunk_frames:
+            return self._audio_tokenizer.decode(codes).squeeze(0).squeeze(0)
+
+        frame_size = self._audio_tokenizer.frame_size
+        audio = None
+        for start in range(0, num_frames, self.decode_chunk_frames):
+            end = min(start + self.decode_chunk_frames, num_frames)
+            warmup = min(start, self.decode_warmup_frames)
+            window = self._audio_tokenizer.decode(codes[..., start - warmup : end])[0, 0]
+            if audio is None:
+                audio = window.new_empty(num_frames * frame_size)
+            audio[start * frame_size : end * frame_size] = window[warmup * frame_size :]
+        return audio
+
+    def _generate_frames(
+        self,
+        text: str,
+        speaker: int,
+        context: List[Segment],
+        max_audio_length_ms: float,
+        temperature: float,
+        topk: int,
+        prefix_cache: Optional[str],
+        stats: GenerationStats,
+        on_progress: Optional[Callable[[int, int], None]] = None,
+    ) -> Iterator[torch.Tensor]:
+        """Yields one (1, 32) frame of audio codes per step until EOS, recording timings into ``stats``."""
+        self._ensure_cache_batch_size(1)
+
+        max_audio_frames = int(max_audio_length_ms / 80)
+        start = time.perf_counter()
+        prompt_tokens, prompt_tokens_mask, text_len = self._tokenize_prompt(text, speaker, context, stats)
+        stats.tokenize_ms = self._elapsed_ms(start)
+
+        max_seq_len = 2048 - max_audio_frames
+        if prompt_tokens.size(0) >= max_seq_len:
+            raise ValueError(f"Inputs too long, must be below max_seq_len - max_audio_frames: {max_seq_len}")
+
+        start = time.perf_counter()
+        prefix_len = 0
+        if prefix_cache is not None and context:
+            prefix_len = prompt_tokens.size(0) - text_len
+            self._prefill_prefix(prefix_cache, prompt_tokens[:prefix_len], prompt_tokens_mask[:prefix_len])
+        else:
+            self._model.reset_caches()
+
+        curr_tokens = prompt_tokens[prefix_len:].unsqueeze(0)
+        curr_tokens_mask = prompt_tokens_mask[prefix_len:].unsqueeze(0)
+        curr_pos = torch.arange(prefix_len, prompt_tokens.size(0)).unsqueeze(0).long().to(self.device)
+
+        samples = torch.zeros(max_audio_frames, 1, 32).long().to(self.device)
+        frame_tokens, frame_tokens_mask, frame_pos = self._frame_input_buffers(1)
+
+        stats.eos_reason = "max_length"
+        with tqdm(total=max_audio_frames, desc="Generating audio", disable=on_progress is not None) as pbar:
+            checked = 0
+            for i in range(max_audio_frames):
+                self._model.generate_frame(curr_tokens, curr_tokens_mask, curr_pos, temperature, topk, out=samples[i])
+
+                frame_tokens[:, 0, :-1] = samples[i]
+                if i == 0:
+                    frame_pos.copy_(curr_pos[:, -1:] + 1)
+                    curr_tokens, curr_tokens_mask, curr_pos = frame_tokens, frame_tokens_mask, frame_pos
+                else:
+                    frame_pos += 1
+
+                # The prompt pass is always checked on its own, so its time is not mixed into the frame times.
+                if i > 0 and (i + 1 - checked) < self.eos_check_interval and i + 1 < max_audio_frames:
+                    continue
+
+                # Frames sampled after an all-zero (eos) frame are discarded.
+                is_eos = torch.all(samples[checked : i + 1] == 0, dim=-1).squeeze(-1)
+                num_valid = int(torch.where(is_eos.any(), is_eos.int().argmax(), is_eos.size(0)))
+                elapsed = (time.perf_counter() - start) * 1000
+                if i == 0:
+                    stats.prefill_ms = elapsed
+                else:
+                    stats.frame_ms.extend([elapsed / (i + 1 - checked)] * (i + 1 - checked))
+                stats.num_frames += num_valid
+                self._sample_memory(stats)
+
+                for sample in samples[checked : checked + num_valid]:
+                    yield sample
+                pbar.update(num_valid)
+                if on_progress is not None:
+                    on_progress(stats.num_frames, max_audio_frames)
+                if num_valid < is_eos.size(0):
+                    stats.eos_reason = "eos"
+                    break
+                checked = i + 1
+                # Time spent by the consumer of the yielded frames is not part of the next interval.
+                start = time.perf_counter()
+
+    def _frame_input_buffers(self, batch_size: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Returns:
+            (batch_size, 1, 33) tokens, (batch_size, 1, 33) mask and (batch_size, 1) positions
+            for feeding each sampled audio frame back into the backbone
+        """
+        frame_tokens = torch.zeros(batch_size, 1, 33).long().to(self.device)
+        frame_tokens_mask = torch.ones(batch_size, 1, 33).bool().to(self.device)
+        frame_tokens_mask[:, :, -1] = False
+        frame_pos = torch.zeros(batch_size, 1).long().to(self.device)
+        return frame_tokens, frame_tokens_mask, frame_pos
+
+    @torch.inference_mode()
+    def generate_batch(
+        self,
+        texts: List[str],
+        speakers: List[int],
+        contexts: List[List[Segment]],
+        max_audio_length_ms: float = 90_000,
+        temperature: Union[float, List[float]] = 0.9,
+        topk: Union[int, List[int]] = 50,
+    ) -> List[torch.Tensor]:
+        """
+        Generate several utterances in one frame loop. ``temperature`` and ``topk`` are either shared
+        or given per row.
+
+        Prompts are left-padded so every row's last prompt token lands on the same cache position;
+        padded positions are hidden from attention, and RoPE only sees relative offsets, so each
+        row behaves as if it had been generated on its own. Rows stop at their own EOS frame.
+
+        Returns:
+            one (num_samples,) waveform per row
+        """
+        if not (len(texts) == len(speakers) == len(contexts)):
+            raise ValueError("texts, speakers and contexts must have the same length")
+        if not texts:
+            return []
+
+        batch_size = len(texts)
+        self._ensure_cache_batch_size(batch_size)
         self._model.reset_caches()
 
         max_audio_frames = int(max_audio_length_ms / 80)
+        self.pretokenize(texts, speakers)
+        prompts = [self._tokenize_prompt(t, s, c)[:2] for t, s, c in zip(texts, speakers, contexts)]
+        prompt_len = max(p[0].size(0) for p in prompts)
+
+        max_seq_len = 2048 - max_audio_frames
+        if prompt_len >= max_seq_len:
+            raise ValueError(f"Inputs too long, must be below max_seq_len - max_audio_frames: {max_seq_len}")
+
+        curr_tokens = torch.zeros(batch_size, prompt_len, 33).long().to(self.device)
+        curr_tokens_mask = torch.zeros(batch_size, prompt_len, 33).bool().to(self.device)
+        padding_mask = torch.ones(batch_size, self._model.backbone.max_seq_len).bool().to(self.device)
+        for i, (prompt_tokens, prompt_tokens_mask) in enumerate(prompts):
+            pad = prompt_len - prompt_tokens.size(0)
+            curr_tokens[i, pad:] = prompt_tokens
+            curr_tokens_mask[i, pad:] = prompt_tokens_mask
+            padding_mask[i, :pad] = False
+        curr_pos = torch.arange(0, prompt_len).unsqueeze(0).repeat(batch_size, 1).long().to(self.device)
+        sampling = SamplingParams.create(temperature, topk, batch_size, self.device)
+
+        samples = torch.zeros(max_audio_frames, batch_size, 32).long().to(self.device)
+        frame_tokens, frame_tokens_mask, frame_pos = self._frame_input_buffers(batch_size)
+        eos = torch.zeros(batch_size).bool().to(self.device)
+        num_frames = torch.full((batch_size,), max_audio_frames).long().to(self.device)
+        for frame in tqdm(range(max_audio_frames), desc=f"Generating audio (batch of {batch_size})"):
+            self._model.generate_frame(
+                curr_tokens,
+                curr_tokens_mask,
+                curr_pos,
+                temperature,
+                topk,
+                padding_mask=padding_mask,
+                out=samples[frame],
+                sampling=sampling,
+            )
+            # Rows that already hit EOS keep sampling; their frames are dropped below.
+            new_eos = torch.all(samples[frame] == 0, dim=1) & ~eos
+            num_frames = torch.where(new_eos, frame, num_frames)
+            eos |= new_eos
+            if ((frame + 1) % self.eos_check_interval == 0 or frame + 1 == max_audio_frames) and eos.all():
+                break
+
+            frame_tokens[:, 0, :-1] = samples[frame]
+            if frame == 0:
+                frame_pos.copy_(curr_pos[:, -1:] + 1)
+                curr_tokens, curr_tokens_mask, curr_pos = frame_tokens, frame_tokens_mask, frame_pos
+            else:
+                frame_pos += 1
+
+        audios = []
+        num_frames = num_frames.tolist()
+        for i in range(batch_size):
+            if num_frames[i] == 0:
+                audios.append(torch.zeros(0, device=self.device))
+                continue
+            row_samples = samples[: num_frames[i], i]
+            audio = self._decode(row_samples.permute(1, 0).unsqueeze(0))
+            audios.append(self._watermark(audio))
+
+        return audios
+
+    def _ensure_cache_batch_size(self, batch_size: int) -> None:
+        # Reallocating the KV caches is cheap next to a generation, but not free, so keep the current size
+        # as long as it matches.
+        if self._model.cache_batch_size != batch_size:
+            self._model.setup_caches(batch_size)
+
+    def _tokenize_prompt(
+        self, text: str, speaker: int, context: List[Segment], stats: Optional[GenerationStats] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor, int]:
+        """
+        Returns:
+            (seq_len, 33), (seq_len, 33), number of trailing frames that belong to ``text``
+        """
         tokens, tokens_mask = [], []
         for segment in context:
-            segment_tokens, segment_tokens_mask = self._tokenize_segment(segment)
+            segment_tokens, segment_tokens_mask = self._tokenize_segment(segment, stats)
             tokens.append(segment_tokens)
             tokens_mask.append(segment_tokens_mask)
 
@@ -138,47 +687,136 @@ class Generator:
 
         prompt_tokens = torch.cat(tokens, dim=0).long().to(self.device)
         prompt_tokens_mask = torch.cat(tokens_mask, dim=0).bool().to(self.device)
+        return prompt_tokens, prompt_tokens_mask, gen_segment_tokens.size(0)
 
-        samples = []
-        curr_tokens = prompt_tokens.unsqueeze(0)
-        curr_tokens_mask = prompt_tokens_mask.unsqueeze(0)
-        curr_pos = torch.arange(0, prompt_tokens.size(0)).unsqueeze(0).long().to(self.device)
+    def _watermark(self, audio: torch.Tensor) -> torch.Tensor:
+        return self._submit_watermark(audio).result()
 
-        max_seq_len = 2048 - max_audio_frames
-        if curr_tokens.size(1) >= max_seq_len:
-            raise ValueError(f"Inputs too long, must be below max_seq_len - max_audio_frames: {max_seq_len}")
+    def _submit_watermark(self, audio: torch.Tensor) -> "Future[torch.Tensor]":
+        """
+        Watermark a whole (num_samples,) clip on the watermark stage. Clips longer than ``decode_chunk_frames``
+        frames go through ``StreamingWatermark`` block by block with ``watermark_margin_ms`` of context and
+        lookahead, so the watermarker never sees more than one block and its margins at once. Like the decode
+        warm-up, the margin is not measured against silentcipher's receptive field;
+        ``benchmarks/bench_decode_memory.py --watermark`` compares the two paths.
+        """
+        block = self.decode_chunk_frames * self._audio_tokenizer.frame_size
+        if audio.numel() <= block:
+            return self._watermark_stage.submit(audio)
+
+        margin = int(self.watermark_margin_ms * self.sample_rate / 1000)
+        streaming = StreamingWatermark(self._watermark_stage, margin, margin)
+        blocks = []
+        for start in range(0, audio.numel(), block):
+            blocks.extend(streaming.push(audio[start : start + block]))
+        blocks.extend(streaming.flush())
+
+        watermarked: "Future[torch.Tensor]" = Future()
+
+        def resolve(_: "Future[torch.Tensor]") -> None:
+            # The stage completes blocks in order, so the last one is done after all the others.
+            errors = [f.exception() for f in blocks if f.exception() is not None]
+            if errors:
+                watermarked.set_exception(errors[0])
+            else:
+                watermarked.set_result(torch.cat([f.result() for f in blocks]))
+
+        blocks[-1].add_done_callback(resolve)
+        return watermarked
+
+    def _elapsed_ms(self, start: float) -> float:
+        """Milliseconds since ``start`` (a ``time.perf_counter()`` value), after waiting for queued GPU work."""
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        return (time.perf_counter() - start) * 1000
+
+    def _start_stats(self) -> GenerationStats:
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.last_stats = GenerationStats()
+        self._sample_memory(self.last_stats)
+        return self.last_stats
+
+    def _sample_memory(self, stats: GenerationStats) -> None:
+        if self.device.type != "cuda":
+            stats.peak_memory_mb = max(stats.peak_memory_mb, _rss_mb())
+
+    def _finish_stats(self, stats: GenerationStats) -> None:
+        if self.device.type == "cuda":
+            stats.peak_memory_mb = torch.cuda.max_memory_allocated(self.device) / 2**20
+        else:
+            self._sample_memory(stats)
 
-        est_steps = len(text.split()) * 3  # Rough estimate of 3 steps per word
-        with tqdm(total=est_steps, desc="Generating audio") as pbar:
-            for _ in range(max_audio_frames):
-                sample = self._model.generate_frame(curr_tokens, curr_tokens_mask, curr_pos, temperature, topk)
-                if torch.all(sample == 0):
-                    break  # eos
 
-                samples.append(sample)
+def load_csm_1b(device: str = "cuda") -> Generator:
+    model = Model.from_pretrained("sesame/csm-1b")
+    model.to(device=device, dtype=torch.bfloat16)
+
+    generator = Generator(model)
+    return generator
 
-                curr_tokens = torch.cat([sample, torch.zeros(1, 1).long().to(self.device)], dim=1).unsqueeze(1)
-                curr_tokens_mask = torch.cat(
-                    [torch.ones_like(sample).bool(), torch.zeros(1, 1).bool().to(self.device)], dim=1
-                ).unsqueeze(1)
-                curr_pos = curr_pos[:, -1:] + 1
-                pbar.update(1)
 
-        audio = self._audio_tokenizer.decode(torch.stack(samples).permute(1, 2, 0)).squeeze(0).squeeze(0)
+def _resolve_checkpoint(checkpoint_path: Optional[str]) -> str:
+    if checkpoint_path is None:
+        checkpoint_path = os.path.join("models", "model.safetensors")
+    if not os.path.exists(checkpoint_path):
+        print("Local checkpoint not found. Downloading from Hugging Face...")
+        checkpoint_path = hf_hub_download(repo_id="sesame/csm-1b", filename="model.safetensors")
+    return checkpoint_path
 
-        # This applies an imperceptible watermark to identify audio as AI-generated.
-        # Watermarking ensures transparency, dissuades misuse, and enables traceability.
-        # Please be a responsible AI citizen and keep the watermarking in place.
-        # If using CSM 1B in another application, use your own private key and keep it secret.
-        audio, wm_sample_rate = watermark(self._watermarker, audio, self.sample_rate, CSM_1B_GH_WATERMARK)
-        audio = torchaudio.functional.resample(audio, orig_freq=wm_sample_rate, new_freq=self.sample_rate)
 
-        return audio
+def load_generator(
+    checkpoint_path: Optional[str] = None,
+    device: str = "cuda",
+    dtype: torch.dtype = torch.bfloat16,
+    quantize: Optional[str] = None,
+    **generator_kwargs,
+) -> Generator:
+    """
+    Load the model, text tokenizer, Mimi and the watermarker concurrently and build a ``Generator``.
 
+    ``checkpoint_path`` defaults to ``models/model.safetensors``, downloaded from Hugging Face when
+    missing. ``quantize`` ("int8" or "int4") applies weight-only quantization, see ``quantization.load_model``.
+    Prints how long each component took.
+    """
 
-def load_csm_1b(device: str = "cuda") -> Generator:
-    model = Model.from_pretrained("sesame/csm-1b")
-    model.to(device=device, dtype=torch.bfloat16)
+    def load_model() -> Model:
+        checkpoint = _resolve_checkpoint(checkpoint_path)
+        if quantize is None:
+            return load_model_from_checkpoint(checkpoint, device=device, dtype=dtype)
+        # torchao is only imported when quantization is asked for.
+        from quantization import load_model as load_quantized
+
+        return load_quantized(checkpoint, device=device, dtype=dtype, quantize=quantize)
+
+    def timed(fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        return result, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        model_future = executor.submit(timed, load_model)
+        tokenizer_future = executor.submit(timed, load_llama3_tokenizer)
+        mimi_future = executor.submit(timed, load_mimi, device)
+        watermarker_future = executor.submit(timed, load_watermarker, device)
+
+        model, model_time = model_future.result()
+        text_tokenizer, tokenizer_time = tokenizer_future.result()
+        mimi, mimi_time = mimi_future.result()
+        watermarker, watermarker_time = watermarker_future.result()
+
+    generator, generator_time = timed(
+        Generator,
+        model,
+        text_tokenizer=text_tokenizer,
+        audio_tokenizer=mimi,
+        watermarker=watermarker,
+        **generator_kwargs,
+    )
 
-    generator = Generator(model)
+    print(
+        f"Startup {time.perf_counter() - start:.2f}s: model {model_time:.2f}s, text tokenizer {tokenizer_time:.2f}s, "
+        f"mimi {mimi_time:.2f}s, watermarker {watermarker_time:.2f}s, caches {generator_time:.2f}s"
+    )
     return generator
\ No newline at end of file
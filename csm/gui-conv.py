@@ -1,25 +1,28 @@
 import os
-import torch
-import torchaudio
+import time
 import gradio as gr
 from huggingface_hub import hf_hub_download
-from generator import load_csm_1b, Segment
+from audio_io import load_audio
+from autotune import cached_or_default
+from audio_sink import open_sink
+from generator import load_csm_1b, Segment, load_generator
+from text_processing import preprocess_text
+from voice_pack import load_voice_pack
 from dataclasses import dataclass
-from safetensors.torch import load_file
-from generator import Segment, Generator
-from models import Model, ModelArgs
 # Disable Triton compilation
 os.environ["NO_TORCH_COMPILE"] = "1"
 
-# Device selection
-if torch.backends.mps.is_available():
-    device = "mps"
-elif torch.cuda.is_available():
-    device = "cuda"
-else:
-    device = "cpu"
+# Device, dtype and CPU thread count as measured by python autotune.py, or the untuned defaults
+tuned = cached_or_default()
+tuned.apply()
+device = tuned.device
 
-print(f"Using device: {device}")
+print(f"Using device: {device} ({tuned.dtype})")
+
+# Finished conversations are written here, turn by turn.
+OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "outputs")
+# CSM_VERBOSE=1 prints each turn's generation timings.
+VERBOSE = os.environ.get("CSM_VERBOSE") == "1"
 
 # Load default prompts
 SPEAKER_PROMPTS = {
@@ -44,27 +47,13 @@ print("Loading CSM model...")
 
 
 def load_model(device=device):
-    model_path = os.path.join("models", "model.safetensors")
-    if not os.path.exists(model_path):
-        print("Downloading model from Hugging Face...")
-        model_path = hf_hub_download(repo_id="sesame/csm-1b", filename="model.safetensors")
-    
-    model_args = ModelArgs(
-        backbone_flavor="llama-1B",
-        decoder_flavor="llama-100M",
-        text_vocab_size=128256,
-        audio_vocab_size=2051,
-        audio_num_codebooks=32,
-    )
-    
-    model = Model(model_args).to(device=device, dtype=torch.bfloat16)
-    state_dict = load_file(model_path, device=device)
-    model.load_state_dict(state_dict)
-    return Generator(model)
+    return load_generator(os.path.join("models", "model.safetensors"), device=device, dtype=tuned.torch_dtype)
 
 # Initialize generator globally
 print("Loading CSM model...")
 generator = load_model()
+# Prebuilt Mimi codes of the bundled voices (python voice_pack.py), if built.
+voice_pack = load_voice_pack()
 
 #generator = load_csm_1b(device)
 
@@ -104,44 +93,19 @@ def load_audio_transcript_pair(selected_pair):
         return None, ""
 
 def prepare_prompt(text: str, speaker: int, audio_path: str) -> Segment:
-    # Load audio and convert to mono if needed
-    audio_tensor, sample_rate = torchaudio.load(audio_path)
-    
-    # Convert to mono if stereo
-    if audio_tensor.shape[0] > 1:
-        audio_tensor = torch.mean(audio_tensor, dim=0, keepdim=True)
-    
-    # Resample if needed
-    audio_tensor = torchaudio.functional.resample(
-        audio_tensor.squeeze(0),
-        orig_freq=sample_rate,
-        new_freq=generator.sample_rate
-    )
-    
-    return Segment(text=text, speaker=speaker, audio=audio_tensor)
+    # Packed voices skip loading, resampling and encoding the reference audio
+    codes = voice_pack.codes_for_file(audio_path) if voice_pack is not None else None
+    if codes is not None:
+        return Segment(text=text, speaker=speaker, audio=None, codes=codes)
 
-def create_silence(duration_ms: int, sample_rate: int, device: str) -> torch.Tensor:
-    """Create a silence tensor of specified duration"""
-    num_samples = int(duration_ms * sample_rate / 1000)
-    return torch.zeros(num_samples, device=device)
-    
-def preprocess_text(text):
-    lines = text.split('\n')
-    cleaned_lines = []
-    for line in lines:
-        line = line.strip()
-        while line and line[0] in ',-._/@#*%$().':
-            line = line[1:]
-        line = line.strip()
-        if line:
-            cleaned_lines.append(line)
-    text = ', '.join(cleaned_lines)
-    text = text.replace(';', ', ').replace(':', ', ')
-    text = text.replace("'", "").replace("’", "")
-    return text
-    
+    # Decoded, downmixed and resampled once per file, then served from the audio cache
+    audio_tensor = load_audio(audio_path, generator.sample_rate)
+    return Segment(text=text, speaker=speaker, audio=audio_tensor)
 
-def generate_conversation(speaker1_audio, speaker1_text, speaker2_audio, speaker2_text, conversation_text):
+def generate_conversation(
+    speaker1_audio, speaker1_text, speaker2_audio, speaker2_text, conversation_text, output_format="wav",
+    progress=gr.Progress()
+):
     try:
         # Validate inputs
         if not all([speaker1_audio, speaker1_text, speaker2_audio, speaker2_text, conversation_text]):
@@ -166,43 +130,49 @@ def generate_conversation(speaker1_audio, speaker1_text, speaker2_audio, speaker
         if not conversation:
             return None, "Error: Conversation text is empty"
 
-        # Generate each utterance
+        # Generate each utterance. Earlier turns go back in as context as the codes the model sampled,
+        # so they are never re-encoded; decoding and watermarking only produce the output audio.
         generated_segments = []
         prompt_segments = [prompt1, prompt2]
-        
-        # Create silence tensor
-        silence = create_silence(500, generator.sample_rate, device)
-        
-        for i, utterance in enumerate(conversation, 1):
-            print(f"\nProcessing [{i}/{len(conversation)}] Speaker {utterance['speaker_id'] + 1}: {utterance['text']}")
-            
-            audio_tensor = generator.generate(
-                text=utterance['text'],
-                speaker=utterance['speaker_id'],
-                context=prompt_segments + generated_segments,
-                max_audio_length_ms=15_000,
-                temperature=0.85
-            )
-            audio_tensor = audio_tensor.to(device)
-            generated_segments.append(
-                Segment(text=utterance['text'], 
-                       speaker=utterance['speaker_id'], 
-                       audio=audio_tensor)
-            )
-            
-            gr.Info(f"Generated {i}/{len(conversation)}: {utterance['text'][:50]}...")
-        
-        # Concatenate all generations with silence
-        all_audio_segments = []
-        for i, seg in enumerate(generated_segments):
-            all_audio_segments.append(seg.audio)
-            if i < len(generated_segments) - 1:
-                all_audio_segments.append(silence)
-                
-        all_audio = torch.cat(all_audio_segments, dim=0)
-        
-        return (generator.sample_rate, all_audio.cpu().numpy()), "Generation completed successfully!"
-        
+
+        # Each turn is appended to the file as soon as it is watermarked, with 500 ms of silence between
+        # turns, so memory holds one turn at a time and finished turns are on disk if generation fails.
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        output_path = os.path.join(OUTPUT_DIR, f"conversation-{time.strftime('%Y%m%d-%H%M%S')}.{output_format}")
+        with open_sink(output_path, generator.sample_rate, gap_ms=500) as sink:
+            pending = None
+            for i, utterance in enumerate(conversation, 1):
+                print(f"\nProcessing [{i}/{len(conversation)}] Speaker {utterance['speaker_id'] + 1}: {utterance['text']}")
+
+                codes = generator.generate_codes(
+                    text=utterance['text'],
+                    speaker=utterance['speaker_id'],
+                    context=prompt_segments + generated_segments,
+                    max_audio_length_ms=15_000,
+                    temperature=0.85,
+                    on_progress=lambda done, total: progress(
+                        (i - 1 + done / total) / len(conversation), desc=f"Utterance {i}/{len(conversation)}"
+                    ),
+                )
+                if VERBOSE:
+                    print(generator.last_stats.summary())
+                generated_segments.append(
+                    Segment(text=utterance['text'],
+                           speaker=utterance['speaker_id'],
+                           audio=None,
+                           codes=codes)
+                )
+                # Watermarking runs in the background while the next turn is generated; the previous
+                # turn is written meanwhile.
+                if pending is not None:
+                    sink.append(pending.result())
+                pending = generator.decode_codes(codes)
+
+                gr.Info(f"Generated {i}/{len(conversation)}: {utterance['text'][:50]}...")
+            sink.append(pending.result())
+
+        return output_path, f"Generation completed successfully! Saved to {output_path}"
+
     except Exception as e:
         import traceback
         return None, f"Error: {str(e)}\n{traceback.format_exc()}"
@@ -257,13 +227,20 @@ def create_interface():
             placeholder="Hello, how are you?\nI'm good, thanks! How about you?\nI'm doing great!"
         )
         
+        # FLAC is encoded with soundfile (in requirements.txt)
+        output_format = gr.Radio(
+            choices=["wav", "flac"],
+            value="wav",
+            label="Output Format"
+        )
+        
         # Generate button
         generate_btn = gr.Button("🎨 Generate Conversation", variant="primary")
         
         # Output audio
         output_audio = gr.Audio(
             label="Generated Conversation",
-            type="numpy"
+            type="filepath"
         )
         
         # Add status output
@@ -303,7 +280,8 @@ def create_interface():
                 speaker1_text,
                 speaker2_audio,
                 speaker2_text,
-                conversation_input
+                conversation_input,
+                output_format
             ],
             outputs=[output_audio, status_output]
         )
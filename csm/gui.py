@@ -1,13 +1,11 @@
 import os
-import torch
-import torchaudio
 import gradio as gr
 import subprocess
-import tempfile
-from huggingface_hub import hf_hub_download
-from safetensors.torch import load_file
-from generator import Segment, Generator
-from models import Model, ModelArgs
+from audio_io import load_audio
+from autotune import cached_or_default
+from generator import Segment, load_generator
+from text_processing import preprocess_text
+from voice_pack import load_voice_pack
 from tqdm import tqdm
 import re
 
@@ -24,60 +22,21 @@ custom_theme = gr.themes.Soft(
     ]
 )
 
-# Device selection
-if torch.backends.mps.is_available():
-    device = "mps"
-elif torch.cuda.is_available():
-    device = "cuda"
-else:
-    device = "cpu"
+# Device, dtype and CPU thread count as measured by python autotune.py, or the untuned defaults
+tuned = cached_or_default()
+tuned.apply()
+device = tuned.device
 
-print(f"Using device: {device}")
+print(f"Using device: {device} ({tuned.dtype})")
 
 def load_model(device=device):
-    model_path = os.path.join("models", "model.safetensors")
-    if not os.path.exists(model_path):
-        print("Downloading model from Hugging Face...")
-        model_path = hf_hub_download(repo_id="sesame/csm-1b", filename="model.safetensors")
-    
-    model_args = ModelArgs(
-        backbone_flavor="llama-1B",
-        decoder_flavor="llama-100M",
-        text_vocab_size=128256,
-        audio_vocab_size=2051,
-        audio_num_codebooks=32,
-    )
-    
-    model = Model(model_args).to(device=device, dtype=torch.bfloat16)
-    state_dict = load_file(model_path, device=device)
-    model.load_state_dict(state_dict)
-    return Generator(model)
+    return load_generator(os.path.join("models", "model.safetensors"), device=device, dtype=tuned.torch_dtype)
 
 # Initialize generator globally
 print("Loading CSM model...")
 generator = load_model()
-
-def preprocess_text(text):
-    # Remove punctuation at start of each line
-    lines = text.split('\n')
-    cleaned_lines = []
-    for line in lines:
-        line = line.strip()  # Remove spaces at start/end
-        # Remove punctuation from start of line
-        while line and line[0] in ',-._/@#*%$().':
-            line = line[1:]
-        line = line.strip()  # Clean again after punctuation removal
-        if line:  # Only add non-empty lines
-            cleaned_lines.append(line)
-    
-    # Join lines and replace specific punctuation
-    text = ', '.join(cleaned_lines)
-    # Replace semicolons and colons with comma space
-    text = text.replace(';', ', ').replace(':', ', ')
-    text = text.replace("'", "").replace("’", "")
-
-    return text
-
+# Prebuilt Mimi codes of the bundled voices (python voice_pack.py), if built.
+voice_pack = load_voice_pack()
 
 
 def process_voice_cloning(ref_audio, ref_transcript, text_to_generate, process_text_enabled):
@@ -87,48 +46,26 @@ def process_voice_cloning(ref_audio, ref_transcript, text_to_generate, process_t
             ref_transcript = preprocess_text(ref_transcript)
             text_to_generate = preprocess_text(text_to_generate)
 
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Load audio directly from file path
-            audio_tensor, sample_rate = torchaudio.load(ref_audio)
-            
-            # Convert to mono if needed
-            if audio_tensor.shape[0] > 1:
-                audio_tensor = torch.mean(audio_tensor, dim=0, keepdim=True)
-            
-            # Resample to match model's sample rate
-            audio_tensor = torchaudio.functional.resample(
-                audio_tensor.squeeze(0),
-                orig_freq=sample_rate,
-                new_freq=generator.sample_rate
-            )
-            
-            # Create context segment
-            context_segment = Segment(
-                text=ref_transcript,
-                speaker=0,
-                audio=audio_tensor
-            )
-            
-            # Generate audio using the same parameters as gen3.py
-            generated_audio = generator.generate(
-                text=text_to_generate,
-                speaker=0,
-                context=[context_segment],
-                max_audio_length_ms=50_000
-            )
-            
-            # Save output
-            output_path = os.path.join(temp_dir, "output.wav")
-            torchaudio.save(
-                output_path,
-                generated_audio.unsqueeze(0).cpu(),
-                generator.sample_rate
-            )
-            
-            # Read the saved audio file to return it
-            generated_audio_data, _ = torchaudio.load(output_path)
-            return (generator.sample_rate, generated_audio_data.squeeze(0).numpy()), "Voice cloning completed successfully!"
-            
+        # Packed voices skip loading, resampling and encoding the reference audio
+        codes = voice_pack.codes_for_file(ref_audio) if voice_pack is not None else None
+        if codes is not None:
+            context_segment = Segment(text=ref_transcript, speaker=0, audio=None, codes=codes)
+        else:
+            # Decoded, downmixed and resampled once per file, then served from the audio cache
+            audio_tensor = load_audio(ref_audio, generator.sample_rate)
+            context_segment = Segment(text=ref_transcript, speaker=0, audio=audio_tensor)
+
+        # Generate audio using the same parameters as gen3.py
+        generated_audio = generator.generate(
+            text=text_to_generate,
+            speaker=0,
+            context=[context_segment],
+            max_audio_length_ms=50_000
+        )
+
+        # Gradio takes the array directly, no need for a round trip through a wav file
+        return (generator.sample_rate, generated_audio.cpu().numpy()), "Voice cloning completed successfully!"
+
     except Exception as e:
         import traceback
         return None, f"Error: {str(e)}\n{traceback.format_exc()}"
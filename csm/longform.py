@@ -0,0 +1,135 @@
+import re
+from typing import List, Optional
+
+import torch
+from generator import Generator, Segment
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_CLAUSE_END = re.compile(r"(?<=[,;:])\s+")
+
+# Backbone positions available to one generate() call (see Model.setup_caches / llama3_2_1B).
+MAX_SEQ_LEN = 2048
+
+
+def split_text(text: str, max_chars: int = 250) -> List[str]:
+    """
+    Split text into chunks of whole sentences, each at most ``max_chars`` long where possible.
+
+    Sentences longer than ``max_chars`` are broken at clause punctuation, then at word boundaries.
+    """
+    pieces = []
+    for sentence in _SENTENCE_END.split(" ".join(text.split())):
+        if len(sentence) <= max_chars:
+            pieces.append(sentence)
+            continue
+        for clause in _CLAUSE_END.split(sentence):
+            while len(clause) > max_chars:
+                cut = clause.rfind(" ", 0, max_chars)
+                if cut <= 0:
+                    cut = max_chars
+                pieces.append(clause[:cut].strip())
+                clause = clause[cut:].strip()
+            if clause:
+                pieces.append(clause)
+
+    chunks: List[str] = []
+    for piece in pieces:
+        if chunks and len(chunks[-1]) + 1 + len(piece) <= max_chars:
+            chunks[-1] = f"{chunks[-1]} {piece}"
+        elif piece:
+            chunks.append(piece)
+    return chunks
+
+
+def crossfade_concat(clips: List[torch.Tensor], sample_rate: int, crossfade_ms: float = 20) -> torch.Tensor:
+    """Concatenate 1D clips, blending each boundary with a linear crossfade of ``crossfade_ms``."""
+    clips = [clip for clip in clips if clip.numel() > 0]
+    if not clips:
+        return torch.zeros(0)
+
+    fade = int(crossfade_ms * sample_rate / 1000)
+    total = sum(clip.numel() for clip in clips)
+    overlaps = [min(fade, prev.numel(), nxt.numel()) for prev, nxt in zip(clips, clips[1:])]
+    out = torch.zeros(total - sum(overlaps), dtype=clips[0].dtype, device=clips[0].device)
+
+    offset = 0
+    for i, clip in enumerate(clips):
+        clip = clip.to(out.device)
+        overlap = overlaps[i - 1] if i > 0 else 0
+        if overlap:
+            ramp = torch.linspace(0, 1, overlap, dtype=out.dtype, device=out.device)
+            out[offset - overlap : offset] = out[offset - overlap : offset] * (1 - ramp) + clip[:overlap] * ramp
+        out[offset : offset + clip.numel() - overlap] = clip[overlap:]
+        offset += clip.numel() - overlap
+    return out
+
+
+def _num_context_tokens(generator: Generator, segments: List[Segment]) -> int:
+    # Cheap after the first call: segment tokens come from the generator's segment cache.
+    return sum(generator._tokenize_segment(segment)[0].size(0) for segment in segments)
+
+
+def generate_long(
+    generator: Generator,
+    text: str,
+    speaker: int,
+    context: List[Segment],
+    history_chunks: int = 2,
+    max_chunk_chars: int = 250,
+    max_chunk_audio_ms: float = 20_000,
+    crossfade_ms: float = 20,
+    temperature: float = 0.9,
+    topk: int = 50,
+    prefix_cache: Optional[str] = None,
+) -> torch.Tensor:
+    """
+    Synthesize text of any length by generating it sentence chunk by sentence chunk.
+
+    Each chunk is conditioned on ``context`` (the reference voice) plus the last ``history_chunks``
+    generated chunks, dropping the oldest history first whenever the prompt would not leave room for
+    ``max_chunk_audio_ms`` of audio. Peak sequence length is therefore bounded by one chunk, not by
+    the document.
+
+    ``prefix_cache`` is passed to ``Generator.generate`` for chunks conditioned on ``context`` alone
+    (the first chunk, or every chunk with ``history_chunks=0``), so calls sharing a voice reuse its
+    backbone cache.
+
+    Returns:
+        (num_samples,) waveform at ``generator.sample_rate``
+    """
+    max_audio_frames = int(max_chunk_audio_ms / 80)
+    budget = MAX_SEQ_LEN - max_audio_frames
+    base_tokens = _num_context_tokens(generator, context)
+
+    chunks = split_text(text, max_chunk_chars)
+    # One tokenizer call for the whole document; each chunk's text frames are then reused as prompt and history.
+    generator.pretokenize(chunks, speaker)
+
+    history: List[Segment] = []
+    clips = []
+    for chunk in chunks:
+        # Leave headroom for the chunk's own text frames (at most one token per character plus markers).
+        text_budget = len(chunk) + 8
+        while history and base_tokens + _num_context_tokens(generator, history) + text_budget >= budget:
+            history.pop(0)
+        if base_tokens + text_budget >= budget:
+            raise ValueError(f"Reference context is too long for max_chunk_audio_ms={max_chunk_audio_ms}")
+
+        codes = generator.generate_codes(
+            text=chunk,
+            speaker=speaker,
+            context=context + history,
+            max_audio_length_ms=max_chunk_audio_ms,
+            temperature=temperature,
+            topk=topk,
+            prefix_cache=prefix_cache if not history else None,
+        )
+        # Watermarked on the background worker while the next chunk is generated.
+        clips.append(generator.decode_codes(codes))
+
+        if history_chunks > 0:
+            # History is conditioned on the sampled codes directly, without a Mimi re-encode.
+            history.append(Segment(speaker=speaker, text=chunk, audio=None, codes=codes))
+            history = history[-history_chunks:]
+
+    return crossfade_concat([clip.result() for clip in clips], generator.sample_rate, crossfade_ms)
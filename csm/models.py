@@ -1,10 +1,15 @@
 from dataclasses import dataclass
+from typing import Dict, List, Optional, Union
 
 import torch
 import torch.nn as nn
 import torchtune
 from huggingface_hub import PyTorchModelHubMixin
+from paged_cache import PagedKVCache, PagedKVPool
+from safetensors.torch import load_file
+from sampling import SamplingParams, sample_topk, sample_topk_rows
 from torchtune.models import llama3_2
+from torchtune.modules.common_utils import delete_kv_caches
 
 
 def llama3_2_1B() -> torchtune.modules.transformer.TransformerDecoder:
@@ -39,9 +44,27 @@ def llama3_2_100M() -> torchtune.modules.transformer.TransformerDecoder:
     )
 
 
+def llama3_2_tiny() -> torchtune.modules.transformer.TransformerDecoder:
+    """A few-MB flavor for running the pipeline with random weights, e.g. in benchmarks and local server tests."""
+    return llama3_2.llama3_2(
+        vocab_size=128_256,
+        num_layers=2,
+        num_heads=4,
+        num_kv_heads=2,
+        embed_dim=128,
+        max_seq_len=2048,
+        intermediate_dim=256,
+        attn_dropout=0.0,
+        norm_eps=1e-5,
+        rope_base=500_000,
+        scale_factor=32,
+    )
+
+
 FLAVORS = {
     "llama-1B": llama3_2_1B,
     "llama-100M": llama3_2_100M,
+    "llama-tiny": llama3_2_tiny,
 }
 
 
@@ -69,22 +92,14 @@ def _index_causal_mask(mask: torch.Tensor, input_pos: torch.Tensor):
     return r
 
 
-def _multinomial_sample_one_no_sync(probs):  # Does multinomial sampling without a cuda synchronization
-    q = torch.empty_like(probs).exponential_(1)
-    return torch.argmax(probs / q, dim=-1, keepdim=True).to(dtype=torch.int)
-
-
-def sample_topk(logits: torch.Tensor, topk: int, temperature: float):
-    logits = logits / temperature
-
-    filter_value: float = -float("Inf")
-    indices_to_remove = logits < torch.topk(logits, topk)[0][..., -1, None]
-    scores_processed = logits.masked_fill(indices_to_remove, filter_value)
-    scores_processed = torch.nn.functional.log_softmax(scores_processed, dim=-1)
-    probs = torch.nn.functional.softmax(scores_processed, dim=-1)
+@dataclass
+class BackboneCacheSnapshot:
+    """Backbone KV cache contents for the first ``length`` positions of one sequence."""
 
-    sample_token = _multinomial_sample_one_no_sync(probs)
-    return sample_token
+    length: int
+    # one (1, num_heads, length, head_dim) tensor per backbone layer
+    keys: List[torch.Tensor]
+    values: List[torch.Tensor]
 
 
 @dataclass
@@ -116,18 +131,74 @@ class Model(
         self.projection = nn.Linear(backbone_dim, decoder_dim, bias=False)
         self.codebook0_head = nn.Linear(backbone_dim, config.audio_vocab_size, bias=False)
         self.audio_head = nn.Parameter(torch.empty(config.audio_num_codebooks - 1, decoder_dim, config.audio_vocab_size))
+        # Set by split_audio_head: the same weights as one nn.Linear per codebook, so they can be quantized.
+        self.audio_heads: Optional[nn.ModuleList] = None
+        # Set by setup_paged_caches: the block pool behind the backbone's paged KV caches.
+        self.kv_pool: Optional[PagedKVPool] = None
 
     def setup_caches(self, max_batch_size: int) -> torch.Tensor:
-        """Setup KV caches and return a causal mask."""
+        """Setup KV caches and return a causal mask. Existing caches are reallocated for the new batch size."""
         dtype = next(self.parameters()).dtype
         device = next(self.parameters()).device
 
+        self._delete_caches()
         with device:
             self.backbone.setup_caches(max_batch_size, dtype)
             self.decoder.setup_caches(max_batch_size, dtype, decoder_max_seq_len=self.config.audio_num_codebooks)
 
         self.register_buffer("backbone_causal_mask", _create_causal_mask(self.backbone.max_seq_len, device))
         self.register_buffer("decoder_causal_mask", _create_causal_mask(self.config.audio_num_codebooks, device))
+        self.cache_batch_size = max_batch_size
+        self._setup_decoder_step_buffers(max_batch_size, device)
+
+    def setup_paged_caches(self, max_batch_size: int, num_blocks: int, block_size: int = 16) -> PagedKVPool:
+        """
+        Give the backbone paged KV caches backed by one pool of ``num_blocks`` blocks of ``block_size``
+        positions, shared by up to ``max_batch_size`` rows (see paged_cache.py). The decoder keeps its dense
+        per-row cache, which only holds one frame.
+
+        Every backbone pass must be laid out with ``PagedKVPool.prepare``, which also provides the
+        attention mask, so ``padding_mask`` is not used. ``setup_caches`` switches back to dense caches.
+        """
+        dtype = next(self.parameters()).dtype
+        device = next(self.parameters()).device
+
+        self._delete_caches()
+        self.kv_pool = PagedKVPool(num_blocks, block_size, device)
+        for layer in self.backbone.layers:
+            attn = layer.attn
+            attn.kv_cache = PagedKVCache(self.kv_pool, attn.num_heads, attn.num_kv_heads, attn.head_dim, dtype)
+            attn.cache_enabled = True
+        with device:
+            self.decoder.setup_caches(max_batch_size, dtype, decoder_max_seq_len=self.config.audio_num_codebooks)
+
+        self.register_buffer("decoder_causal_mask", _create_causal_mask(self.config.audio_num_codebooks, device))
+        # Not a valid batch size for Generator, which sets up dense caches again before its next call.
+        self.cache_batch_size = 0
+        self._setup_decoder_step_buffers(max_batch_size, device)
+        return self.kv_pool
+
+    def _delete_caches(self) -> None:
+        if self.backbone.caches_are_setup():
+            delete_kv_caches(self.backbone)
+            delete_kv_caches(self.decoder)
+        self.kv_pool = None
+        # The dense backbone mask is max_seq_len x max_seq_len; paged caches build theirs per pass.
+        self.register_buffer("backbone_causal_mask", None)
+
+    def _setup_decoder_step_buffers(self, max_batch_size: int, device: torch.device) -> None:
+        """
+        Precompute the positions and masks of the codebook decoder loop.
+
+        They are identical for every frame: step 1 feeds [backbone_h, c0_embed] at positions [0, 1],
+        step i > 1 feeds c(i-1)_embed at position i.
+        """
+        num_codebooks = self.config.audio_num_codebooks
+        positions = [torch.arange(0, 2, device=device).unsqueeze(0).repeat(max_batch_size, 1)]
+        positions += [torch.full((max_batch_size, 1), i, device=device) for i in range(2, num_codebooks)]
+        self._decoder_step_pos = positions
+        self._decoder_step_masks = [_index_causal_mask(self.decoder_causal_mask, pos) for pos in positions]
+        self._decoder_cache_pos = torch.arange(0, self.decoder.decoder_max_cache_seq_len, device=device)
 
     def generate_frame(
         self,
@@ -136,13 +207,18 @@ class Model(
         input_pos: torch.Tensor,
         temperature: float,
         topk: int,
+        padding_mask: Optional[torch.Tensor] = None,
+        out: Optional[torch.Tensor] = None,
+        sampling: Optional[SamplingParams] = None,
     ) -> torch.Tensor:
         """
         Args:
             tokens: (batch_size, seq_len, audio_num_codebooks+1)
             tokens_mask: (batch_size, seq_len, audio_num_codebooks+1)
             input_pos: (batch_size, seq_len) positions for each token
-            mask: (batch_size, seq_len, max_seq_len
+            padding_mask: (batch_size, max_seq_len) False for cache positions a row must not attend to
+            out: optional (batch_size, audio_num_codebooks) buffer the samples are written into
+            sampling: per-row temperature and top-k; overrides ``temperature`` and ``topk`` when given
 
         Returns:
             (batch_size, audio_num_codebooks) sampled tokens
@@ -150,43 +226,140 @@ class Model(
         dtype = next(self.parameters()).dtype
         b, s, _ = tokens.size()
 
-        assert self.backbone.caches_are_enabled(), "backbone caches are not enabled"
-        curr_backbone_mask = _index_causal_mask(self.backbone_causal_mask, input_pos)
-        embeds = self._embed_tokens(tokens)
-        masked_embeds = embeds * tokens_mask.unsqueeze(-1)
-        h = masked_embeds.sum(dim=2)
-        h = self.backbone(h, input_pos=input_pos, mask=curr_backbone_mask).to(dtype=dtype)
+        h = self._backbone_forward(tokens, tokens_mask, input_pos, padding_mask)
+
+        if out is None:
+            out = torch.empty(b, self.config.audio_num_codebooks, dtype=torch.int, device=tokens.device)
 
         last_h = h[:, -1, :]
         c0_logits = self.codebook0_head(last_h)
-        c0_sample = sample_topk(c0_logits, topk, temperature)
-        c0_embed = self._embed_audio(0, c0_sample)
+        out[:, :1] = self._sample(c0_logits, topk, temperature, sampling)
+        c0_embed = self._embed_audio(0, out[:, :1])
 
         curr_h = torch.cat([last_h.unsqueeze(1), c0_embed], dim=1)
-        curr_sample = c0_sample.clone()
-        curr_pos = torch.arange(0, curr_h.size(1), device=curr_h.device).unsqueeze(0).repeat(curr_h.size(0), 1)
 
-        # Decoder caches must be reset every frame.
-        self.decoder.reset_caches()
+        # Decoder caches must be reset every frame. Rewinding the cache position is enough: stale
+        # entries sit behind the causal mask until this frame overwrites them.
+        self._rewind_decoder_caches()
         for i in range(1, self.config.audio_num_codebooks):
-            curr_decoder_mask = _index_causal_mask(self.decoder_causal_mask, curr_pos)
+            curr_pos = self._decoder_step_pos[i - 1][:b]
+            curr_decoder_mask = self._decoder_step_masks[i - 1][:b]
             decoder_h = self.decoder(self.projection(curr_h), input_pos=curr_pos, mask=curr_decoder_mask).to(
                 dtype=dtype
             )
-            ci_logits = torch.mm(decoder_h[:, -1, :], self.audio_head[i - 1])
-            ci_sample = sample_topk(ci_logits, topk, temperature)
-            ci_embed = self._embed_audio(i, ci_sample)
+            ci_logits = self._audio_head_logits(i - 1, decoder_h[:, -1, :])
+            out[:, i : i + 1] = self._sample(ci_logits, topk, temperature, sampling)
+            curr_h = self._embed_audio(i, out[:, i : i + 1])
 
-            curr_h = ci_embed
-            curr_sample = torch.cat([curr_sample, ci_sample], dim=1)
-            curr_pos = curr_pos[:, -1:] + 1
+        return out
+
+    def prefill(
+        self,
+        tokens: torch.Tensor,
+        tokens_mask: torch.Tensor,
+        input_pos: torch.Tensor,
+        padding_mask: Optional[torch.Tensor] = None,
+    ) -> None:
+        """
+        Run the backbone over a prompt to fill its KV cache without sampling.
 
-        return curr_sample
+        Args:
+            tokens: (batch_size, seq_len, audio_num_codebooks+1)
+            tokens_mask: (batch_size, seq_len, audio_num_codebooks+1)
+            input_pos: (batch_size, seq_len) positions for each token
+            padding_mask: (batch_size, max_seq_len) False for cache positions a row must not attend to
+        """
+        self._backbone_forward(tokens, tokens_mask, input_pos, padding_mask)
 
     def reset_caches(self):
         self.backbone.reset_caches()
         self.decoder.reset_caches()
 
+    def snapshot_backbone_cache(self, length: int) -> BackboneCacheSnapshot:
+        """Copy the first ``length`` cached positions of batch row 0 out of every backbone layer."""
+        keys, values = [], []
+        for layer in self.backbone.layers:
+            kv_cache = layer.attn.kv_cache
+            keys.append(kv_cache.k_cache[:1, :, :length].clone())
+            values.append(kv_cache.v_cache[:1, :, :length].clone())
+        return BackboneCacheSnapshot(length=length, keys=keys, values=values)
+
+    def restore_backbone_cache(self, snapshot: BackboneCacheSnapshot) -> None:
+        """
+        Load a snapshot into every batch row and move the cache position to ``snapshot.length``.
+
+        Positions past the snapshot keep stale values; the causal mask hides them until they are
+        overwritten, so the next forward pass must start at ``input_pos == snapshot.length``.
+        """
+        for layer, k, v in zip(self.backbone.layers, snapshot.keys, snapshot.values):
+            kv_cache = layer.attn.kv_cache
+            kv_cache.k_cache[:, :, : snapshot.length].copy_(k)
+            kv_cache.v_cache[:, :, : snapshot.length].copy_(v)
+            torch.add(
+                torch.arange(kv_cache.cache_pos.size(0), device=kv_cache.cache_pos.device),
+                snapshot.length,
+                out=kv_cache.cache_pos,
+            )
+        self.decoder.reset_caches()
+
+    def split_audio_head(self) -> None:
+        """Replace the stacked ``audio_head`` parameter with one ``nn.Linear`` per codebook in ``audio_heads``."""
+        if self.audio_heads is not None:
+            return
+        num_heads, decoder_dim, vocab_size = self.audio_head.shape
+        factory_kwargs = {"device": self.audio_head.device, "dtype": self.audio_head.dtype}
+        heads = nn.ModuleList()
+        for i in range(num_heads):
+            head = nn.Linear(decoder_dim, vocab_size, bias=False, **factory_kwargs)
+            if not self.audio_head.is_meta:
+                head.weight.data.copy_(self.audio_head.data[i].t())
+            heads.append(head)
+        self.audio_heads = heads
+        self.audio_head = None
+
+    def _audio_head_logits(self, codebook: int, h: torch.Tensor) -> torch.Tensor:
+        if self.audio_heads is not None:
+            return self.audio_heads[codebook](h)
+        return torch.mm(h, self.audio_head[codebook])
+
+    @staticmethod
+    def _sample(
+        logits: torch.Tensor, topk: int, temperature: float, sampling: Optional[SamplingParams]
+    ) -> torch.Tensor:
+        if sampling is not None:
+            return sample_topk_rows(logits, sampling)
+        return sample_topk(logits, topk, temperature)
+
+    def _rewind_decoder_caches(self) -> None:
+        # Unlike KVCache.reset this neither zeroes the cache nor reads its size back to the host.
+        for layer in self.decoder.layers:
+            layer.attn.kv_cache.cache_pos.copy_(self._decoder_cache_pos)
+
+    def _backbone_forward(
+        self,
+        tokens: torch.Tensor,
+        tokens_mask: torch.Tensor,
+        input_pos: torch.Tensor,
+        padding_mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        dtype = next(self.parameters()).dtype
+
+        assert self.backbone.caches_are_enabled(), "backbone caches are not enabled"
+        if self.kv_pool is not None:
+            # Laid out by PagedKVPool.prepare together with the block tables and write slots.
+            curr_backbone_mask = self.kv_pool.mask
+        else:
+            curr_backbone_mask = _index_causal_mask(self.backbone_causal_mask, input_pos)
+            if padding_mask is not None:
+                # Padded positions still attend to themselves so their (discarded) outputs stay finite;
+                # a fully masked row would turn into NaNs that leak through the value matmul.
+                curr_backbone_mask = curr_backbone_mask & padding_mask.unsqueeze(1)
+                curr_backbone_mask = curr_backbone_mask.scatter(2, input_pos.unsqueeze(-1), True)
+        embeds = self._embed_tokens(tokens)
+        masked_embeds = embeds * tokens_mask.unsqueeze(-1)
+        h = masked_embeds.sum(dim=2)
+        return self.backbone(h, input_pos=input_pos, mask=curr_backbone_mask).to(dtype=dtype)
+
     def _embed_audio(self, codebook: int, tokens: torch.Tensor) -> torch.Tensor:
         return self.audio_embeddings(tokens + codebook * self.config.audio_vocab_size)
 
@@ -201,3 +374,86 @@ class Model(
         )
 
         return torch.cat([audio_embeds, text_embeds], dim=-2)
+
+
+CSM_1B_ARGS = ModelArgs(
+    backbone_flavor="llama-1B",
+    decoder_flavor="llama-100M",
+    text_vocab_size=128256,
+    audio_vocab_size=2051,
+    audio_num_codebooks=32,
+)
+
+TINY_ARGS = ModelArgs(
+    backbone_flavor="llama-tiny",
+    decoder_flavor="llama-tiny",
+    text_vocab_size=128256,
+    audio_vocab_size=2051,
+    audio_num_codebooks=32,
+)
+
+
+def random_model(
+    config: ModelArgs = TINY_ARGS, device: Union[str, torch.device] = "cpu", dtype: torch.dtype = torch.float32
+) -> Model:
+    """A model with small random weights, allocated directly in ``dtype``. Produces noise, but exercises every path."""
+    with torch.device("meta"):
+        model = Model(config).to(dtype=dtype)
+    model = model.to_empty(device=device)
+    with torch.no_grad():
+        for param in model.parameters():
+            param.normal_(0, 0.02)
+    init_rope_buffers(model, device, dtype)
+    return model
+
+
+def load_model_from_checkpoint(
+    checkpoint_path: str,
+    config: ModelArgs = CSM_1B_ARGS,
+    device: Union[str, torch.device] = "cuda",
+    dtype: torch.dtype = torch.bfloat16,
+) -> Model:
+    """
+    Build a ``Model`` from a ``.safetensors`` or ``.pt`` checkpoint without allocating its weights twice.
+
+    The module tree is created on the meta device and the checkpoint tensors are assigned as the
+    parameters. Both formats are memory-mapped, so on CPU with a matching dtype the weights are
+    never copied at all.
+    """
+    if checkpoint_path.endswith(".pt"):
+        state_dict = torch.load(checkpoint_path, map_location="cpu", mmap=True, weights_only=True)
+    else:
+        state_dict = load_file(checkpoint_path, device="cpu")
+    return model_from_state_dict(state_dict, config, device, dtype)
+
+
+def model_from_state_dict(
+    state_dict: Dict[str, torch.Tensor],
+    config: ModelArgs = CSM_1B_ARGS,
+    device: Union[str, torch.device] = "cuda",
+    dtype: torch.dtype = torch.bfloat16,
+) -> Model:
+    """
+    Build a ``Model`` on the meta device and assign ``state_dict`` as its parameters. Tensors already
+    on ``device`` in ``dtype`` are used as they are, so e.g. shared-memory weights stay shared.
+    """
+    with torch.device("meta"):
+        model = Model(config)
+
+    state_dict = {k: v.to(device=device, dtype=dtype) for k, v in state_dict.items()}
+    model.load_state_dict(state_dict, assign=True)
+    init_rope_buffers(model, device, dtype)
+    return model
+
+
+def init_rope_buffers(model: Model, device: Union[str, torch.device], dtype: torch.dtype) -> None:
+    """
+    RoPE tables are non-persistent buffers, skipped while a model is on the meta device; build them
+    for real and give them the model dtype, as ``Model(...).to(dtype)`` would.
+    """
+    with torch.device(device):
+        for module in model.modules():
+            if hasattr(module, "rope_init"):
+                module.rope_init()
+                for name, buffer in module.named_buffers(recurse=False):
+                    setattr(module, name, buffer.to(dtype=dtype))
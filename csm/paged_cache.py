@@ -0,0 +1,164 @@
+"""
+Paged backbone KV cache for serving many concurrent sessions.
+
+The dense cache (``Model.setup_caches``) gives every batch row ``max_seq_len`` positions up front. Here
+every backbone layer instead stores its keys and values in one pool of fixed-size blocks shared by all
+rows. Each session holds a block table (the blocks of its positions, in order), takes a new block only
+when it grows past the last one, and returns all of them when it finishes. Memory is bounded by the
+tokens in use, and attention only reads as many positions as the longest active session has.
+
+Keys and values are stored once per KV head rather than once per query head, so with grouped-query
+attention (the 1B backbone has 8 KV heads for 32 query heads) a position also costs a quarter of the
+dense cache.
+
+    pool = model.setup_paged_caches(max_batch_size=16, num_blocks=1024, block_size=16)
+    input_pos = pool.prepare(sessions, new_tokens, seq_len)   # before every backbone pass
+    model.generate_frame(tokens, tokens_mask, input_pos, ...)
+"""
+
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence
+
+import torch
+import torch.nn as nn
+
+# Block 0 is never handed out: padded step positions write into it and empty rows read from it.
+SCRATCH_BLOCK = 0
+
+
+class PagedCacheFull(Exception):
+    """Raised by ``PagedKVPool.prepare`` when the pool has too few free blocks for the step."""
+
+
+@dataclass
+class PagedSession:
+    """Cache state of one sequence: its blocks in position order and how many positions are filled."""
+
+    blocks: List[int] = field(default_factory=list)
+    length: int = 0
+
+
+class PagedKVPool:
+    """
+    Block allocator plus the layout of the next backbone pass (block tables, write slots and attention
+    mask), which the ``PagedKVCache`` of every layer reads.
+    """
+
+    def __init__(self, num_blocks: int, block_size: int, device: torch.device):
+        if num_blocks < 2:
+            raise ValueError("num_blocks must be at least 2, block 0 is reserved")
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.device = device
+        self._free = list(range(num_blocks - 1, SCRATCH_BLOCK, -1))
+        self.peak_blocks_in_use = 0
+        self.block_tables: Optional[torch.Tensor] = None
+        self.write_slots: Optional[torch.Tensor] = None
+        self.mask: Optional[torch.Tensor] = None
+
+    @property
+    def num_free_blocks(self) -> int:
+        return len(self._free)
+
+    @property
+    def blocks_in_use(self) -> int:
+        return self.num_blocks - 1 - len(self._free)
+
+    def blocks_needed(self, session: PagedSession, new_tokens: int) -> int:
+        """Blocks ``session`` has to take to grow by ``new_tokens`` positions."""
+        total = -(-(session.length + new_tokens) // self.block_size)
+        return max(0, total - len(session.blocks))
+
+    def free(self, session: PagedSession) -> None:
+        self._free.extend(reversed(session.blocks))
+        session.blocks = []
+        session.length = 0
+
+    def prepare(
+        self, sessions: Sequence[Optional[PagedSession]], new_tokens: Sequence[int], seq_len: int
+    ) -> torch.Tensor:
+        """
+        Lay out a backbone pass of ``seq_len`` step positions in which row ``i`` appends ``new_tokens[i]``
+        tokens to ``sessions[i]``, right-aligned (the positions before them are padding). Empty rows are
+        None. Allocates the blocks the sessions grow into and advances their lengths.
+
+        Returns:
+            (batch_size, seq_len) RoPE positions for the pass
+        """
+        needed = sum(self.blocks_needed(s, n) for s, n in zip(sessions, new_tokens) if s is not None)
+        if needed > len(self._free):
+            raise PagedCacheFull(f"{needed} blocks needed, {len(self._free)} free")
+
+        batch_size = len(sessions)
+        # Padding sits at position 0, where it only attends to position 0, so its (discarded) outputs stay finite.
+        input_pos = torch.zeros(batch_size, seq_len, dtype=torch.long)
+        write_slots = torch.full((batch_size, seq_len), SCRATCH_BLOCK * self.block_size, dtype=torch.long)
+        for i, (session, n) in enumerate(zip(sessions, new_tokens)):
+            if session is None or n == 0:
+                continue
+            for _ in range(self.blocks_needed(session, n)):
+                session.blocks.append(self._free.pop())
+            positions = torch.arange(session.length, session.length + n)
+            blocks = torch.tensor(session.blocks)[positions // self.block_size]
+            input_pos[i, seq_len - n :] = positions
+            write_slots[i, seq_len - n :] = blocks * self.block_size + positions % self.block_size
+            session.length += n
+        self.peak_blocks_in_use = max(self.peak_blocks_in_use, self.blocks_in_use)
+
+        num_table_blocks = max([1] + [len(s.blocks) for s in sessions if s is not None])
+        block_tables = torch.full((batch_size, num_table_blocks), SCRATCH_BLOCK, dtype=torch.long)
+        for i, session in enumerate(sessions):
+            if session is not None and session.blocks:
+                block_tables[i, : len(session.blocks)] = torch.tensor(session.blocks)
+
+        kv_pos = torch.arange(num_table_blocks * self.block_size)
+        self.block_tables = block_tables.to(self.device)
+        self.write_slots = write_slots.to(self.device)
+        self.mask = (kv_pos.view(1, 1, -1) <= input_pos.unsqueeze(-1)).to(self.device)
+        return input_pos.to(self.device)
+
+
+class PagedKVCache(nn.Module):
+    """
+    Drop-in for torchtune's ``KVCache`` on one backbone attention layer, backed by ``PagedKVPool`` blocks.
+
+    ``update`` writes the new keys and values to the pool's write slots and returns every row's
+    positions gathered through its block table, padded to the longest table.
+    """
+
+    def __init__(self, pool: PagedKVPool, num_heads: int, num_kv_heads: int, head_dim: int, dtype: torch.dtype):
+        super().__init__()
+        self.pool = pool
+        self.q_per_kv = num_heads // num_kv_heads
+        # (num_blocks * block_size, num_kv_heads, head_dim): one row per cache position.
+        shape = (pool.num_blocks * pool.block_size, num_kv_heads, head_dim)
+        self.register_buffer("k_cache", torch.zeros(shape, dtype=dtype, device=pool.device), persistent=False)
+        self.register_buffer("v_cache", torch.zeros(shape, dtype=dtype, device=pool.device), persistent=False)
+
+    def reset(self) -> None:
+        # Sessions own the contents; freeing their blocks is what resets them.
+        pass
+
+    def update(self, k_val: torch.Tensor, v_val: torch.Tensor):
+        """
+        Args:
+            k_val, v_val: (batch_size, num_heads, seq_len, head_dim), the KV heads repeated per query head
+
+        Returns:
+            (batch_size, num_heads, num_table_blocks * block_size, head_dim) keys and values
+        """
+        b, _, s, d = k_val.shape
+        slots = self.pool.write_slots.reshape(-1)
+        # Every group of q_per_kv heads holds copies of one KV head; store one of each.
+        self.k_cache[slots] = k_val[:, :: self.q_per_kv].permute(0, 2, 1, 3).reshape(b * s, -1, d)
+        self.v_cache[slots] = v_val[:, :: self.q_per_kv].permute(0, 2, 1, 3).reshape(b * s, -1, d)
+        return self._gather(self.k_cache), self._gather(self.v_cache)
+
+    def _gather(self, cache: torch.Tensor) -> torch.Tensor:
+        block_size = self.pool.block_size
+        tables = self.pool.block_tables
+        b, num_table_blocks = tables.shape
+        blocks = cache.view(-1, block_size, *cache.shape[1:])[tables]
+        # (b, blocks, block_size, kv_heads, d) -> (b, kv_heads, positions, d) -> (b, heads, positions, d)
+        out = blocks.reshape(b, num_table_blocks * block_size, *cache.shape[1:]).transpose(1, 2)
+        return out.repeat_interleave(self.q_per_kv, dim=1)
@@ -0,0 +1,116 @@
+import os
+from dataclasses import asdict
+from typing import Optional, Union
+
+import torch
+import torchao
+from models import Model, ModelArgs, init_rope_buffers, load_model_from_checkpoint
+from torchao.quantization import int4_weight_only, int8_weight_only, quantize_
+
+QUANTIZE_MODES = ("int8", "int4")
+
+
+def quantize_model(model: Model, mode: str) -> Model:
+    """
+    Apply weight-only quantization in place to every linear layer of the backbone, the decoder, the
+    projection and the codebook heads. Embeddings stay in the model dtype.
+
+    ``int8`` works on any device. ``int4`` uses the tinygemm CUDA kernels and needs a bfloat16 model on CUDA.
+    """
+    if mode not in QUANTIZE_MODES:
+        raise ValueError(f"Unknown quantization mode {mode!r}, expected one of {QUANTIZE_MODES}")
+
+    param = next(model.parameters())
+    if mode == "int4" and (param.device.type != "cuda" or param.dtype != torch.bfloat16):
+        raise ValueError("int4 weight-only quantization needs a bfloat16 model on a CUDA device")
+
+    # audio_head is a stacked parameter used through torch.mm; quantize_ only rewrites nn.Linear weights.
+    model.split_audio_head()
+    config = int8_weight_only() if mode == "int8" else int4_weight_only(group_size=128)
+    for module in [model.backbone, model.decoder, model.projection, model.codebook0_head, model.audio_heads]:
+        quantize_(module, config)
+    return model
+
+
+def save_quantized_model(model: Model, path: str, mode: str, source: Optional[dict] = None) -> None:
+    """``source`` describes what the model was quantized from, see ``quantization_source``."""
+    dtype = next(model.parameters()).dtype
+    payload = {
+        "quantize": mode,
+        "config": asdict(model.config),
+        "dtype": str(dtype),
+        "source": source,
+        "state_dict": model.state_dict(),
+    }
+    partial_path = path + ".partial"
+    torch.save(payload, partial_path)
+    os.replace(partial_path, path)
+
+
+def load_quantized_model(path: str, device: Union[str, torch.device] = "cuda") -> Model:
+    """
+    Load a checkpoint written by ``save_quantized_model``.
+
+    The quantized weights are tensor subclasses, which ``weights_only`` loading rejects, so only load
+    files this code produced.
+    """
+    return _model_from_payload(torch.load(path, map_location=device, mmap=True, weights_only=False), device)
+
+
+def _model_from_payload(payload: dict, device: Union[str, torch.device]) -> Model:
+    dtype = getattr(torch, payload["dtype"].replace("torch.", ""))
+
+    with torch.device("meta"):
+        model = Model(ModelArgs(**payload["config"]))
+        model.split_audio_head()
+    model.load_state_dict(payload["state_dict"], assign=True)
+    init_rope_buffers(model, device, dtype)
+    return model
+
+
+def quantized_checkpoint_path(checkpoint_path: str, mode: str, dtype: torch.dtype = torch.bfloat16) -> str:
+    dtype_name = str(dtype).replace("torch.", "")
+    return f"{os.path.splitext(checkpoint_path)[0]}.{mode}.{dtype_name}.pt"
+
+
+def quantization_source(checkpoint_path: str, mode: str, dtype: torch.dtype) -> dict:
+    """What a quantized checkpoint depends on: the source checkpoint's size and mtime, the mode and the dtype."""
+    stat = os.stat(checkpoint_path)
+    return {
+        "checkpoint_size": stat.st_size,
+        "checkpoint_mtime_ns": stat.st_mtime_ns,
+        "quantize": mode,
+        "dtype": str(dtype),
+        "torchao": torchao.__version__,
+    }
+
+
+def load_model(
+    checkpoint_path: str,
+    device: Union[str, torch.device] = "cuda",
+    dtype: torch.dtype = torch.bfloat16,
+    quantize: Optional[str] = None,
+) -> Model:
+    """
+    ``load_model_from_checkpoint`` with optional weight-only quantization.
+
+    The quantized model is saved next to the checkpoint (``model.int8.bfloat16.pt`` for ``model.safetensors``)
+    the first time and reloaded from there afterwards, so quantization runs only once. It is quantized
+    again when the checkpoint's size or modification time, or the torchao version, no longer match.
+    """
+    if quantize is None:
+        return load_model_from_checkpoint(checkpoint_path, device=device, dtype=dtype)
+
+    quantized_path = quantized_checkpoint_path(checkpoint_path, quantize, dtype)
+    source = quantization_source(checkpoint_path, quantize, dtype)
+    if os.path.exists(quantized_path):
+        payload = torch.load(quantized_path, map_location=device, mmap=True, weights_only=False)
+        if payload.get("source") == source:
+            return _model_from_payload(payload, device)
+        del payload
+        print(f"{quantized_path} is stale, quantizing {checkpoint_path} again")
+
+    model = load_model_from_checkpoint(checkpoint_path, device=device, dtype=dtype)
+    quantize_model(model, quantize)
+    save_quantized_model(model, quantized_path, quantize, source)
+    return model
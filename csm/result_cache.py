@@ -0,0 +1,219 @@
+"""
+On-disk cache of finished syntheses, for traffic that repeats the same request (menu prompts, greetings,
+error messages).
+
+Entries are the final watermarked waveforms, one safetensors file each, keyed on a hash of the normalized
+text, the speaker, a fingerprint of the context segments, the sampling parameters, an optional seed and
+a namespace identifying the model weights. The directory is capped at ``max_bytes`` and evicts the least
+recently used entries, using file modification times, which hits refresh.
+
+Several processes can share a directory. Entries are written under a temporary name and renamed into
+place, and nothing else is shared between processes, so a reader sees a whole entry or none. On Windows
+a file another process has open cannot be replaced or removed; such writes and evictions are skipped
+(and counted as errors), never raised. Counters (hits, misses, bytes saved) are per process.
+
+    cache = ResultCache("cache/results", max_bytes=2 * 2**30, namespace=checkpoint_namespace(path))
+    audio = cache.generate(generator, "Thank you for calling.", 0, context)
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from dataclasses import dataclass
+from typing import List, Optional
+
+import torch
+from generator import Generator, Segment
+from safetensors import SafetensorError
+from safetensors.torch import load_file, save_file
+from segment_cache import tensor_fingerprint
+from text_processing import normalize_text
+
+_SUFFIX = ".safetensors"
+
+
+@dataclass
+class ResultCacheStats:
+    hits: int = 0
+    misses: int = 0
+    # Bytes of audio served from the cache rather than generated.
+    bytes_saved: int = 0
+    audio_seconds_saved: float = 0.0
+    evictions: int = 0
+    # Entries that could not be written or removed, e.g. because another process had them open on Windows.
+    errors: int = 0
+
+
+def checkpoint_namespace(checkpoint_path: Optional[str]) -> str:
+    """Namespace for weights loaded from ``checkpoint_path``: its path, size and modification time."""
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return f"sesame/csm-1b:{checkpoint_path}"
+    stat = os.stat(checkpoint_path)
+    return f"{os.path.abspath(checkpoint_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def context_fingerprint(context: List[Segment]) -> List[list]:
+    """Speaker, text and audio (or codes) hash of every context segment."""
+    return [
+        [
+            segment.speaker,
+            segment.text,
+            "codes" if segment.codes is not None else "audio",
+            tensor_fingerprint(segment.codes if segment.codes is not None else segment.audio),
+        ]
+        for segment in context
+    ]
+
+
+class ResultCache:
+    def __init__(self, directory: str, max_bytes: int = 1024 * 1024 * 1024, namespace: str = ""):
+        """``namespace`` must change whenever the weights do, see ``checkpoint_namespace``."""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+        os.makedirs(directory, exist_ok=True)
+        self._stats = ResultCacheStats()
+        self._lock = threading.Lock()
+
+    def key(
+        self,
+        text: str,
+        speaker: int,
+        context: List[Segment],
+        max_audio_length_ms: float,
+        temperature: float,
+        topk: int,
+        seed: Optional[int] = None,
+    ) -> str:
+        fields = {
+            "namespace": self.namespace,
+            "text": normalize_text(text),
+            "speaker": speaker,
+            "context": context_fingerprint(context),
+            "max_audio_length_ms": float(max_audio_length_ms),
+            "temperature": float(temperature),
+            "topk": int(topk),
+            "seed": seed,
+        }
+        return hashlib.blake2b(json.dumps(fields, sort_keys=True).encode("utf-8"), digest_size=20).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def get(self, key: str, sample_rate: int) -> Optional[torch.Tensor]:
+        path = self._path(key)
+        try:
+            audio = load_file(path)["audio"]
+            # Marks the entry as recently used for eviction.
+            os.utime(path)
+        except (OSError, KeyError, SafetensorError):
+            # Missing, evicted by another process in between, or unreadable.
+            with self._lock:
+                self._stats.misses += 1
+            return None
+        with self._lock:
+            self._stats.hits += 1
+            self._stats.bytes_saved += audio.element_size() * audio.nelement()
+            self._stats.audio_seconds_saved += audio.numel() / sample_rate
+        return audio
+
+    def put(self, key: str, audio: torch.Tensor) -> None:
+        """Store ``audio`` under ``key``. A failed write is counted in ``stats.errors``, not raised."""
+        partial_path = None
+        try:
+            fd, partial_path = tempfile.mkstemp(dir=self.directory, suffix=".partial")
+            os.close(fd)
+            save_file({"audio": audio.detach().float().cpu().contiguous()}, partial_path)
+            os.replace(partial_path, self._path(key))
+        except OSError:
+            self._count_error()
+            if partial_path is not None:
+                try:
+                    os.remove(partial_path)
+                except OSError:
+                    pass
+            return
+        self._evict()
+
+    def _count_error(self) -> None:
+        with self._lock:
+            self._stats.errors += 1
+
+    def _entries(self) -> List[os.DirEntry]:
+        return [entry for entry in os.scandir(self.directory) if entry.name.endswith(_SUFFIX)]
+
+    def _evict(self) -> None:
+        entries = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                with self._lock:
+                    self._stats.evictions += 1
+            except FileNotFoundError:
+                pass  # another process evicted it first
+            except OSError:
+                # Open in another process (Windows); left for a later eviction.
+                self._count_error()
+                continue
+            total -= size
+
+    def clear(self) -> None:
+        for entry in self._entries():
+            try:
+                os.remove(entry.path)
+            except OSError:
+                self._count_error()
+
+    @property
+    def stats(self) -> ResultCacheStats:
+        with self._lock:
+            return ResultCacheStats(**vars(self._stats))
+
+    @property
+    def disk_usage(self) -> int:
+        """Bytes of all entries in the directory, from every process."""
+        total = 0
+        for entry in self._entries():
+            try:
+                total += entry.stat().st_size
+            except OSError:
+                pass
+        return total
+
+    def generate(
+        self,
+        generator: Generator,
+        text: str,
+        speaker: int,
+        context: List[Segment],
+        max_audio_length_ms: float = 90_000,
+        temperature: float = 0.9,
+        topk: int = 50,
+        seed: Optional[int] = None,
+        **kwargs,
+    ) -> torch.Tensor:
+        """
+        ``generator.generate`` through the cache. On a miss with a ``seed``, the torch RNG is seeded with it
+        first. Other keyword arguments (``prefix_cache``, ``on_progress``) go to ``generate`` and are not
+        part of the key.
+        """
+        key = self.key(text, speaker, context, max_audio_length_ms, temperature, topk, seed)
+        audio = self.get(key, generator.sample_rate)
+        if audio is not None:
+            return audio.to(generator.device)
+        if seed is not None:
+            torch.manual_seed(seed)
+        audio = generator.generate(text, speaker, context, max_audio_length_ms, temperature, topk, **kwargs)
+        self.put(key, audio)
+        return audio
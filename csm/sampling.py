@@ -0,0 +1,101 @@
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Union
+
+import torch
+
+
+def _multinomial_sample_one_no_sync(
+    probs, generators: Optional[Sequence[Optional[torch.Generator]]] = None
+):  # Does multinomial sampling without a cuda synchronization
+    q = torch.empty_like(probs).exponential_(1)
+    # Rows with a generator of their own redraw their noise from it, independently of the other rows.
+    for i, generator in enumerate(generators or []):
+        if generator is not None:
+            q[i].exponential_(1, generator=generator)
+    return torch.argmax(probs / q, dim=-1, keepdim=True).to(dtype=torch.int)
+
+
+@dataclass
+class SamplingParams:
+    """Per-row sampling settings, built once per batch so sampling never reads them back to the host."""
+
+    # (batch_size, 1)
+    temperature: torch.Tensor
+    # (batch_size, 1)
+    topk: torch.Tensor
+    max_topk: int
+    # One per row, or None: rows with a generator sample from it instead of the global RNG.
+    generators: Optional[List[Optional[torch.Generator]]] = None
+
+    @classmethod
+    def create(
+        cls,
+        temperature: Union[float, Sequence[float]],
+        topk: Union[int, Sequence[int]],
+        batch_size: int,
+        device: torch.device,
+        generators: Optional[Sequence[Optional[torch.Generator]]] = None,
+    ) -> "SamplingParams":
+        temperatures = [temperature] * batch_size if isinstance(temperature, (int, float)) else list(temperature)
+        topks = [topk] * batch_size if isinstance(topk, int) else list(topk)
+        if len(temperatures) != batch_size or len(topks) != batch_size:
+            raise ValueError(f"Expected {batch_size} temperature and topk values")
+        if generators is not None and len(generators) != batch_size:
+            raise ValueError(f"Expected {batch_size} generators")
+        return cls(
+            temperature=torch.tensor(temperatures, dtype=torch.float32, device=device).unsqueeze(-1),
+            topk=torch.tensor(topks, dtype=torch.long, device=device).unsqueeze(-1),
+            max_topk=max(topks),
+            generators=list(generators) if generators is not None and any(generators) else None,
+        )
+
+
+def sample_topk(logits: torch.Tensor, topk: int, temperature: float) -> torch.Tensor:
+    """
+    Sample one token per row from the ``topk`` most likely tokens.
+
+    Only the (batch_size, topk) slice returned by ``torch.topk`` is scaled, normalized and sampled;
+    the full-vocabulary logits are never copied or masked.
+
+    Args:
+        logits: (batch_size, vocab_size)
+
+    Returns:
+        (batch_size, 1) int32 token ids
+    """
+    values, indices = torch.topk(logits, topk, dim=-1)
+    probs = torch.softmax(values.float() / temperature, dim=-1)
+    return torch.gather(indices, -1, _multinomial_sample_one_no_sync(probs).long()).to(dtype=torch.int)
+
+
+def sample_topk_rows(logits: torch.Tensor, params: SamplingParams) -> torch.Tensor:
+    """
+    ``sample_topk`` with a temperature, top-k and optionally a random generator of its own for every row.
+
+    Args:
+        logits: (batch_size, vocab_size)
+
+    Returns:
+        (batch_size, 1) int32 token ids
+    """
+    values, indices = torch.topk(logits, params.max_topk, dim=-1)
+    scores = values.float() / params.temperature
+    ranks = torch.arange(params.max_topk, device=logits.device)
+    scores = scores.masked_fill(ranks >= params.topk, -float("inf"))
+    probs = torch.softmax(scores, dim=-1)
+    sample = _multinomial_sample_one_no_sync(probs, params.generators)
+    return torch.gather(indices, -1, sample.long()).to(dtype=torch.int)
+
+
+def sample_topk_reference(logits: torch.Tensor, topk: int, temperature: float) -> torch.Tensor:
+    """The original full-vocabulary implementation, kept as the baseline for benchmarks."""
+    logits = logits / temperature
+
+    filter_value: float = -float("Inf")
+    indices_to_remove = logits < torch.topk(logits, topk)[0][..., -1, None]
+    scores_processed = logits.masked_fill(indices_to_remove, filter_value)
+    scores_processed = torch.nn.functional.log_softmax(scores_processed, dim=-1)
+    probs = torch.nn.functional.softmax(scores_processed, dim=-1)
+
+    sample_token = _multinomial_sample_one_no_sync(probs)
+    return sample_token
@@ -0,0 +1,350 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import torch
+from generator import Generator, Segment
+from paged_cache import PagedKVPool, PagedSession
+from sampling import SamplingParams
+from watermarking import StreamingWatermark
+
+
+class SchedulerBusy(Exception):
+    """Raised by ``BatchScheduler.submit`` when the request queue is full."""
+
+
+@dataclass
+class SynthesisRequest:
+    text: str
+    speaker: int
+    context: List[Segment]
+    max_audio_length_ms: float = 30_000
+    temperature: float = 0.9
+    topk: int = 50
+    # Seeds a random generator used by this request alone, so the same request samples the same tokens
+    # whatever else is in the batch (up to float rounding, which can differ with the batch's makeup).
+    seed: Optional[int] = None
+    # Called with each watermarked chunk, in order, while the request is still generating (see
+    # ``BatchScheduler``). Runs on the scheduler or watermark thread, so it should only hand the chunk off.
+    on_chunk: Optional[Callable[[torch.Tensor], None]] = None
+    # Resolves to the watermarked (num_samples,) waveform; with ``on_chunk``, after the last chunk.
+    future: "Future[torch.Tensor]" = field(default_factory=Future)
+
+
+@dataclass
+class _Row:
+    request: SynthesisRequest
+    max_frames: int
+    frames: List[torch.Tensor] = field(default_factory=list)
+    session: PagedSession = field(default_factory=PagedSession)
+    # Seeded from ``request.seed`` on admission, so a preempted request restarts from the same state.
+    rng: Optional[torch.Generator] = None
+    # Streaming rows only: frames decoded so far, Mimi's decoder state after them and the watermarked chunks.
+    decoded_frames: int = 0
+    mimi_state: Optional[Dict[str, Any]] = None
+    watermark: Optional[StreamingWatermark] = None
+    chunks: List["Future[torch.Tensor]"] = field(default_factory=list)
+
+
+class BatchScheduler:
+    """
+    Continuous batching over ``Model.generate_frame`` with a paged backbone KV cache.
+
+    One background thread owns the generator and steps up to ``max_batch_size`` requests together.
+    Requests are admitted between frames with a "join step": the step input is as long as the longest
+    new prompt, new rows get their (left-padded) prompt and running rows get their last frame in the
+    final position. Each row is a ``PagedSession`` with its own positions, taking cache blocks from a
+    pool of ``cache_tokens`` positions as it grows and returning them as soon as it finishes.
+
+    A request is admitted when the pool has room for its prompt and for one more frame of every
+    running row. Should the pool run out later, the most recently admitted row is preempted: its
+    blocks are freed and its request goes back to the front of the queue to start over.
+
+    Requests with an ``on_chunk`` callback are streamed: every ``stream_chunk_frames`` frames the row's new
+    frames are decoded, carrying the row's own copy of Mimi's streaming state from one chunk to the next,
+    and watermarked with ``stream_watermark_ms`` of audio on either side (see ``StreamingWatermark``).
+    Audio already streamed cannot be taken back, so such rows are preempted last, and fail rather than
+    start over. Streaming needs an audio tokenizer with moshi's ``get_streaming_state`` /
+    ``set_streaming_state``; with any other, the clip arrives as one chunk when the request finishes.
+
+    The generator must not be used for anything else while the scheduler is running.
+    """
+
+    def __init__(
+        self,
+        generator: Generator,
+        max_batch_size: int = 8,
+        max_queue: int = 32,
+        cache_tokens: Optional[int] = None,
+        block_size: int = 16,
+        stream_chunk_frames: int = 2,
+        stream_watermark_ms: float = 80,
+    ):
+        """
+        ``cache_tokens`` is the backbone cache size in positions, shared by all rows. The default,
+        ``max_batch_size * max_seq_len``, never preempts; a smaller pool fits more rows into the same
+        memory when requests are shorter than the worst case.
+        """
+        self._generator = generator
+        self._model = generator._model
+        self.max_batch_size = max_batch_size
+        self._max_seq_len = self._model.backbone.max_seq_len
+        cache_tokens = cache_tokens if cache_tokens is not None else max_batch_size * self._max_seq_len
+        # One more block for the pool's scratch block.
+        self._num_blocks = -(-cache_tokens // block_size) + 1
+        self._block_size = block_size
+        self._pool: Optional[PagedKVPool] = None
+        self._queue: "queue.Queue[SynthesisRequest]" = queue.Queue(maxsize=max_queue)
+        self._preempted: Deque[SynthesisRequest] = deque()
+        self._waiting: Optional[SynthesisRequest] = None
+        self._rows: List[Optional[_Row]] = [None] * max_batch_size
+        # Row indices in admission order, oldest first.
+        self._admission_order: List[int] = []
+        self._sampling: Optional[SamplingParams] = None
+        self.stream_chunk_frames = stream_chunk_frames
+        self._stream_watermark = int(stream_watermark_ms * generator.sample_rate / 1000)
+        audio_tokenizer = generator._audio_tokenizer
+        self._can_stream = hasattr(audio_tokenizer, "get_streaming_state") and hasattr(
+            audio_tokenizer, "set_streaming_state"
+        )
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, request: SynthesisRequest) -> "Future[torch.Tensor]":
+        try:
+            self._queue.put_nowait(request)
+        except queue.Full:
+            raise SchedulerBusy(f"{self._queue.maxsize} requests are already queued") from None
+        return request.future
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() + len(self._preempted) + (self._waiting is not None)
+
+    @property
+    def active_requests(self) -> int:
+        return sum(row is not None for row in self._rows)
+
+    @property
+    def cache_usage(self) -> Tuple[int, int]:
+        """(positions held by running rows, pool size in positions)."""
+        if self._pool is None:
+            return 0, 0
+        return self._pool.blocks_in_use * self._block_size, (self._num_blocks - 1) * self._block_size
+
+    def close(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        with torch.inference_mode():
+            self._pool = self._model.setup_paged_caches(self.max_batch_size, self._num_blocks, self._block_size)
+            while not self._stopped.is_set():
+                if self.active_requests == 0 and self._next_request() is None:
+                    try:
+                        self._waiting = self._queue.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                try:
+                    admitted = self._admit()
+                    if admitted or self.active_requests > 0:
+                        self._step(admitted)
+                except Exception as e:  # noqa: BLE001 - fail the requests in flight, keep serving
+                    for i, row in enumerate(self._rows):
+                        if row is not None:
+                            row.request.future.set_exception(e)
+                            self._release(i)
+
+    def _next_request(self) -> Optional[SynthesisRequest]:
+        if self._waiting is None:
+            if self._preempted:
+                self._waiting = self._preempted.popleft()
+            else:
+                try:
+                    self._waiting = self._queue.get_nowait()
+                except queue.Empty:
+                    return None
+        return self._waiting
+
+    def _admit(self) -> List[Tuple[int, torch.Tensor, torch.Tensor, _Row]]:
+        """Move queued requests into free rows while they fit. Returns (row index, tokens, mask, row) for each."""
+        free = [i for i, row in enumerate(self._rows) if row is None]
+        # Blocks the running rows take in the join step, one position each.
+        reserved = sum(self._pool.blocks_needed(row.session, 1) for row in self._rows if row is not None)
+        admitted = []
+        while free:
+            request = self._next_request()
+            if request is None:
+                break
+
+            max_frames = int(request.max_audio_length_ms / 80)
+            try:
+                tokens, tokens_mask, _ = self._generator._tokenize_prompt(
+                    request.text, request.speaker, request.context
+                )
+                if tokens.size(0) + max_frames > self._max_seq_len:
+                    raise ValueError(
+                        f"Inputs too long, must be below max_seq_len - max_audio_frames: {self._max_seq_len}"
+                    )
+                if self._pool.blocks_needed(PagedSession(), tokens.size(0) + max_frames) > self._num_blocks - 1:
+                    raise ValueError("Inputs too long for the scheduler's cache_tokens")
+            except Exception as e:  # noqa: BLE001 - reported to the caller through its future
+                request.future.set_exception(e)
+                self._waiting = None
+                continue
+
+            row = _Row(request=request, max_frames=max_frames)
+            if request.seed is not None:
+                row.rng = torch.Generator(device=self._generator.device).manual_seed(request.seed)
+            needed = self._pool.blocks_needed(row.session, tokens.size(0))
+            if reserved + needed > self._pool.num_free_blocks:
+                break  # wait until running rows finish and free their blocks
+
+            admitted.append((free.pop(0), tokens, tokens_mask, row))
+            reserved += needed
+            self._waiting = None
+        return admitted
+
+    def _make_room(self) -> None:
+        """
+        Preempt the most recently admitted rows until every running row can take one more position. Rows
+        that have streamed audio go last, and fail instead of going back to the queue.
+        """
+        while True:
+            needed = sum(self._pool.blocks_needed(row.session, 1) for row in self._rows if row is not None)
+            if needed <= self._pool.num_free_blocks or len(self._admission_order) <= 1:
+                return
+            unstreamed = [i for i in self._admission_order if self._rows[i].decoded_frames == 0]
+            i = unstreamed[-1] if unstreamed else self._admission_order[-1]
+            if unstreamed:
+                self._preempted.appendleft(self._rows[i].request)
+            else:
+                self._rows[i].request.future.set_exception(
+                    RuntimeError("Preempted after streaming had started; the cache is too small for this load")
+                )
+            self._release(i)
+
+    def _release(self, i: int) -> None:
+        self._pool.free(self._rows[i].session)
+        self._rows[i] = None
+        self._admission_order.remove(i)
+
+    def _step(self, admitted: List[Tuple[int, torch.Tensor, torch.Tensor, _Row]]) -> None:
+        device = self._generator.device
+        b = self.max_batch_size
+        s = max([1] + [tokens.size(0) for _, tokens, _, _ in admitted])
+        if not admitted:
+            self._make_room()
+
+        tokens = torch.zeros(b, s, 33).long().to(device)
+        tokens_mask = torch.zeros(b, s, 33).bool().to(device)
+        new_tokens = [0] * b
+        for i, row in enumerate(self._rows):
+            if row is not None:
+                tokens[i, -1, :-1] = row.frames[-1]
+                tokens_mask[i, -1, :-1] = True
+                new_tokens[i] = 1
+        for i, row_tokens, row_mask, row in admitted:
+            pad = s - row_tokens.size(0)
+            tokens[i, pad:] = row_tokens
+            tokens_mask[i, pad:] = row_mask
+            new_tokens[i] = row_tokens.size(0)
+            self._rows[i] = row
+            self._admission_order.append(i)
+
+        if admitted or self._sampling is None:
+            self._sampling = SamplingParams.create(
+                [row.request.temperature if row is not None else 1.0 for row in self._rows],
+                [row.request.topk if row is not None else 1 for row in self._rows],
+                b,
+                device,
+                [row.rng if row is not None else None for row in self._rows],
+            )
+        sessions = [row.session if row is not None else None for row in self._rows]
+        input_pos = self._pool.prepare(sessions, new_tokens, s)
+        sample = self._model.generate_frame(tokens, tokens_mask, input_pos, 1.0, 1, sampling=self._sampling)
+
+        is_eos = torch.all(sample == 0, dim=1).tolist()
+        for i, row in enumerate(self._rows):
+            if row is None:
+                continue
+            if not is_eos[i]:
+                row.frames.append(sample[i].clone())
+            if is_eos[i] or len(row.frames) >= row.max_frames:
+                self._finish(row)
+                self._release(i)
+            elif self._streams(row) and len(row.frames) - row.decoded_frames >= self.stream_chunk_frames:
+                self._stream_chunk(row)
+
+    def _streams(self, row: _Row) -> bool:
+        return row.request.on_chunk is not None and self._can_stream
+
+    def _stream_chunk(self, row: _Row) -> None:
+        """Decode the row's frames since the last chunk and queue them for watermarking and ``on_chunk``."""
+        mimi = self._generator._audio_tokenizer
+        codes = torch.stack(row.frames[row.decoded_frames :]).permute(1, 0).unsqueeze(0)
+        with mimi.streaming(1):
+            if row.mimi_state is not None:
+                mimi.set_streaming_state(row.mimi_state)
+            audio = mimi.decode(codes)[0, 0]
+            row.mimi_state = mimi.get_streaming_state()
+        row.decoded_frames = len(row.frames)
+
+        if row.watermark is None:
+            row.watermark = StreamingWatermark(
+                self._generator._watermark_stage, self._stream_watermark, self._stream_watermark
+            )
+        self._queue_chunks(row, row.watermark.push(audio))
+
+    def _queue_chunks(self, row: _Row, chunks: List["Future[torch.Tensor]"]) -> None:
+        on_chunk = row.request.on_chunk
+        for chunk in chunks:
+            # The watermark worker completes chunks in order, so the callbacks run in order too.
+            chunk.add_done_callback(lambda f: on_chunk(f.result()) if f.exception() is None else None)
+            row.chunks.append(chunk)
+
+    def _finish(self, row: _Row) -> None:
+        if self._streams(row):
+            self._finish_stream(row)
+            return
+        if not row.frames:
+            row.request.future.set_result(torch.zeros(0))
+            if row.request.on_chunk is not None:
+                row.request.on_chunk(torch.zeros(0))
+            return
+        codes = torch.stack(row.frames).permute(1, 0).unsqueeze(0)
+        audio = self._generator._decode(codes)
+        watermarked = self._generator._submit_watermark(audio)
+
+        def resolve(f: "Future[torch.Tensor]") -> None:
+            if f.exception() is not None:
+                row.request.future.set_exception(f.exception())
+            else:
+                if row.request.on_chunk is not None:
+                    row.request.on_chunk(f.result())
+                row.request.future.set_result(f.result())
+
+        watermarked.add_done_callback(resolve)
+
+    def _finish_stream(self, row: _Row) -> None:
+        if len(row.frames) > row.decoded_frames:
+            self._stream_chunk(row)
+        if row.watermark is not None:
+            self._queue_chunks(row, row.watermark.flush())
+        if not row.chunks:
+            row.request.future.set_result(torch.zeros(0))
+            return
+
+        def resolve(_: "Future[torch.Tensor]") -> None:
+            # The last chunk completes last, after the on_chunk callbacks of every chunk.
+            errors = [chunk.exception() for chunk in row.chunks if chunk.exception() is not None]
+            if errors:
+                row.request.future.set_exception(errors[0])
+            else:
+                row.request.future.set_result(torch.cat([chunk.result() for chunk in row.chunks]))
+
+        row.chunks[-1].add_done_callback(resolve)
@@ -0,0 +1,94 @@
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Hashable, Optional, Tuple
+
+import torch
+
+
+def tensor_fingerprint(tensor: torch.Tensor) -> str:
+    """Content hash of a tensor's dtype, shape and raw bytes."""
+    data = tensor.detach().contiguous().cpu()
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(data.dtype).encode())
+    h.update(str(tuple(data.shape)).encode())
+    h.update(data.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+def segment_key(text: str, speaker: int, audio: torch.Tensor) -> Tuple[int, str, str]:
+    text_hash = hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+    return (speaker, text_hash, tensor_fingerprint(audio))
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    entries: int = 0
+    bytes: int = 0
+
+
+def _nbytes(value: Tuple[torch.Tensor, ...]) -> int:
+    return sum(t.element_size() * t.nelement() for t in value)
+
+
+class SegmentTokenCache:
+    """
+    Bounded LRU of tokenized context segments.
+
+    Values are the ``(seq_len, 33)`` frame and mask tensors produced by
+    ``Generator._tokenize_segment``; the budget is counted in tensor bytes.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, Tuple[torch.Tensor, ...]]" = OrderedDict()
+        self._stats = CacheStats()
+
+    def get(self, key: Hashable) -> Optional[Tuple[torch.Tensor, ...]]:
+        value = self._entries.get(key)
+        if value is None:
+            self._stats.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self._stats.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Tuple[torch.Tensor, ...]) -> None:
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._stats.bytes -= _nbytes(self._entries.pop(key))
+        self._entries[key] = value
+        self._stats.bytes += size
+        while self._stats.bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._stats.bytes -= _nbytes(evicted)
+            self._stats.evictions += 1
+
+    def invalidate(self, key: Optional[Hashable] = None) -> None:
+        """Drop one entry, or every entry when ``key`` is None."""
+        if key is None:
+            self._entries.clear()
+            self._stats.bytes = 0
+        elif key in self._entries:
+            self._stats.bytes -= _nbytes(self._entries.pop(key))
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def stats(self) -> CacheStats:
+        return CacheStats(
+            hits=self._stats.hits,
+            misses=self._stats.misses,
+            evictions=self._stats.evictions,
+            entries=len(self._entries),
+            bytes=self._stats.bytes,
+        )
@@ -0,0 +1,319 @@
+"""
+Local HTTP inference server with dynamic batching.
+
+    python server.py --port 8000
+    curl -X POST localhost:8000/synthesize -d '{"text": "Hello there.", "voice": "3-news_woman"}' -o out.wav
+
+POST /synthesize takes JSON:
+    text                  text to speak (required)
+    voice                 id of a bundled voice from sounds/ or the voice pack (see GET /voices), or
+    reference_audio       base64-encoded audio file, with reference_text as its transcript
+    speaker               speaker id, default 0
+    temperature, topk     sampling parameters
+    max_audio_length_ms   default 30000
+    format                "wav" (default) or "pcm" (raw 16-bit little-endian mono, streamed with chunked
+                          transfer as the audio is generated)
+    seed                  makes sampling reproducible whatever else is batched with the request (up to
+                          float rounding); with --result-cache, seeds are cached separately
+
+Requests from all clients are merged into shared frame-loop batches by ``BatchScheduler``. When the
+queue is full the server answers 503 with a Retry-After header. PCM responses start with the first
+watermarked chunk, a few frames into generation; a request that fails after that ends the response
+without the final empty chunk, so clients see an incomplete body rather than an error status.
+
+``--cache-tokens`` sizes the paged backbone KV cache shared by all requests; with prompts shorter than the
+worst case, a pool smaller than ``--max-batch-size`` x 2048 positions serves the same batch in less memory.
+
+``--result-cache DIR`` answers repeated requests (same text, voice, sampling parameters and seed) from
+finished audio on disk, shared with other server processes pointed at the same directory. Hit counts are
+reported by GET /health.
+
+``--random-weights`` serves the tiny random-weight model (noise) for testing the serving path.
+"""
+
+import argparse
+import base64
+import io
+import json
+import queue
+import threading
+import wave
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dataclasses import asdict
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import torch
+from audio_io import load_audio
+from audio_sink import to_pcm16
+from generator import Generator, Segment, load_generator
+from models import random_model
+from result_cache import ResultCache, checkpoint_namespace
+from scheduler import BatchScheduler, SchedulerBusy, SynthesisRequest
+from voice_pack import find_voice_pairs, load_voice_pack
+
+PCM_CHUNK_BYTES = 32 * 1024
+
+
+def to_wav(audio: torch.Tensor, sample_rate: int) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(to_pcm16(audio))
+    return buffer.getvalue()
+
+
+class SynthesisServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self, address, generator: Generator, scheduler: BatchScheduler, result_cache: Optional[ResultCache] = None
+    ):
+        super().__init__(address, SynthesisHandler)
+        self.generator = generator
+        self.scheduler = scheduler
+        self.result_cache = result_cache
+        self.voice_pack = load_voice_pack()
+        self._voice_files = {name: (wav, txt) for name, wav, txt in find_voice_pairs()}
+        self._voices: Dict[str, Segment] = {}
+        self._voices_lock = threading.Lock()
+
+    def list_voices(self) -> List[str]:
+        packed = self.voice_pack.names if self.voice_pack is not None else []
+        return sorted(set(packed) | set(self._voice_files))
+
+    def voice_segment(self, voice: str, speaker: int) -> Segment:
+        if self.voice_pack is not None and voice in self.voice_pack:
+            return self.voice_pack.segment(voice, speaker)
+        if voice not in self._voice_files:
+            raise KeyError(f"Unknown voice {voice!r}")
+        with self._voices_lock:
+            if voice not in self._voices:
+                wav_path, txt_path = self._voice_files[voice]
+                with open(txt_path, encoding="utf-8") as f:
+                    text = f.read().strip()
+                audio = load_audio(wav_path, self.generator.sample_rate)
+                self._voices[voice] = Segment(speaker=0, text=text, audio=audio)
+            segment = self._voices[voice]
+        return Segment(speaker=speaker, text=segment.text, audio=segment.audio)
+
+
+class SynthesisHandler(BaseHTTPRequestHandler):
+    server: SynthesisServer
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        if self.path == "/voices":
+            self._send_json(200, {"voices": self.server.list_voices()})
+        elif self.path == "/health":
+            scheduler = self.server.scheduler
+            cache_used, cache_size = scheduler.cache_usage
+            health = {
+                "queue_depth": scheduler.queue_depth,
+                "active": scheduler.active_requests,
+                "cache_tokens_used": cache_used,
+                "cache_tokens": cache_size,
+            }
+            result_cache = self.server.result_cache
+            if result_cache is not None:
+                health["result_cache"] = dict(asdict(result_cache.stats), disk_bytes=result_cache.disk_usage)
+            self._send_json(200, health)
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self) -> None:
+        if self.path != "/synthesize":
+            self._send_json(404, {"error": "not found"})
+            return
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            request = self._parse_request(body)
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        sample_rate = self.server.generator.sample_rate
+        result_cache = self.server.result_cache
+        audio = None
+        cache_key = None
+        if result_cache is not None:
+            cache_key = result_cache.key(
+                request.text,
+                request.speaker,
+                request.context,
+                request.max_audio_length_ms,
+                request.temperature,
+                request.topk,
+                request.seed,
+            )
+            audio = result_cache.get(cache_key, sample_rate)
+
+        if audio is not None:
+            if body.get("format", "wav") == "pcm":
+                data = to_pcm16(audio)
+                pieces = [data[i : i + PCM_CHUNK_BYTES] for i in range(0, len(data), PCM_CHUNK_BYTES)]
+                self._send_pcm(pieces, sample_rate)
+            else:
+                self._send_bytes(200, to_wav(audio, sample_rate), "audio/wav")
+            return
+
+        streamed = body.get("format", "wav") == "pcm"
+        chunks: "queue.Queue[Optional[torch.Tensor]]" = queue.Queue()
+        if streamed:
+            request.on_chunk = chunks.put
+        try:
+            future = self.server.scheduler.submit(request)
+        except SchedulerBusy as e:
+            self._send_json(503, {"error": str(e)}, headers={"Retry-After": "1"})
+            return
+        # The future resolves after the last on_chunk call, so this marks the end of the stream.
+        future.add_done_callback(lambda _: chunks.put(None))
+
+        # Until the first chunk is out, a failure can still be answered with its own status.
+        first = chunks.get() if streamed else None
+        if first is None:
+            try:
+                future.result()
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+                return
+            except Exception as e:  # noqa: BLE001
+                self._send_json(500, {"error": str(e)})
+                return
+
+        if streamed:
+            if not self._send_pcm(self._pcm_chunks(first, chunks, future), sample_rate):
+                return
+        else:
+            self._send_bytes(200, to_wav(future.result(), sample_rate), "audio/wav")
+
+        if result_cache is not None:
+            try:
+                result_cache.put(cache_key, future.result())
+            except Exception as e:  # noqa: BLE001 - the audio is already sent, a cache failure must not fail it
+                print(f"Result cache write failed: {type(e).__name__}: {e}")
+
+    @staticmethod
+    def _pcm_chunks(
+        first: Optional[torch.Tensor], chunks: "queue.Queue[Optional[torch.Tensor]]", future: Future
+    ) -> Iterator[bytes]:
+        chunk = first
+        while chunk is not None:
+            yield to_pcm16(chunk)
+            chunk = chunks.get()
+        # Raises if the request failed after streaming started.
+        future.result()
+
+    def _parse_request(self, body: dict) -> SynthesisRequest:
+        text = body["text"]
+        speaker = int(body.get("speaker", 0))
+        if body.get("format", "wav") not in ("wav", "pcm"):
+            raise ValueError("format must be 'wav' or 'pcm'")
+
+        context = []
+        if body.get("voice"):
+            context.append(self.server.voice_segment(body["voice"], speaker))
+        elif body.get("reference_audio"):
+            try:
+                reference = io.BytesIO(base64.b64decode(body["reference_audio"]))
+                audio = load_audio(reference, self.server.generator.sample_rate)
+            except Exception as e:  # noqa: BLE001 - torchaudio raises RuntimeError for undecodable audio
+                raise ValueError(f"reference_audio could not be decoded: {e}") from e
+            context.append(Segment(speaker=speaker, text=body.get("reference_text", ""), audio=audio))
+
+        # Checked here because the scheduler samples every request in one batch: a bad value would fail
+        # the whole batch (topk too large) or silently sample from NaN probabilities (zero or negative values).
+        max_audio_length_ms = float(body.get("max_audio_length_ms", 30_000))
+        temperature = float(body.get("temperature", 0.9))
+        topk = int(body.get("topk", 50))
+        audio_vocab_size = self.server.generator._model.config.audio_vocab_size
+        if not 80 <= max_audio_length_ms < float("inf"):
+            raise ValueError("max_audio_length_ms must be at least 80 (one frame)")
+        if not 0 < temperature < float("inf"):
+            raise ValueError("temperature must be positive")
+        if not 1 <= topk <= audio_vocab_size:
+            raise ValueError(f"topk must be between 1 and {audio_vocab_size}")
+
+        return SynthesisRequest(
+            text=text,
+            speaker=speaker,
+            context=context,
+            max_audio_length_ms=max_audio_length_ms,
+            temperature=temperature,
+            topk=topk,
+            seed=int(body["seed"]) if body.get("seed") is not None else None,
+        )
+
+    def _send_json(self, status: int, payload: dict, headers: Dict[str, str] = None) -> None:
+        self._send_bytes(status, json.dumps(payload).encode(), "application/json", headers)
+
+    def _send_bytes(self, status: int, data: bytes, content_type: str, headers: Dict[str, str] = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_pcm(self, chunks: Iterable[bytes], sample_rate: int) -> bool:
+        """Send ``chunks`` with chunked transfer. Returns False if producing them failed part way."""
+        self.send_response(200)
+        self.send_header("Content-Type", f"audio/L16; rate={sample_rate}; channels=1")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                if chunk:
+                    self.wfile.write(f"{len(chunk):X}\r\n".encode() + chunk + b"\r\n")
+                    self.wfile.flush()
+        except Exception as e:  # noqa: BLE001 - the status is already sent; leave the body unterminated
+            print(f"Streaming failed: {type(e).__name__}: {e}")
+            self.close_connection = True
+            return False
+        self.wfile.write(b"0\r\n\r\n")
+        return True
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--checkpoint", type=str, default=None)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-queue", type=int, default=32)
+    parser.add_argument(
+        "--cache-tokens", type=int, default=None, help="backbone KV cache positions shared by all rows (paged)"
+    )
+    parser.add_argument("--random-weights", action="store_true", help="serve the tiny random-weight model")
+    parser.add_argument("--result-cache", type=str, default=None, help="directory of cached finished audio")
+    parser.add_argument("--result-cache-mb", type=float, default=1024)
+    args = parser.parse_args()
+
+    if args.random_weights:
+        generator = Generator(random_model(device=args.device))
+    else:
+        generator = load_generator(args.checkpoint, device=args.device)
+    scheduler = BatchScheduler(
+        generator, max_batch_size=args.max_batch_size, max_queue=args.max_queue, cache_tokens=args.cache_tokens
+    )
+
+    result_cache = None
+    if args.result_cache:
+        namespace = "random-weights" if args.random_weights else checkpoint_namespace(args.checkpoint)
+        result_cache = ResultCache(args.result_cache, int(args.result_cache_mb * 2**20), namespace)
+
+    server = SynthesisServer((args.host, args.port), generator, scheduler, result_cache)
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    finally:
+        scheduler.close()
+
+
+if __name__ == "__main__":
+    main()
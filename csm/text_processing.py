@@ -0,0 +1,125 @@
+"""
+Text normalization and tokenization shared by the generator, the GUIs and the batch / long-form paths.
+
+``preprocess_text`` is the optional cleanup the GUIs offer for pasted text. ``normalize_text`` is the
+pass every segment goes through before tokenization. ``TextTokenizer`` turns (text, speaker) pairs into
+the ``(num_tokens, 33)`` text frames the backbone reads. It encodes lists of texts with one
+batch call on the Hugging Face fast tokenizer and memoizes the frames of texts it has already seen.
+"""
+
+import re
+import threading
+from collections import OrderedDict
+from typing import List, Sequence, Tuple, Union
+
+import torch
+from segment_cache import CacheStats
+
+_LEADING_PUNCTUATION = re.compile(r"^[,\-._/@#*%$().]+")
+_COLON_OR_SEMICOLON = re.compile(r"[;:]")
+_APOSTROPHE = re.compile(r"['’]")
+
+_PAUSE = re.compile(r"[\r;:]")
+_COMMA = re.compile(r"\s*,\s*")
+
+
+def preprocess_text(text: str) -> str:
+    """
+    Cleanup for pasted text: drop empty lines and punctuation at the start of lines, join lines with
+    commas, turn colons and semicolons into commas and remove apostrophes.
+    """
+    lines = []
+    for line in text.split("\n"):
+        line = _LEADING_PUNCTUATION.sub("", line.strip()).strip()
+        if line:
+            lines.append(line)
+    text = _COLON_OR_SEMICOLON.sub(", ", ", ".join(lines))
+    return _APOSTROPHE.sub("", text)
+
+
+def normalize_text(text: str) -> str:
+    """Turn carriage returns, colons and semicolons into comma pauses and collapse whitespace."""
+    text = _COMMA.sub(", ", _PAUSE.sub(", ", text))
+    return " ".join(text.split())
+
+
+def _text_frames(token_ids: List[int], device: torch.device) -> Tuple[torch.Tensor, torch.Tensor]:
+    text_frame = torch.zeros(len(token_ids), 33, dtype=torch.long)
+    text_frame_mask = torch.zeros(len(token_ids), 33, dtype=torch.bool)
+    text_frame[:, -1] = torch.tensor(token_ids)
+    text_frame_mask[:, -1] = True
+    return text_frame.to(device), text_frame_mask.to(device)
+
+
+class TextTokenizer:
+    """
+    Normalizes, tokenizes and frames text segments, with a bounded LRU of the frames per (speaker, text).
+
+    Returned tensors are shared with the memo and must not be modified in place.
+    """
+
+    def __init__(self, tokenizer, device: Union[str, torch.device] = "cpu", max_entries: int = 4096):
+        self._tokenizer = tokenizer
+        self._device = torch.device(device)
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[int, str], Tuple[torch.Tensor, torch.Tensor]]" = OrderedDict()
+        self._stats = CacheStats()
+        # The server tokenizes from request threads while the scheduler thread generates.
+        self._lock = threading.Lock()
+
+    def frames(self, text: str, speaker: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """(num_tokens, 33) text frames and mask for ``text`` spoken by ``speaker``."""
+        return self.frames_batch([text], [speaker])[0]
+
+    def frames_batch(
+        self, texts: Sequence[str], speakers: Union[int, Sequence[int]]
+    ) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """``frames`` for many texts, with every text not memoized yet encoded in one tokenizer call."""
+        if isinstance(speakers, int):
+            speakers = [speakers] * len(texts)
+        keys = list(zip(speakers, texts))
+
+        results = {}
+        with self._lock:
+            for key in keys:
+                value = self._entries.get(key)
+                if value is not None:
+                    self._entries.move_to_end(key)
+                    results[key] = value
+            self._stats.hits += sum(key in results for key in keys)
+            missing = [key for key in dict.fromkeys(keys) if key not in results]
+            self._stats.misses += len(missing)
+
+        if missing:
+            token_ids = self._encode([f"[{speaker}]{normalize_text(text)}" for speaker, text in missing])
+            for key, ids in zip(missing, token_ids):
+                results[key] = _text_frames(ids, self._device)
+            with self._lock:
+                for key in missing:
+                    self._entries[key] = results[key]
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self._stats.evictions += 1
+
+        return [results[key] for key in keys]
+
+    def _encode(self, texts: List[str]) -> List[List[int]]:
+        # Fast (Rust) tokenizers encode a list in one call, in parallel; anything else goes text by text.
+        if getattr(self._tokenizer, "is_fast", False):
+            return self._tokenizer(texts)["input_ids"]
+        return [self._tokenizer.encode(text) for text in texts]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self._stats.hits,
+                misses=self._stats.misses,
+                evictions=self._stats.evictions,
+                entries=len(self._entries),
+                bytes=sum(t.element_size() * t.nelement() for value in self._entries.values() for t in value),
+            )
@@ -0,0 +1,167 @@
+"""
+Precompiled voice packs: the Mimi codes of reference clips, stored in one memory-mapped safetensors file.
+
+    python voice_pack.py                                   # every sounds/*.wav + .txt pair
+    python voice_pack.py --voice my_voice me.wav me.txt    # plus user-supplied clips
+
+Using a voice from the pack needs no audio decoding, resampling or Mimi encoding: its codes go straight
+into ``Segment(speaker, text, audio=None, codes=codes)``. The text frames are still built per use, since
+they depend on the speaker id. Clips are matched by a hash of the audio file's bytes, so a copy of a
+bundled wav (e.g. one Gradio put in its cache) still hits the pack. Codes only mean something to the Mimi
+that produced them, so a pack built with a different Mimi checkpoint is ignored until it is rebuilt.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from audio_io import decode_audio
+from generator import Segment, load_mimi
+from moshi.models import loaders
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+PACK_FORMAT = "csm-voice-pack/1"
+SOUNDS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sounds")
+DEFAULT_PACK_PATH = os.path.join(SOUNDS_DIR, "voices.safetensors")
+
+
+@dataclass
+class VoiceInfo:
+    text: str
+    duration_s: float
+    # Mimi frames in the clip; the prompt adds one EOS frame and the text frames.
+    num_frames: int
+    # blake2b of the source audio file's bytes.
+    file_hash: str
+
+
+def file_hash(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def find_voice_pairs(directory: str = SOUNDS_DIR) -> List[Tuple[str, str, str]]:
+    """(name, wav path, txt path) for every ``name.wav`` in ``directory`` with a ``name.txt`` transcript."""
+    pairs = []
+    if os.path.exists(directory):
+        for file in sorted(os.listdir(directory)):
+            name, ext = os.path.splitext(file)
+            txt_path = os.path.join(directory, name + ".txt")
+            if ext == ".wav" and os.path.exists(txt_path):
+                pairs.append((name, os.path.join(directory, file), txt_path))
+    return pairs
+
+
+@torch.inference_mode()
+def build_voice_pack(voices: List[Tuple[str, str, str]], output_path: str, mimi) -> Dict[str, VoiceInfo]:
+    """
+    Encode every (name, wav path, txt path) with ``mimi`` and write the pack to ``output_path``.
+
+    Codes are stored as int16 (32, num_frames) tensors named ``codes.<name>``; the transcripts and
+    clip metadata go into the safetensors header.
+    """
+    device = next(mimi.parameters()).device
+    tensors: Dict[str, torch.Tensor] = {}
+    infos: Dict[str, VoiceInfo] = {}
+    for name, wav_path, txt_path in voices:
+        with open(txt_path, encoding="utf-8") as f:
+            text = f.read().strip()
+        audio = decode_audio(wav_path, mimi.sample_rate)
+        codes = mimi.encode(audio.to(device).unsqueeze(0).unsqueeze(0))[0]
+        tensors[f"codes.{name}"] = codes.to(device="cpu", dtype=torch.int16).contiguous()
+        infos[name] = VoiceInfo(
+            text=text,
+            duration_s=audio.numel() / mimi.sample_rate,
+            num_frames=codes.size(-1),
+            file_hash=file_hash(wav_path),
+        )
+
+    metadata = {
+        "format": PACK_FORMAT,
+        "mimi": loaders.MIMI_NAME,
+        "sample_rate": str(mimi.sample_rate),
+        "voices": json.dumps({name: asdict(info) for name, info in infos.items()}),
+    }
+    save_file(tensors, output_path, metadata=metadata)
+    return infos
+
+
+class VoicePack:
+    """Read side of a voice pack. Codes are read lazily from the memory-mapped file."""
+
+    def __init__(self, path: str = DEFAULT_PACK_PATH):
+        self.path = path
+        self._file = safe_open(path, framework="pt", device="cpu")
+        metadata = self._file.metadata() or {}
+        if metadata.get("format") != PACK_FORMAT:
+            raise ValueError(f"{path} is not a voice pack ({PACK_FORMAT})")
+        # Name of the Mimi checkpoint the codes were encoded with.
+        self.mimi = metadata.get("mimi")
+        self.voices: Dict[str, VoiceInfo] = {
+            name: VoiceInfo(**info) for name, info in json.loads(metadata["voices"]).items()
+        }
+        self._by_hash = {info.file_hash: name for name, info in self.voices.items()}
+
+    @property
+    def names(self) -> List[str]:
+        return sorted(self.voices)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.voices
+
+    def codes(self, name: str) -> torch.Tensor:
+        """(32, num_frames) long codes of voice ``name``."""
+        return self._file.get_tensor(f"codes.{name}").long()
+
+    def segment(self, name: str, speaker: int, text: Optional[str] = None) -> Segment:
+        """Context segment for voice ``name``, with its own transcript unless ``text`` is given."""
+        text = self.voices[name].text if text is None else text
+        return Segment(speaker=speaker, text=text, audio=None, codes=self.codes(name))
+
+    def codes_for_file(self, path: str) -> Optional[torch.Tensor]:
+        """Codes of the packed clip with the same bytes as the audio file at ``path``, if there is one."""
+        name = self._by_hash.get(file_hash(path))
+        return None if name is None else self.codes(name)
+
+
+def load_voice_pack(path: str = DEFAULT_PACK_PATH) -> Optional[VoicePack]:
+    """The voice pack at ``path``, or None when it has not been built or was built with another Mimi."""
+    if not os.path.exists(path):
+        return None
+    pack = VoicePack(path)
+    if pack.mimi != loaders.MIMI_NAME:
+        print(f"Ignoring {path}: built with Mimi {pack.mimi!r}, not {loaders.MIMI_NAME!r}; run python voice_pack.py")
+        return None
+    return pack
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Build a voice pack from reference clips and transcripts.")
+    parser.add_argument("--sounds-dir", type=str, default=SOUNDS_DIR, help="directory of name.wav + name.txt pairs")
+    parser.add_argument(
+        "--voice", nargs=3, action="append", default=[], metavar=("NAME", "WAV", "TXT"), help="an extra voice"
+    )
+    parser.add_argument("--output", type=str, default=DEFAULT_PACK_PATH)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    voices = find_voice_pairs(args.sounds_dir) + [tuple(voice) for voice in args.voice]
+    if not voices:
+        parser.error("no voices found")
+
+    infos = build_voice_pack(voices, args.output, load_mimi(args.device))
+    for name, info in infos.items():
+        print(f"{name}: {info.duration_s:.1f} s, {info.num_frames} frames")
+    print(f"Wrote {len(infos)} voices to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
 import argparse
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 import silentcipher
 import torch
@@ -17,6 +20,26 @@ def cli_check_audio() -> None:
     check_audio_from_file(args.audio_path)
 
 
+_RESAMPLERS: Dict[Tuple[int, int, str, torch.dtype], torchaudio.transforms.Resample] = {}
+_RESAMPLERS_LOCK = threading.Lock()
+
+
+def resample(audio: torch.Tensor, orig_freq: int, new_freq: int) -> torch.Tensor:
+    """
+    ``torchaudio.functional.resample`` with the sinc kernel built once per (rates, device, dtype)
+    instead of on every call. Identity resamples return the input unchanged.
+    """
+    if orig_freq == new_freq:
+        return audio
+    key = (orig_freq, new_freq, str(audio.device), audio.dtype)
+    with _RESAMPLERS_LOCK:
+        resampler = _RESAMPLERS.get(key)
+        if resampler is None:
+            resampler = torchaudio.transforms.Resample(orig_freq, new_freq, dtype=audio.dtype).to(audio.device)
+            _RESAMPLERS[key] = resampler
+    return resampler(audio)
+
+
 def load_watermarker(device: str = "cuda") -> silentcipher.server.Model:
     model = silentcipher.get_model(
         model_type="44.1k",
@@ -32,14 +55,105 @@ def watermark(
     sample_rate: int,
     watermark_key: list[int],
 ) -> tuple[torch.Tensor, int]:
-    audio_array_44khz = torchaudio.functional.resample(audio_array, orig_freq=sample_rate, new_freq=44100)
+    audio_array_44khz = resample(audio_array, orig_freq=sample_rate, new_freq=44100)
     encoded, _ = watermarker.encode_wav(audio_array_44khz, 44100, watermark_key, calc_sdr=False, message_sdr=36)
 
     output_sample_rate = min(44100, sample_rate)
-    encoded = torchaudio.functional.resample(encoded, orig_freq=44100, new_freq=output_sample_rate)
+    encoded = resample(encoded, orig_freq=44100, new_freq=output_sample_rate)
     return encoded, output_sample_rate
 
 
+class WatermarkStage:
+    """
+    Watermarking as a pipeline stage that returns audio at ``sample_rate``.
+
+    With ``background=True`` all watermarking runs on one worker thread, so ``submit`` lets the
+    caller start the next generation while the previous clip is being watermarked. Streamed chunks
+    can be submitted one by one; the worker keeps them in order.
+    """
+
+    def __init__(
+        self,
+        watermarker: silentcipher.server.Model,
+        sample_rate: int,
+        watermark_key: list[int],
+        background: bool = True,
+    ):
+        self._watermarker = watermarker
+        self.sample_rate = sample_rate
+        self._watermark_key = watermark_key
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="watermark") if background else None
+
+    def _apply(self, audio: torch.Tensor) -> torch.Tensor:
+        encoded, wm_sample_rate = watermark(self._watermarker, audio, self.sample_rate, self._watermark_key)
+        return resample(encoded, orig_freq=wm_sample_rate, new_freq=self.sample_rate)
+
+    def submit(self, audio: torch.Tensor) -> "Future[torch.Tensor]":
+        if self._executor is None:
+            future: "Future[torch.Tensor]" = Future()
+            future.set_result(self._apply(audio))
+            return future
+        return self._executor.submit(self._apply, audio)
+
+    def submit_window(self, audio: torch.Tensor, start: int, end: int) -> "Future[torch.Tensor]":
+        """Like ``submit``, but resolves to samples ``start:end`` of the watermarked ``audio`` only."""
+        if self._executor is None:
+            future: "Future[torch.Tensor]" = Future()
+            future.set_result(self._apply(audio)[start:end])
+            return future
+        return self._executor.submit(lambda: self._apply(audio)[start:end])
+
+    def apply(self, audio: torch.Tensor) -> torch.Tensor:
+        # Goes through the worker when there is one so the watermarker is only ever used by one thread.
+        return self.submit(audio).result()
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+
+class StreamingWatermark:
+    """
+    Watermarks audio that arrives in chunks as if it had been watermarked in one piece.
+
+    Resampling and watermarking a short chunk on its own zero-pads both of its edges, which dips the
+    amplitude at every chunk boundary. Here each block is instead watermarked inside a window with up to
+    ``context`` samples of earlier audio before it and ``lookahead`` samples of later audio after it, and
+    only the block is kept. The output therefore lags the input by ``lookahead`` samples; ``flush`` emits
+    the rest at the end of the clip.
+    """
+
+    def __init__(self, stage: WatermarkStage, context: int, lookahead: int):
+        self._stage = stage
+        self._context = context
+        self._lookahead = lookahead
+        # Audio from up to ``context`` samples before the first sample not yet emitted.
+        self._buffer: Optional[torch.Tensor] = None
+        self._start = 0
+
+    def push(self, audio: torch.Tensor) -> List["Future[torch.Tensor]"]:
+        """Add a chunk. Returns futures for the blocks that now have enough lookahead, in order."""
+        self._buffer = audio if self._buffer is None else torch.cat([self._buffer, audio])
+        ready = self._buffer.size(0) - self._start - self._lookahead
+        return [self._emit(ready)] if ready > 0 else []
+
+    def flush(self) -> List["Future[torch.Tensor]"]:
+        """Emit everything still held back, without lookahead past the end of the clip."""
+        if self._buffer is None or self._buffer.size(0) == self._start:
+            return []
+        return [self._emit(self._buffer.size(0) - self._start)]
+
+    def _emit(self, num_samples: int) -> "Future[torch.Tensor]":
+        end = self._start + num_samples
+        window = self._buffer[: end + self._lookahead]
+        future = self._stage.submit_window(window, self._start, end)
+        # The buffer is replaced rather than modified, so the window handed to the worker stays intact.
+        keep_from = max(0, end - self._context)
+        self._buffer = self._buffer[keep_from:]
+        self._start = end - keep_from
+        return future
+
+
 @torch.inference_mode()
 def verify(
     watermarker: silentcipher.server.Model,
@@ -47,7 +161,7 @@ def verify(
     sample_rate: int,
     watermark_key: list[int],
 ) -> bool:
-    watermarked_audio_44khz = torchaudio.functional.resample(watermarked_audio, orig_freq=sample_rate, new_freq=44100)
+    watermarked_audio_44khz = resample(watermarked_audio, orig_freq=sample_rate, new_freq=44100)
     result = watermarker.decode_wav(watermarked_audio_44khz, 44100, phase_shift_decoding=True)
 
     is_watermarked = result["status"]
@@ -0,0 +1,328 @@
+import builtins
+import itertools
+import os
+import queue
+import threading
+import traceback
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+import torch
+import torch.multiprocessing as mp
+from generator import Generator, Segment, _resolve_checkpoint, load_llama3_tokenizer, load_mimi
+from models import Model, ModelArgs, load_model_from_checkpoint, model_from_state_dict
+from moshi.models import loaders
+from moshi.models.compression import MimiModel
+from moshi.modules import SEANetDecoder, SEANetEncoder
+from moshi.modules.transformer import ProjectedTransformer
+from moshi.quantization import SplitResidualVectorQuantizer
+from watermarking import load_watermarker
+
+
+def _shared_state_dict(module: torch.nn.Module) -> Dict[str, torch.Tensor]:
+    module.share_memory()
+    return module.state_dict()
+
+
+def _share_modules(obj) -> None:
+    """Move the weights of every module held directly by ``obj`` (e.g. the watermarker) to shared memory."""
+    for value in getattr(obj, "__dict__", {}).values():
+        if isinstance(value, torch.nn.Module):
+            value.share_memory()
+
+
+class _RemoteTraceback(Exception):
+    """The worker's traceback, chained as the cause of the error re-raised in the parent."""
+
+    def __str__(self) -> str:
+        return self.args[0]
+
+
+def _rebuild_error(type_name: str, message: str, remote_traceback: str) -> Exception:
+    """
+    The worker's exception rebuilt from its name and message: a builtin type is kept, so callers can still
+    catch e.g. ``ValueError``; anything else becomes a ``RuntimeError`` naming the original type.
+    """
+    error_type = getattr(builtins, type_name, None)
+    error = None
+    if isinstance(error_type, type) and issubclass(error_type, Exception):
+        try:
+            error = error_type(message)
+        except TypeError:  # builtins with a different signature, e.g. UnicodeDecodeError
+            pass
+    if error is None:
+        error = RuntimeError(f"{type_name}: {message}")
+    error.__cause__ = _RemoteTraceback(remote_traceback)
+    return error
+
+
+def _mimi_from_state_dict(state_dict: Dict[str, torch.Tensor]) -> MimiModel:
+    """
+    Mimi built as moshi 0.2.2's ``loaders.get_mimi`` builds it, but around ``state_dict`` instead of a
+    checkpoint file (``get_mimi`` needs a file to load).
+    """
+    encoder = SEANetEncoder(**loaders._seanet_kwargs)
+    decoder = SEANetDecoder(**loaders._seanet_kwargs)
+    mimi = MimiModel(
+        encoder,
+        decoder,
+        SplitResidualVectorQuantizer(**loaders._quantizer_kwargs),
+        channels=1,
+        sample_rate=loaders.SAMPLE_RATE,
+        frame_rate=loaders.FRAME_RATE,
+        encoder_frame_rate=loaders.SAMPLE_RATE / encoder.hop_length,
+        causal=True,
+        resample_method="conv",
+        encoder_transformer=ProjectedTransformer(device="cpu", **loaders._transformer_kwargs),
+        decoder_transformer=ProjectedTransformer(device="cpu", **loaders._transformer_kwargs),
+    )
+    mimi.load_state_dict(state_dict, assign=True)
+    mimi.eval()
+    mimi.set_num_codebooks(32)
+    return mimi
+
+
+def _allowed_cores() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    try:
+        import psutil
+
+        return sorted(psutil.Process().cpu_affinity())
+    except (ImportError, AttributeError):  # no psutil, or macOS where it has no cpu_affinity
+        return list(range(os.cpu_count()))
+
+
+def _can_pin_cores() -> bool:
+    if hasattr(os, "sched_setaffinity"):
+        return True
+    try:
+        import psutil
+    except ImportError:
+        return False
+    return hasattr(psutil.Process, "cpu_affinity")
+
+
+def _pin_to_cores(cores: List[int]) -> None:
+    """Restrict this process to ``cores``: ``sched_setaffinity`` on Linux, psutil on Windows."""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    else:
+        import psutil
+
+        psutil.Process().cpu_affinity(cores)
+
+
+def _worker_main(
+    model_config: ModelArgs,
+    model_state: Dict[str, torch.Tensor],
+    dtype: torch.dtype,
+    audio_tokenizer,
+    generator_kwargs: dict,
+    num_threads: int,
+    cores: Optional[List[int]],
+    jobs: "mp.Queue",
+    results: "mp.Queue",
+) -> None:
+    if cores:
+        _pin_to_cores(cores)
+    torch.set_num_threads(num_threads)
+
+    # Weights arrive as shared-memory tensors and are assigned, not copied, into modules built here;
+    # only the KV caches set up by Generator are private to this worker.
+    model = model_from_state_dict(model_state, model_config, device="cpu", dtype=dtype)
+    if isinstance(audio_tokenizer, dict):
+        audio_tokenizer = _mimi_from_state_dict(audio_tokenizer)
+    generator = Generator(model, audio_tokenizer=audio_tokenizer, **generator_kwargs)
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, kwargs = job
+        try:
+            audio = generator.generate(on_progress=lambda done, total: None, **kwargs)
+            # Sent by value: a shared-memory tensor would need this worker alive until the parent reads it.
+            results.put((job_id, audio.cpu().numpy(), None))
+        except Exception as e:  # noqa: BLE001 - reported to the caller through its future
+            # Sent as strings: an exception holding unpicklable state would break the results queue.
+            results.put((job_id, None, (type(e).__name__, str(e), traceback.format_exc())))
+
+
+class WorkerPool:
+    """
+    ``num_workers`` CPU processes serving ``Generator.generate`` jobs from one queue.
+
+    The parent holds the only copy of the model, Mimi and watermarker weights, moved into shared memory;
+    each worker maps them and adds just its own KV caches. The text tokenizer is also loaded once, in the
+    parent, and each worker gets a copy of it. If the tokenizer or watermarker cannot be pickled, every worker
+    loads its own instead, which is printed once. Workers are started with ``spawn``: forking after torch has
+    run multi-threaded OpenMP work can hang the child. Quantized models are not supported.
+
+    A job that fails in a worker fails its future with the same builtin exception type and message (other
+    types become ``RuntimeError``), chained to the worker's traceback.
+
+    Each worker runs ``threads_per_worker`` intra-op threads, optionally pinned to its own cores. Pinning
+    needs ``os.sched_setaffinity`` (Linux) or psutil (Windows); elsewhere, e.g. on macOS, ``pin_cores``
+    raises rather than being ignored.
+    """
+
+    def __init__(
+        self,
+        model: Model,
+        num_workers: int,
+        threads_per_worker: Optional[int] = None,
+        pin_cores: bool = False,
+        audio_tokenizer=None,
+        generator_kwargs: Optional[dict] = None,
+        text_tokenizer=None,
+        watermarker=None,
+    ):
+        if pin_cores and not _can_pin_cores():
+            raise RuntimeError("pin_cores needs os.sched_setaffinity (Linux) or psutil (Windows)")
+        cores = _allowed_cores()
+        threads_per_worker = threads_per_worker or max(1, len(cores) // num_workers)
+        if pin_cores and num_workers * threads_per_worker > len(cores):
+            raise ValueError(f"{num_workers} workers x {threads_per_worker} threads do not fit on {len(cores)} cores")
+
+        # Modules are not picklable (torchtune attention holds a closure), so workers get shared state
+        # dicts and rebuild the modules around them.
+        model_state = _shared_state_dict(model)
+        if audio_tokenizer is None:
+            audio_tokenizer = load_mimi("cpu")
+        if isinstance(audio_tokenizer, torch.nn.Module):
+            audio_tokenizer = _shared_state_dict(audio_tokenizer)
+        if text_tokenizer is None:
+            text_tokenizer = load_llama3_tokenizer()
+        if watermarker is None:
+            watermarker = load_watermarker(device="cpu")
+        _share_modules(watermarker)
+        shared = dict(text_tokenizer=text_tokenizer, watermarker=watermarker)
+
+        ctx = mp.get_context("spawn")
+        self._jobs = ctx.Queue()
+        self._results = ctx.Queue()
+        self._futures: Dict[int, Future] = {}
+        self._futures_lock = threading.Lock()
+        self._job_ids = itertools.count()
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+
+        def start(worker_cores: Optional[List[int]], shared: dict) -> "mp.Process":
+            process = ctx.Process(
+                target=_worker_main,
+                args=(
+                    model.config,
+                    model_state,
+                    next(model.parameters()).dtype,
+                    audio_tokenizer,
+                    dict(generator_kwargs or {}, **shared),
+                    threads_per_worker,
+                    worker_cores,
+                    self._jobs,
+                    self._results,
+                ),
+                daemon=True,
+            )
+            # spawn pickles the arguments here.
+            process.start()
+            return process
+
+        self._workers = []
+        for rank in range(num_workers):
+            worker_cores = cores[rank * threads_per_worker : (rank + 1) * threads_per_worker] if pin_cores else None
+            try:
+                process = start(worker_cores, shared)
+            except Exception as e:  # noqa: BLE001 - pickling fails with TypeError, AttributeError, ...
+                if not shared:
+                    raise
+                print(
+                    f"WorkerPool: the tokenizer or watermarker cannot be sent to workers ({type(e).__name__}: {e}); "
+                    "each worker loads its own"
+                )
+                shared = {}
+                process = start(worker_cores, shared)
+            self._workers.append(process)
+
+        self._collector = threading.Thread(target=self._collect, name="worker-pool-results", daemon=True)
+        self._collector.start()
+
+    @property
+    def pids(self) -> List[int]:
+        return [process.pid for process in self._workers]
+
+    def submit(
+        self,
+        text: str,
+        speaker: int,
+        context: List[Segment],
+        max_audio_length_ms: float = 90_000,
+        temperature: float = 0.9,
+        topk: int = 50,
+    ) -> "Future[torch.Tensor]":
+        """Queue one ``generate`` call. The future resolves to the watermarked (num_samples,) waveform."""
+        future: "Future[torch.Tensor]" = Future()
+        job_id = next(self._job_ids)
+        with self._futures_lock:
+            self._futures[job_id] = future
+        kwargs = dict(
+            text=text,
+            speaker=speaker,
+            context=context,
+            max_audio_length_ms=max_audio_length_ms,
+            temperature=temperature,
+            topk=topk,
+        )
+        self._jobs.put((job_id, kwargs))
+        return future
+
+    def close(self) -> None:
+        for _ in self._workers:
+            self._jobs.put(None)
+        for process in self._workers:
+            process.join()
+        self._results.put(None)
+        self._collector.join()
+        self._fail_pending(RuntimeError("worker pool closed"))
+
+    def __enter__(self) -> "WorkerPool":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _collect(self) -> None:
+        while True:
+            try:
+                item = self._results.get(timeout=1.0)
+            except queue.Empty:
+                if not any(process.is_alive() for process in self._workers):
+                    self._fail_pending(RuntimeError("all pool workers exited"))
+                    return
+                continue
+            if item is None:
+                return
+            job_id, audio, error = item
+            with self._futures_lock:
+                future = self._futures.pop(job_id)
+            if error is not None:
+                future.set_exception(_rebuild_error(*error))
+            else:
+                future.set_result(torch.from_numpy(audio))
+
+    def _fail_pending(self, error: Exception) -> None:
+        with self._futures_lock:
+            for future in self._futures.values():
+                future.set_exception(error)
+            self._futures.clear()
+
+
+def load_worker_pool(
+    checkpoint_path: Optional[str] = None,
+    num_workers: int = 2,
+    threads_per_worker: Optional[int] = None,
+    pin_cores: bool = False,
+    dtype: torch.dtype = torch.bfloat16,
+) -> WorkerPool:
+    """Load the checkpoint and Mimi once on CPU and start ``num_workers`` workers sharing them."""
+    model = load_model_from_checkpoint(_resolve_checkpoint(checkpoint_path), device="cpu", dtype=dtype)
+    return WorkerPool(model, num_workers, threads_per_worker, pin_cores)
@@ -150,6 +150,7 @@ try {
         pip install moshi==0.2.2
         pip install torchtune==0.4.0
         pip install torchao==0.9.0
+        pip install soundfile==0.13.1
         pip install "silentcipher @ git+https://github.com/SesameAILabs/silentcipher@master"
     }else{
         Write-Host "Installing GPU-compatible packages for CUDA 12.4..." -ForegroundColor Yellow
@@ -165,6 +166,7 @@ try {
         pip install moshi==0.2.2
         pip install torchtune==0.4.0
         pip install torchao==0.9.0
+        pip install soundfile==0.13.1
         pip install "silentcipher @ git+https://github.com/SesameAILabs/silentcipher@master"
     }
     